@@ -8,8 +8,11 @@ from st_utils import (
     get_current_state,
     get_weather,
     parse_args,
-    get_nyt_stories
+    get_nyt_stories,
+    get_session_id,
+    update_agent_ids,
 )
+from core.llm_scheduler import llm_request_context
 
 # Steps
 # 1. parse command-line arguments
@@ -141,7 +144,7 @@ if selected and selected != st.session_state.selected_pill:
 
 # Generate and display the assistant's response
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
+        with st.spinner("Thinking..."), llm_request_context(get_session_id()):
             response = current_state.builder_agent.chat(selected)
             st.write(str(response))
             add_to_message_history("assistant", str(response))
@@ -164,18 +167,16 @@ if prompt := st.chat_input(
         # If last message is not from assistant, generate a new response
         if st.session_state.messages[-1]["role"] != "assistant":
             with st.chat_message("assistant"):
-                with st.spinner("Thinking..."):
+                with st.spinner("Thinking..."), llm_request_context(get_session_id()):
                     response = current_state.builder_agent.chat(prompt)
                     st.write(str(response))
                     add_to_message_history("assistant", str(response))
 
         else:
             pass
-        # check agent_ids again
-        # if it doesn't match, add to directory and refresh
-        agent_ids = current_state.agent_registry.get_agent_ids()
-        # check diff between agent_ids and cur agent ids
-        diff_ids = list(set(agent_ids) - set(st.session_state.cur_agent_ids))
+        # check agent_ids again (only read if the registry changed)
+        # if there are new agents, refresh
+        diff_ids = update_agent_ids()
         if len(diff_ids) > 0:
             # # clear streamlit cache, to allow you to generate a new agent
             # st.cache_resource.clear()
@@ -0,0 +1,490 @@
+"""Headless HTTP serving for registered agents.
+
+Serves the agents in the agent cache registry (`cache/agents/` by default)
+without Streamlit in the request path. Agents are loaded once at startup and
+kept in memory; every conversation gets its own chat engine over the shared
+index.
+
+    python app.py --port 8000
+
+Endpoints:
+
+- GET /health
+- GET /agents
+- POST /agents/{agent_id}/chat
+    body: {"message": "...", "conversation_id": "..." (optional)}
+    returns: {"conversation_id": ..., "response": ..., "sources": [...]}
+- POST /agents/{agent_id}/stream_chat
+    same body, returns the response as a chunked text/plain stream (the
+    conversation id is in the `X-Conversation-Id` header)
+- DELETE /agents/{agent_id}/conversations/{conversation_id}
+
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import signal
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+from llama_index.core.chat_engine.types import BaseChatEngine
+
+from core.agent_builder.registry import AgentCacheRegistry
+from core.constants import AGENT_CACHE_DIR
+from core.llm_scheduler import Priority, llm_request_context
+from core.param_cache import ParamCache
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_BYTES = 1024 * 1024
+MAX_HEADERS = 100
+# seconds for a client to send its whole request
+READ_TIMEOUT = 30.0
+
+
+class HTTPError(Exception):
+    """Error returned to the client as a JSON response."""
+
+    def __init__(self, status: HTTPStatus, message: str) -> None:
+        """Init params."""
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+@dataclass
+class Request:
+    """Parsed HTTP request."""
+
+    method: str
+    path: str
+    headers: Dict[str, str]
+    body: bytes
+
+    def json(self) -> Dict[str, Any]:
+        try:
+            data = json.loads(self.body or b"{}")
+        except json.JSONDecodeError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Body must be valid JSON.")
+        if not isinstance(data, dict):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Body must be a JSON object.")
+        return data
+
+
+@dataclass
+class Conversation:
+    """A conversation with an agent (own chat engine / memory)."""
+
+    agent: BaseChatEngine
+    # turns of one conversation must not interleave
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class AgentServer:
+    """Serve registered agents over HTTP.
+
+    Requests are handled on one event loop; the (blocking) agent calls run in
+    worker threads, bounded by `max_concurrency`.
+
+    """
+
+    def __init__(
+        self,
+        registry: AgentCacheRegistry,
+        agent_ids: Optional[List[str]] = None,
+        max_concurrency: int = 8,
+        max_conversations: int = 1000,
+        conversation_ttl: float = 3600.0,
+    ) -> None:
+        """Init params."""
+        self._registry = registry
+        self._agent_ids = agent_ids
+        self._max_concurrency = max_concurrency
+        self._max_conversations = max_conversations
+        self._conversation_ttl = conversation_ttl
+        self._caches: Dict[str, ParamCache] = {}
+        self._conversations: Dict[Tuple[str, str], Conversation] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._tasks: "set[asyncio.Task]" = set()
+
+    def load_agents(self) -> None:
+        """Load agent caches from the registry."""
+        agent_ids = self._agent_ids or self._registry.get_agent_ids()
+        for agent_id in agent_ids:
+            start = time.perf_counter()
+            self._caches[agent_id] = self._registry.get_agent_cache(agent_id)
+            logger.info(
+                "Loaded agent %s in %.1fs", agent_id, time.perf_counter() - start
+            )
+
+    def _create_agent(self, agent_id: str) -> BaseChatEngine:
+        return self._caches[agent_id].create_agent(
+            msg_handler=lambda msg: logger.info("[%s] %s", agent_id, msg.strip())
+        )
+
+    def _evict_conversations(self) -> None:
+        """Drop idle conversations, and the oldest ones if over capacity."""
+        now = time.monotonic()
+        for key, conversation in list(self._conversations.items()):
+            idle = now - conversation.last_used > self._conversation_ttl
+            if idle and not conversation.lock.locked():
+                del self._conversations[key]
+        if len(self._conversations) > self._max_conversations:
+            by_age = sorted(
+                self._conversations.items(), key=lambda item: item[1].last_used
+            )
+            for key, conversation in by_age:
+                if len(self._conversations) <= self._max_conversations:
+                    break
+                if not conversation.lock.locked():
+                    del self._conversations[key]
+
+    async def _get_conversation(
+        self, agent_id: str, conversation_id: str
+    ) -> Conversation:
+        if agent_id not in self._caches:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"Agent {agent_id} not found.")
+        key = (agent_id, conversation_id)
+        if key not in self._conversations:
+            agent = await asyncio.to_thread(self._create_agent, agent_id)
+            # another request may have created it while we were building
+            if key not in self._conversations:
+                self._conversations[key] = Conversation(agent=agent)
+                self._evict_conversations()
+        conversation = self._conversations[key]
+        conversation.last_used = time.monotonic()
+        return conversation
+
+    @staticmethod
+    def _parse_chat_request(request: Request) -> Tuple[str, str]:
+        data = request.json()
+        message = data.get("message")
+        if not isinstance(message, str) or not message.strip():
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "`message` must be a string.")
+        conversation_id = str(data.get("conversation_id") or uuid.uuid4())
+        return message, conversation_id
+
+    async def _chat(self, agent_id: str, request: Request) -> Dict[str, Any]:
+        message, conversation_id = self._parse_chat_request(request)
+        conversation = await self._get_conversation(agent_id, conversation_id)
+        assert self._semaphore is not None
+        async with conversation.lock, self._semaphore:
+
+            def _run() -> Any:
+                with llm_request_context(conversation_id, Priority.INTERACTIVE):
+                    return conversation.agent.chat(message)
+
+            response = await asyncio.to_thread(_run)
+        return {
+            "conversation_id": conversation_id,
+            "response": str(response),
+            "sources": [
+                {
+                    "node_id": node.node.node_id,
+                    "score": node.score,
+                    "metadata": node.node.metadata,
+                }
+                for node in getattr(response, "source_nodes", [])
+            ],
+        }
+
+    async def _stream_chat(
+        self, agent_id: str, request: Request
+    ) -> Tuple[str, AsyncGenerator[str, None]]:
+        message, conversation_id = self._parse_chat_request(request)
+        conversation = await self._get_conversation(agent_id, conversation_id)
+        assert self._semaphore is not None
+        loop = asyncio.get_running_loop()
+        queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+        errors: List[BaseException] = []
+        # set if the client went away: the worker stops streaming
+        cancelled = threading.Event()
+
+        def _run() -> None:
+            try:
+                with llm_request_context(conversation_id, Priority.INTERACTIVE):
+                    response = conversation.agent.stream_chat(message)
+                    for token in response.response_gen:
+                        if cancelled.is_set():
+                            break
+                        loop.call_soon_threadsafe(queue.put_nowait, token)
+                    if cancelled.is_set():
+                        _wait_until_written(response)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        async def _gen() -> AsyncGenerator[str, None]:
+            async with conversation.lock, self._semaphore:  # type: ignore
+                task = asyncio.ensure_future(asyncio.to_thread(_run))
+                try:
+                    while True:
+                        token = await queue.get()
+                        if token is None:
+                            break
+                        yield token
+                finally:
+                    cancelled.set()
+                    # the conversation / concurrency slot are only released once
+                    # the worker is done with the agent
+                    await asyncio.wait({task})
+            if errors:
+                logger.error("Streaming failed", exc_info=errors[0])
+
+        return conversation_id, _gen()
+
+    def _reset(self, agent_id: str, conversation_id: str) -> Dict[str, Any]:
+        conversation = self._conversations.pop((agent_id, conversation_id), None)
+        if conversation is None:
+            raise HTTPError(HTTPStatus.NOT_FOUND, "Conversation not found.")
+        return {"conversation_id": conversation_id, "deleted": True}
+
+    async def _route(
+        self, request: Request, writer: asyncio.StreamWriter
+    ) -> Optional[Tuple[HTTPStatus, Dict[str, Any]]]:
+        """Route request, return (status, JSON body), or None if already sent."""
+        parts = [part for part in request.path.split("?")[0].split("/") if part]
+        if request.method == "GET" and parts == ["health"]:
+            return HTTPStatus.OK, {
+                "status": "ok",
+                "num_agents": len(self._caches),
+                "num_conversations": len(self._conversations),
+            }
+        if request.method == "GET" and parts == ["agents"]:
+            return HTTPStatus.OK, {"agent_ids": list(self._caches.keys())}
+        if len(parts) == 3 and parts[0] == "agents" and request.method == "POST":
+            agent_id = parts[1]
+            if parts[2] == "chat":
+                return HTTPStatus.OK, await self._chat(agent_id, request)
+            if parts[2] == "stream_chat":
+                conversation_id, gen = await self._stream_chat(agent_id, request)
+                await _write_stream(writer, conversation_id, gen)
+                return None
+        if (
+            len(parts) == 4
+            and parts[0] == "agents"
+            and parts[2] == "conversations"
+            and request.method == "DELETE"
+        ):
+            return HTTPStatus.OK, self._reset(parts[1], parts[3])
+        raise HTTPError(
+            HTTPStatus.NOT_FOUND, f"No route for {request.method} {request.path}"
+        )
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Handle one connection (one request, no keep-alive)."""
+        task = asyncio.current_task()
+        if task is not None:
+            self._tasks.add(task)
+        try:
+            try:
+                request = await _read_request(reader)
+                result = await self._route(request, writer)
+            except HTTPError as e:
+                result = e.status, {"error": e.message}
+            except Exception as e:
+                logger.exception("Error handling request")
+                result = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)}
+            if result is not None:
+                await _write_json(writer, *result)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            if task is not None:
+                self._tasks.discard(task)
+
+    async def serve(self, host: str, port: int, shutdown_timeout: float = 30.0) -> None:
+        """Serve until SIGINT / SIGTERM, then drain in-flight requests."""
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logger.info("Serving %d agents on http://%s:%d", len(self._caches), host, port)
+        async with server:
+            await stop.wait()
+            # stop accepting new connections, let in-flight requests finish
+            logger.info("Shutting down, %d requests in flight", len(self._tasks))
+            server.close()
+            if self._tasks:
+                _, pending = await asyncio.wait(
+                    set(self._tasks), timeout=shutdown_timeout
+                )
+                for task in pending:
+                    task.cancel()
+        logger.info("Shut down")
+
+
+def _wait_until_written(response: Any, poll_interval: float = 0.01) -> None:
+    """Wait until a streamed response is written to the agent's memory.
+
+    The agent writes it from its own thread once the LLM stream ends, which
+    can't be interrupted.
+
+    """
+    while (
+        getattr(response, "is_writing_to_memory", False)
+        and not getattr(response, "is_done", True)
+        and getattr(response, "exception", None) is None
+    ):
+        time.sleep(poll_interval)
+
+
+async def _read_line(reader: asyncio.StreamReader) -> str:
+    try:
+        line = await reader.readline()
+    except ValueError:
+        # longer than the stream limit (64KB)
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Line too long.")
+    return line.decode("latin-1").strip()
+
+
+async def _read_request(
+    reader: asyncio.StreamReader, timeout: float = READ_TIMEOUT
+) -> Request:
+    """Read a (minimal) HTTP/1.1 request, within timeout seconds."""
+    try:
+        return await asyncio.wait_for(_read_request_parts(reader), timeout)
+    except asyncio.TimeoutError:
+        raise HTTPError(HTTPStatus.REQUEST_TIMEOUT, "Timed out reading request.")
+
+
+async def _read_request_parts(reader: asyncio.StreamReader) -> Request:
+    request_line = await _read_line(reader)
+    try:
+        method, path, _ = request_line.split(" ", 2)
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request line.")
+    headers: Dict[str, str] = {}
+    for num_headers in range(MAX_HEADERS + 1):
+        line = await _read_line(reader)
+        if not line:
+            break
+        if num_headers == MAX_HEADERS:
+            raise HTTPError(
+                HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, "Too many headers."
+            )
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0) or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length.")
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Body too large.")
+    body = await reader.readexactly(length) if length else b""
+    return Request(method=method.upper(), path=path, headers=headers, body=body)
+
+
+async def _write_json(
+    writer: asyncio.StreamWriter, status: HTTPStatus, data: Dict[str, Any]
+) -> None:
+    body = json.dumps(data).encode("utf-8")
+    writer.write(
+        (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode("latin-1")
+        + body
+    )
+    await writer.drain()
+
+
+async def _write_stream(
+    writer: asyncio.StreamWriter,
+    conversation_id: str,
+    gen: AsyncGenerator[str, None],
+) -> None:
+    """Write tokens as they come, with chunked transfer encoding.
+
+    The generator is closed even if the client goes away, so that it stops the
+    agent call it streams from.
+
+    """
+    try:
+        writer.write(
+            (
+                "HTTP/1.1 200 OK\r\n"
+                "Content-Type: text/plain; charset=utf-8\r\n"
+                "Transfer-Encoding: chunked\r\n"
+                f"X-Conversation-Id: {conversation_id}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1")
+        )
+        async for token in gen:
+            data = token.encode("utf-8")
+            if data:
+                writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+                await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+    finally:
+        await gen.aclose()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve registered agents over HTTP")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host")
+    parser.add_argument("--port", type=int, default=8000, help="Port")
+    parser.add_argument(
+        "--cache-dir", type=str, default=str(AGENT_CACHE_DIR), help="Agent cache dir"
+    )
+    parser.add_argument(
+        "--agent-ids", nargs="+", default=None, help="Agents to serve (default: all)"
+    )
+    parser.add_argument(
+        "--max-concurrency", type=int, default=8, help="Max concurrent agent calls"
+    )
+    parser.add_argument(
+        "--max-conversations", type=int, default=1000, help="Max open conversations"
+    )
+    parser.add_argument(
+        "--conversation-ttl",
+        type=float,
+        default=3600.0,
+        help="Seconds after which an idle conversation is dropped",
+    )
+    parser.add_argument(
+        "--shutdown-timeout",
+        type=float,
+        default=30.0,
+        help="Seconds to wait for in-flight requests on shutdown",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s"
+    )
+    server = AgentServer(
+        AgentCacheRegistry(args.cache_dir),
+        agent_ids=args.agent_ids,
+        max_concurrency=args.max_concurrency,
+        max_conversations=args.max_conversations,
+        conversation_ttl=args.conversation_ttl,
+    )
+    server.load_agents()
+    asyncio.run(server.serve(args.host, args.port, args.shutdown_timeout))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Run a file of questions against a registered agent.
+
+Questions are read from a JSONL file (one object per line) or a CSV file with
+a header row. Answers are appended to a JSONL output file as they complete, so
+an interrupted run can be resumed by running the same command again: questions
+that already have an answer in the output file are skipped.
+
+    python batch_query.py <agent_id> --input questions.jsonl --output answers.jsonl
+
+"""
+
+import argparse
+import csv
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List, Set
+
+from llama_index.core.chat_engine.types import BaseChatEngine
+
+from core.agent_builder.registry import AgentCacheRegistry
+from core.constants import AGENT_CACHE_DIR
+from core.llm_scheduler import Priority, llm_request_context
+from core.param_cache import ParamCache
+
+logger = logging.getLogger(__name__)
+
+
+def load_questions(
+    input_path: Path, question_field: str, id_field: str
+) -> List[Dict[str, str]]:
+    """Load questions as a list of {"id": ..., "question": ...}.
+
+    Rows without an id are numbered by position in the file.
+
+    """
+    if input_path.suffix.lower() == ".csv":
+        with open(input_path, newline="") as f:
+            rows: List[Dict[str, Any]] = list(csv.DictReader(f))
+    else:
+        with open(input_path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    questions = []
+    for i, row in enumerate(rows):
+        if question_field not in row:
+            raise ValueError(f"Row {i} has no `{question_field}` field.")
+        row_id = row.get(id_field)
+        questions.append(
+            {
+                "id": str(row_id if row_id not in (None, "") else i),
+                "question": str(row[question_field]),
+            }
+        )
+    return questions
+
+
+def load_done_ids(output_path: Path) -> Set[str]:
+    """Get ids of questions already answered in output_path."""
+    done_ids: Set[str] = set()
+    if not output_path.exists():
+        return done_ids
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # partially written line of an interrupted run
+                continue
+            if "error" not in record:
+                done_ids.add(str(record["id"]))
+    return done_ids
+
+
+class BatchRunner:
+    """Run questions in a thread pool, one chat engine per worker thread."""
+
+    def __init__(self, cache: ParamCache, concurrency: int = 4) -> None:
+        """Init params."""
+        self._cache = cache
+        self._concurrency = concurrency
+        self._local = threading.local()
+
+    def _get_agent(self) -> BaseChatEngine:
+        agent = getattr(self._local, "agent", None)
+        if agent is None:
+            agent = self._cache.create_agent(
+                msg_handler=lambda msg: logger.debug(msg.strip())
+            )
+            self._local.agent = agent
+        return agent
+
+    def _run_one(self, question: Dict[str, str]) -> Dict[str, Any]:
+        agent = self._get_agent()
+        # questions are independent, don't carry over conversation state
+        agent.reset()
+        start = time.perf_counter()
+        try:
+            with llm_request_context(
+                f"batch-{threading.get_ident()}", Priority.BACKGROUND
+            ):
+                response = agent.chat(question["question"])
+        except Exception as e:
+            logger.exception("Question %s failed", question["id"])
+            return {
+                **question,
+                "error": str(e),
+                "latency_ms": (time.perf_counter() - start) * 1000,
+            }
+        return {
+            **question,
+            "answer": str(response),
+            "source_node_ids": [
+                node.node.node_id for node in getattr(response, "source_nodes", [])
+            ],
+            "latency_ms": (time.perf_counter() - start) * 1000,
+        }
+
+    def run(self, questions: List[Dict[str, str]], output_path: Path) -> int:
+        """Run questions, append results to output_path. Returns number of errors."""
+        num_errors = 0
+        # terminate a partially written last line of an interrupted run
+        if output_path.exists() and output_path.stat().st_size > 0:
+            with open(output_path, "rb") as f:
+                f.seek(-1, 2)
+                needs_newline = f.read(1) != b"\n"
+            if needs_newline:
+                with open(output_path, "a") as f:
+                    f.write("\n")
+        with open(output_path, "a") as f, ThreadPoolExecutor(
+            max_workers=self._concurrency
+        ) as executor:
+            futures = [executor.submit(self._run_one, q) for q in questions]
+            for i, future in enumerate(as_completed(futures)):
+                record = future.result()
+                num_errors += "error" in record
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                print(
+                    f"[{i + 1}/{len(questions)}] {record['id']} "
+                    f"{record['latency_ms']:.0f}ms",
+                    file=sys.stderr,
+                )
+        return num_errors
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Batch query a registered agent")
+    parser.add_argument("agent_id", type=str, help="Agent id")
+    parser.add_argument(
+        "--input", type=str, required=True, help="Questions file (.jsonl or .csv)"
+    )
+    parser.add_argument("--output", type=str, required=True, help="Output JSONL file")
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="Number of parallel workers"
+    )
+    parser.add_argument(
+        "--cache-dir", type=str, default=str(AGENT_CACHE_DIR), help="Agent cache dir"
+    )
+    parser.add_argument(
+        "--question-field", type=str, default="question", help="Question field"
+    )
+    parser.add_argument("--id-field", type=str, default="id", help="Id field")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    output_path = Path(args.output)
+    questions = load_questions(Path(args.input), args.question_field, args.id_field)
+    done_ids = load_done_ids(output_path)
+    todo = [q for q in questions if q["id"] not in done_ids]
+    print(
+        f"{len(questions)} questions, {len(questions) - len(todo)} already done",
+        file=sys.stderr,
+    )
+    if not todo:
+        return
+
+    cache = AgentCacheRegistry(args.cache_dir).get_agent_cache(args.agent_id)
+    start = time.perf_counter()
+    num_errors = BatchRunner(cache, concurrency=args.concurrency).run(todo, output_path)
+    elapsed = time.perf_counter() - start
+    print(
+        f"Answered {len(todo) - num_errors}/{len(todo)} questions in {elapsed:.1f}s "
+        f"({len(todo) / elapsed:.1f} questions/s)",
+        file=sys.stderr,
+    )
+    if num_errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""Benchmark reduced-precision / truncated embedding storage.
+
+Embeds each bundled dataset once, then stores the embeddings in every storage
+mode (reduced precision, truncation, product quantization, see
+core/vector_stores.py) and reports memory / disk saved against recall@k lost,
+relative to exact full precision search.
+
+    python -m benchmarks.embedding_storage --output embedding_storage.json
+
+NOTE: the offline hash embeddings aren't trained for truncation, so truncated
+modes lose more recall than they would with e.g. OpenAI `text-embedding-3-*`
+(use `--embed-model` with a real model to measure that).
+
+"""
+
+import os
+
+# must be set before `core` is imported (it resolves the builder LLM on import)
+os.environ.setdefault("RAGS_OFFLINE", "1")
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores import SimpleVectorStore
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from benchmarks.run_benchmarks import (
+    DATASETS,
+    get_dir_size,
+    get_git_commit,
+    percentile,
+    sample_queries,
+    timed,
+)
+from core.utils import RAGParams, _resolve_embed_model, build_vector_index, load_data
+from core.vector_stores import QuantizedVectorStore, get_vector_store
+
+# `get_vector_store` params, "truncate" keeps half the dimensions
+STORAGE_MODES: List[Dict[str, Any]] = [
+    {"precision": "float16"},
+    {"precision": "int8"},
+    {"precision": "int8", "full_precision_rerank": True},
+    {"precision": "float16", "truncate": True},
+    {"precision": "int8", "truncate": True},
+    {"precision": "int8", "truncate": True, "full_precision_rerank": True},
+    {"index_type": "pq", "pq_subvector_dim": 4},
+    {"index_type": "pq", "pq_subvector_dim": 8},
+    {"index_type": "pq", "pq_subvector_dim": 8, "full_precision_rerank": True},
+]
+
+
+def get_mode_name(params: Dict[str, Any]) -> str:
+    """Readable name of a storage mode."""
+    if params.get("index_type") == "pq":
+        name = f"pq/subvector_dim={params['pq_subvector_dim']}"
+    else:
+        name = params["precision"]
+    if params.get("dim") is not None:
+        name += f"/dim={params['dim']}"
+    return f"{name}+rerank" if params.get("full_precision_rerank") else name
+
+
+def query_ids(
+    vector_store: Any, query_embeddings: List[List[float]], top_k: int
+) -> Tuple[List[List[str]], List[float]]:
+    """Top-k node ids per query, and latencies in ms."""
+    ids = []
+    latencies = []
+    for query_embedding in query_embeddings:
+        result, secs = timed(
+            lambda: vector_store.query(
+                VectorStoreQuery(
+                    query_embedding=query_embedding, similarity_top_k=top_k
+                )
+            )
+        )
+        ids.append(result.ids)
+        latencies.append(secs * 1000)
+    return ids, latencies
+
+
+def get_recall(exact_ids: List[List[str]], ids: List[List[str]]) -> float:
+    """Mean fraction of the exact top-k found."""
+    recalls = [
+        len(set(exact) & set(found)) / len(exact)
+        for exact, found in zip(exact_ids, ids)
+        if exact
+    ]
+    return sum(recalls) / len(recalls) if recalls else 0.0
+
+
+def bench_dataset(
+    dataset: Dict[str, Any],
+    rag_params: RAGParams,
+    num_queries: int,
+    top_k: int,
+    seed: int,
+) -> Dict[str, Any]:
+    """Benchmark all storage modes over one dataset."""
+    docs = load_data(**dataset)
+    vector_index = build_vector_index(docs, rag_params)
+    exact_store = vector_index.vector_store
+    assert isinstance(exact_store, SimpleVectorStore)
+    embedding_dict = exact_store.data.embedding_dict
+    nodes = [
+        TextNode(id_=node_id, embedding=embedding)
+        for node_id, embedding in embedding_dict.items()
+    ]
+    full_dim = len(nodes[0].embedding or [])
+    embed_model = _resolve_embed_model(rag_params.embed_model)
+    query_embeddings = [
+        embed_model.get_query_embedding(query)
+        for query in sample_queries(docs, num_queries, seed)
+    ]
+
+    exact_ids, exact_latencies = query_ids(exact_store, query_embeddings, top_k)
+    # float32 as a contiguous array, the baseline for the savings
+    float32_bytes = len(nodes) * full_dim * 4
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        exact_store.persist(str(Path(tmp_dir) / "vector_store.json"))
+        exact_disk_bytes = get_dir_size(Path(tmp_dir))
+
+    modes = []
+    for mode in STORAGE_MODES:
+        params = {key: value for key, value in mode.items() if key != "truncate"}
+        params["dim"] = full_dim // 2 if mode.get("truncate") else None
+        store = get_vector_store(**params)
+        assert store is not None
+        store.add(nodes)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store.persist(str(Path(tmp_dir) / "vector_store.json"))
+            # queries run against the persisted store (full vectors memory-mapped)
+            store = QuantizedVectorStore.from_persist_path(
+                str(Path(tmp_dir) / "vector_store.json")
+            )
+            ids, latencies = query_ids(store, query_embeddings, top_k)
+            disk_bytes = get_dir_size(Path(tmp_dir))
+        mode_result = {
+            "mode": get_mode_name(params),
+            "memory_bytes": store.nbytes,
+            "memory_saved": 1 - store.nbytes / float32_bytes,
+            "disk_bytes": disk_bytes,
+            "disk_saved": 1 - disk_bytes / exact_disk_bytes,
+            f"recall@{top_k}": get_recall(exact_ids, ids),
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+        }
+        modes.append(mode_result)
+        print(
+            f"  {mode_result['mode']:<24} memory -{mode_result['memory_saved']:.0%}, "
+            f"recall@{top_k} {mode_result[f'recall@{top_k}']:.3f}",
+            file=sys.stderr,
+        )
+    return {
+        "num_embeddings": len(nodes),
+        "dim": full_dim,
+        "float32": {
+            "memory_bytes": float32_bytes,
+            "disk_bytes": exact_disk_bytes,
+            "p50_ms": percentile(exact_latencies, 50),
+            "p95_ms": percentile(exact_latencies, 95),
+        },
+        "modes": modes,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Embedding storage benchmark")
+    parser.add_argument(
+        "--datasets",
+        nargs="+",
+        default=list(DATASETS.keys()),
+        choices=list(DATASETS.keys()),
+        help="Datasets to benchmark",
+    )
+    parser.add_argument("--chunk-size", type=int, default=512, help="Chunk size")
+    parser.add_argument("--top-k", type=int, default=10, help="Recall@k")
+    parser.add_argument(
+        "--num-queries", type=int, default=100, help="Number of queries"
+    )
+    parser.add_argument(
+        "--embed-model", type=str, default="offline:hash", help="Embedding model"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--output", type=str, default=None, help="Output JSON file (default: stdout)"
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    rag_params = RAGParams(
+        chunk_size=args.chunk_size, embed_model=args.embed_model, llm="offline:echo"
+    )
+    results = []
+    for dataset_name in args.datasets:
+        print(f"[{dataset_name}]", file=sys.stderr)
+        results.append(
+            {
+                "dataset": dataset_name,
+                **bench_dataset(
+                    DATASETS[dataset_name],
+                    rag_params,
+                    args.num_queries,
+                    args.top_k,
+                    args.seed,
+                ),
+            }
+        )
+    results_str = json.dumps(
+        {
+            "meta": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "git_commit": get_git_commit(),
+                "params": vars(args),
+            },
+            "results": results,
+        },
+        indent=2,
+    )
+    if args.output is None:
+        print(results_str)
+    else:
+        with open(args.output, "w") as f:
+            f.write(results_str)
+
+
+if __name__ == "__main__":
+    main()
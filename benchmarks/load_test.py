@@ -0,0 +1,443 @@
+"""Load test the Streamlit and HTTP agent serving paths with concurrent sessions.
+
+Builds one agent offline (hash embeddings + echo LLM, see core/offline.py) in a
+temporary registry, then for each session count runs that many concurrent
+sessions, each sending `--turns` chat turns, and reports throughput, turn
+latency percentiles and memory growth per session.
+
+- `streamlit`: every session has its own session state (`st.session_state`
+  is patched to the state of the calling session's thread) and runs the
+  app's own `st_utils.get_current_state` before every turn, like a Streamlit
+  script rerun, then chats with the selected agent.
+- `server`: sessions are conversations of an in-process `AgentServer`
+  (app.py), driven over HTTP.
+
+    python -m benchmarks.load_test --sessions 1 4 16 --turns 5 --output load.json
+
+Set `--llm-latency` to simulate a remote LLM (the echo LLM answers instantly).
+
+"""
+
+import os
+
+# must be set before `core` is imported (it resolves the builder LLM on import)
+os.environ.setdefault("RAGS_OFFLINE", "1")
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import http.client
+import json
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from unittest import mock
+
+import streamlit as st
+
+import st_utils
+from app import AgentServer
+from benchmarks.run_benchmarks import (
+    DATASETS,
+    get_git_commit,
+    get_peak_rss_mb,
+    percentile,
+    sample_queries,
+    timed,
+)
+from build_agents import build_agent
+from core.agent_builder.registry import AgentCacheRegistry
+from core.llm_scheduler import llm_request_context
+from core.offline import OFFLINE_LATENCY_ENV_VAR
+from core.utils import load_data
+
+AGENT_ID = "load_test_agent"
+MODES = ["streamlit", "server"]
+
+
+def get_rss_mb() -> float:
+    """Current resident set size of this process, in MB (peak if unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            num_pages = int(f.read().split()[1])
+    except OSError:
+        return get_peak_rss_mb()
+    return num_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+class SessionState(dict):
+    """Session state of one simulated session (item and attribute access)."""
+
+    def __getattr__(self, name: str) -> Any:
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        self[name] = value
+
+
+class ThreadSessionState:
+    """Stand-in for `st.session_state`: the state of the calling thread's session.
+
+    Streamlit runs each session in its own script thread, so do the sessions
+    of the load test.
+
+    """
+
+    def __init__(self) -> None:
+        """Init params."""
+        object.__setattr__(self, "_local", threading.local())
+
+    @contextlib.contextmanager
+    def bind(self, session_state: SessionState) -> Iterator[None]:
+        """Use session_state in this thread."""
+        self._local.state = session_state
+        try:
+            yield
+        finally:
+            del self._local.state
+
+    def _get_state(self) -> SessionState:
+        try:
+            return self._local.state
+        except AttributeError:
+            raise RuntimeError("No session state bound to this thread.")
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._get_state(), name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self._get_state(), name, value)
+
+    def __getitem__(self, key: str) -> Any:
+        return self._get_state()[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._get_state()[key] = value
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._get_state()
+
+    def keys(self) -> Any:
+        return self._get_state().keys()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._get_state().get(key, default)
+
+
+@contextlib.contextmanager
+def patch_streamlit(cache_dir: str) -> Iterator[ThreadSessionState]:
+    """Run the app's session code over per-thread session states in cache_dir."""
+    session_states = ThreadSessionState()
+    with mock.patch.object(st, "session_state", session_states), mock.patch.object(
+        st_utils, "AGENT_CACHE_DIR", cache_dir
+    ):
+        yield session_states
+
+
+def run_streamlit_session(
+    session_states: ThreadSessionState,
+    queries: List[str],
+    kept_states: List[SessionState],
+) -> Tuple[float, List[float]]:
+    """One Streamlit session: select the agent, then chat.
+
+    Returns (session start seconds, turn latencies in seconds).
+
+    """
+    session_state = SessionState(session_id=str(uuid.uuid4()))
+    # kept alive until the end of the run, like sessions of a running app
+    kept_states.append(session_state)
+
+    with session_states.bind(session_state):
+
+        def _start() -> None:
+            # first page load, then selecting the agent in the sidebar
+            st_utils.get_current_state()
+            st_utils.update_selected_agent_with_id(AGENT_ID)
+            st_utils.get_current_state()
+
+        _, start_secs = timed(_start)
+        latencies = []
+        for query in queries:
+
+            def _turn() -> Any:
+                cache = st_utils.get_current_state().cache
+                with llm_request_context(session_state["session_id"]):
+                    return cache.agent.chat(query)
+
+            _, secs = timed(_turn)
+            latencies.append(secs)
+    return start_secs, latencies
+
+
+def _post(port: int, path: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+    try:
+        conn.request("POST", path, body=json.dumps(body))
+        response = conn.getresponse()
+        data = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(f"HTTP {response.status}: {data}")
+        return data
+    finally:
+        conn.close()
+
+
+def run_server_session(port: int, queries: List[str]) -> Tuple[float, List[float]]:
+    """One HTTP conversation. The first turn creates the conversation."""
+    conversation_id = str(uuid.uuid4())
+    latencies = []
+    for query in queries:
+        _, secs = timed(
+            lambda: _post(
+                port,
+                f"/agents/{AGENT_ID}/chat",
+                {"message": query, "conversation_id": conversation_id},
+            )
+        )
+        latencies.append(secs)
+    # the server has no separate session start, it's part of the first turn
+    return 0.0, latencies
+
+
+class ServerThread:
+    """`AgentServer` serving on a free local port, on its own event loop."""
+
+    def __init__(self, cache_dir: str, max_concurrency: int) -> None:
+        """Init params."""
+        self.server = AgentServer(
+            AgentCacheRegistry(cache_dir), max_concurrency=max_concurrency
+        )
+        self.server.load_agents()
+        self.port = 0
+        self._loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self._loop)
+
+        async def _start() -> None:
+            # what `AgentServer.serve` does, minus the signal handling
+            self.server._semaphore = asyncio.Semaphore(self.server._max_concurrency)
+            tcp_server = await asyncio.start_server(
+                self.server.handle_connection, "127.0.0.1", 0
+            )
+            self.port = tcp_server.sockets[0].getsockname()[1]
+            self._started.set()
+
+        self._loop.run_until_complete(_start())
+        self._loop.run_forever()
+
+    def __enter__(self) -> "ServerThread":
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+def run_level(
+    mode: str,
+    num_sessions: int,
+    queries: List[str],
+    turns: int,
+    session_states: Optional[ThreadSessionState],
+    port: Optional[int],
+) -> Dict[str, Any]:
+    """Run `num_sessions` concurrent sessions of `turns` turns each."""
+    gc.collect()
+    rss_before = get_rss_mb()
+    kept_states: List[SessionState] = []
+    with ThreadPoolExecutor(max_workers=num_sessions) as executor:
+        start = time.perf_counter()
+        futures = []
+        for i in range(num_sessions):
+            # sessions ask different questions, in a different order
+            session_queries = [
+                queries[(i + turn) % len(queries)] for turn in range(turns)
+            ]
+            if mode == "streamlit":
+                assert session_states is not None
+                futures.append(
+                    executor.submit(
+                        run_streamlit_session,
+                        session_states,
+                        session_queries,
+                        kept_states,
+                    )
+                )
+            else:
+                assert port is not None
+                futures.append(
+                    executor.submit(run_server_session, port, session_queries)
+                )
+        session_results = [future.result() for future in futures]
+        wall_secs = time.perf_counter() - start
+    gc.collect()
+    rss_growth = get_rss_mb() - rss_before
+
+    start_secs = [start_secs for start_secs, _ in session_results]
+    latencies = [
+        secs for _, session_latencies in session_results for secs in session_latencies
+    ]
+    return {
+        "mode": mode,
+        "num_sessions": num_sessions,
+        "num_turns": len(latencies),
+        "wall_secs": wall_secs,
+        "turns_per_sec": len(latencies) / wall_secs,
+        "session_start_p50_ms": percentile(start_secs, 50) * 1000,
+        "turn_p50_ms": percentile(latencies, 50) * 1000,
+        "turn_p95_ms": percentile(latencies, 95) * 1000,
+        "turn_p99_ms": percentile(latencies, 99) * 1000,
+        "rss_growth_mb": rss_growth,
+        "rss_growth_per_session_mb": rss_growth / num_sessions,
+    }
+
+
+def run_load_test(
+    modes: List[str],
+    session_counts: List[int],
+    turns: int,
+    dataset_name: str,
+    top_k: int,
+    max_concurrency: int,
+    seed: int,
+) -> Dict[str, Any]:
+    """Run the load test, return results as a JSON-serializable dict."""
+    dataset = DATASETS[dataset_name]
+    queries = sample_queries(load_data(**dataset), max(turns, 20), seed)
+    results: List[Dict[str, Any]] = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        agent_spec = {
+            "agent_id": AGENT_ID,
+            "system_prompt": "You are a helpful assistant answering questions.",
+            **dataset,
+            "rag_params": {
+                "embed_model": "offline:hash",
+                "llm": "offline:echo",
+                "top_k": top_k,
+            },
+        }
+        build_secs = build_agent(agent_spec, AgentCacheRegistry(cache_dir))
+        print(f"Built agent in {build_secs:.1f}s", file=sys.stderr)
+        for mode in modes:
+            mode_context = (
+                ServerThread(cache_dir, max_concurrency)
+                if mode == "server"
+                else patch_streamlit(cache_dir)
+            )
+            with mode_context as context:
+                for num_sessions in session_counts:
+                    result = run_level(
+                        mode,
+                        num_sessions,
+                        queries,
+                        turns,
+                        context if mode == "streamlit" else None,
+                        context.port if mode == "server" else None,
+                    )
+                    print(
+                        f"{mode} x{num_sessions}: "
+                        f"{result['turns_per_sec']:.1f} turns/s, "
+                        f"p95 {result['turn_p95_ms']:.0f}ms, "
+                        f"+{result['rss_growth_per_session_mb']:.1f}MB/session",
+                        file=sys.stderr,
+                    )
+                    results.append(result)
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git_commit": get_git_commit(),
+            "params": {
+                "modes": modes,
+                "session_counts": session_counts,
+                "turns": turns,
+                "dataset": dataset_name,
+                "top_k": top_k,
+                "max_concurrency": max_concurrency,
+                "llm_latency": os.environ.get(OFFLINE_LATENCY_ENV_VAR),
+                "seed": seed,
+            },
+        },
+        "results": results,
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline multi-session load test")
+    parser.add_argument(
+        "--modes", nargs="+", default=MODES, choices=MODES, help="Serving paths"
+    )
+    parser.add_argument(
+        "--sessions",
+        nargs="+",
+        type=int,
+        default=[1, 4, 16],
+        help="Numbers of concurrent sessions",
+    )
+    parser.add_argument("--turns", type=int, default=5, help="Chat turns per session")
+    parser.add_argument(
+        "--dataset",
+        type=str,
+        default="books",
+        choices=list(DATASETS.keys()),
+        help="Dataset of the agent",
+    )
+    parser.add_argument("--top-k", type=int, default=2, help="top_k of the agent")
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=8,
+        help="Concurrent agent calls of the server (`app.py --max-concurrency`)",
+    )
+    parser.add_argument(
+        "--llm-latency",
+        type=float,
+        default=None,
+        help="Simulated LLM latency per call, in seconds",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--output", type=str, default=None, help="Output JSON file (default: stdout)"
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.llm_latency is not None:
+        # read by the offline LLMs when agents are loaded
+        os.environ[OFFLINE_LATENCY_ENV_VAR] = str(args.llm_latency)
+    results = run_load_test(
+        args.modes,
+        args.sessions,
+        args.turns,
+        args.dataset,
+        args.top_k,
+        args.max_concurrency,
+        args.seed,
+    )
+    results_str = json.dumps(results, indent=2)
+    if args.output is None:
+        print(results_str)
+    else:
+        with open(args.output, "w") as f:
+            f.write(results_str)
+
+
+if __name__ == "__main__":
+    main()
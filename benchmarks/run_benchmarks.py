@@ -0,0 +1,296 @@
+"""Benchmark ingestion, index build, persistence and query latency.
+
+Runs entirely offline against the bundled datasets (hash embeddings + echo LLM,
+see core/offline.py) and writes machine-readable JSON so runs can be compared.
+
+    python -m benchmarks.run_benchmarks --output bench_results.json
+
+"""
+
+import os
+
+# must be set before `core` is imported (it resolves the builder LLM on import)
+os.environ.setdefault("RAGS_OFFLINE", "1")
+
+import argparse
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from llama_index.core import Document, VectorStoreIndex
+
+from core.param_cache import ParamCache
+from core.utils import RAGParams, construct_agent, load_data
+
+REPO_DIR = Path(__file__).parent.parent
+DATASETS: Dict[str, Dict[str, Any]] = {
+    "books": {"file_names": [str(REPO_DIR / "data" / "books.csv")]},
+    "movies": {"directory": str(REPO_DIR / "data" / "movies")},
+}
+# queries that make sense for both datasets, plus lines sampled from the data
+FIXED_QUERIES = [
+    "war films directed by Steven Spielberg",
+    "highly rated fantasy books for young adults",
+    "animated movies about friendship",
+    "biography of a famous boxer",
+    "classic detective stories from the 1940s",
+]
+
+
+def get_peak_rss_mb() -> float:
+    """Peak resident set size of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KB on Linux, bytes on macOS
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return peak / divisor
+
+
+def get_dir_size(path: Path) -> int:
+    """Total size of files under path, in bytes."""
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile."""
+    if not values:
+        return 0.0
+    sorted_values = sorted(values)
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def timed(fn: Callable[[], Any]) -> Tuple[Any, float]:
+    """Run fn, return (result, seconds)."""
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def get_git_commit() -> Optional[str]:
+    """Current git commit, if any."""
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def sample_queries(docs: List[Document], num_queries: int, seed: int) -> List[str]:
+    """Fixed queries, topped up with random lines from the documents."""
+    rng = random.Random(seed)
+    lines = [
+        line.strip()
+        for doc in docs
+        for line in doc.text.splitlines()
+        if len(line.strip()) > 40
+    ]
+    queries = list(FIXED_QUERIES)
+    while len(queries) < num_queries and lines:
+        line = rng.choice(lines)
+        queries.append(" ".join(line.split()[:12]))
+    return queries[:num_queries]
+
+
+def bench_load(dataset: Dict[str, Any]) -> Tuple[List[Document], Dict[str, Any]]:
+    """Benchmark `load_data`."""
+    docs, secs = timed(lambda: load_data(**dataset))
+    num_chars = sum(len(doc.text) for doc in docs)
+    return docs, {
+        "num_docs": len(docs),
+        "num_chars": num_chars,
+        "load_secs": secs,
+        "docs_per_sec": len(docs) / secs if secs else None,
+        "mb_per_sec": num_chars / 1e6 / secs if secs else None,
+    }
+
+
+def bench_build(
+    docs: List[Document], rag_params: RAGParams
+) -> Tuple[ParamCache, Dict[str, Any]]:
+    """Benchmark `construct_agent` (chunking + embedding + agent setup)."""
+    (agent, extra_info), secs = timed(
+        lambda: construct_agent("You are a helpful assistant.", rag_params, docs)
+    )
+    vector_index = extra_info["vector_index"]
+    num_chunks = len(vector_index.docstore.docs)
+    cache = ParamCache(
+        system_prompt="You are a helpful assistant.",
+        docs=docs,
+        rag_params=rag_params,
+        vector_index=vector_index,
+        agent=agent,
+    )
+    return cache, {
+        "num_chunks": num_chunks,
+        "build_secs": secs,
+        "chunks_per_sec": num_chunks / secs if secs else None,
+    }
+
+
+def bench_persist(cache: ParamCache, dataset: Dict[str, Any]) -> Dict[str, Any]:
+    """Benchmark `ParamCache.save_to_disk` / `ParamCache.load_from_disk`."""
+    cache.file_names = dataset.get("file_names", [])
+    cache.directory = dataset.get("directory")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        save_dir = Path(tmp_dir) / cache.agent_id
+        _, save_secs = timed(lambda: cache.save_to_disk(str(save_dir)))
+        size = get_dir_size(save_dir)
+        _, load_secs = timed(lambda: ParamCache.load_from_disk(str(save_dir)))
+    return {
+        "save_secs": save_secs,
+        "load_secs": load_secs,
+        "disk_bytes": size,
+    }
+
+
+def bench_retrieval(
+    vector_index: VectorStoreIndex,
+    queries: List[str],
+    top_k: int,
+    warmup: int = 2,
+) -> Dict[str, Any]:
+    """Benchmark retrieval latency (query embedding + vector search)."""
+    retriever = vector_index.as_retriever(similarity_top_k=top_k)
+    for query in queries[:warmup]:
+        retriever.retrieve(query)
+    latencies = []
+    for query in queries:
+        _, secs = timed(lambda: retriever.retrieve(query))
+        latencies.append(secs * 1000)
+    return {
+        "top_k": top_k,
+        "num_queries": len(queries),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "mean_ms": sum(latencies) / len(latencies) if latencies else 0.0,
+    }
+
+
+def run_benchmarks(
+    dataset_names: List[str],
+    chunk_sizes: List[int],
+    top_ks: List[int],
+    num_queries: int,
+    embed_model: str,
+    seed: int,
+) -> Dict[str, Any]:
+    """Run all benchmarks and return results."""
+    results: List[Dict[str, Any]] = []
+    for dataset_name in dataset_names:
+        dataset = DATASETS[dataset_name]
+        docs, load_result = bench_load(dataset)
+        queries = sample_queries(docs, num_queries, seed)
+        dataset_result: Dict[str, Any] = {
+            "dataset": dataset_name,
+            "load": load_result,
+            "configs": [],
+        }
+        for i, chunk_size in enumerate(chunk_sizes):
+            rag_params = RAGParams(
+                chunk_size=chunk_size,
+                top_k=max(top_ks),
+                embed_model=embed_model,
+                llm="offline:echo",
+            )
+            cache, build_result = bench_build(docs, rag_params)
+            config_result: Dict[str, Any] = {
+                "chunk_size": chunk_size,
+                "build": build_result,
+                "retrieval": [
+                    bench_retrieval(cache.vector_index, queries, top_k)
+                    for top_k in top_ks
+                ],
+            }
+            # persistence doesn't depend much on chunk size, only measure once
+            if i == 0:
+                config_result["persist"] = bench_persist(cache, dataset)
+            config_result["peak_rss_mb"] = get_peak_rss_mb()
+            dataset_result["configs"].append(config_result)
+            print(
+                f"[{dataset_name}] chunk_size={chunk_size}: "
+                f"{build_result['chunks_per_sec']:.1f} chunks/s, "
+                f"peak RSS {config_result['peak_rss_mb']:.0f} MB",
+                file=sys.stderr,
+            )
+        results.append(dataset_result)
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_commit": get_git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {
+                "datasets": dataset_names,
+                "chunk_sizes": chunk_sizes,
+                "top_ks": top_ks,
+                "num_queries": num_queries,
+                "embed_model": embed_model,
+                "seed": seed,
+            },
+        },
+        "results": results,
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline RAG benchmarks")
+    parser.add_argument(
+        "--datasets",
+        nargs="+",
+        default=list(DATASETS.keys()),
+        choices=list(DATASETS.keys()),
+        help="Datasets to benchmark",
+    )
+    parser.add_argument(
+        "--chunk-sizes", nargs="+", type=int, default=[512, 1024], help="Chunk sizes"
+    )
+    parser.add_argument(
+        "--top-ks", nargs="+", type=int, default=[2, 5, 10], help="top_k values"
+    )
+    parser.add_argument(
+        "--num-queries", type=int, default=50, help="Number of retrieval queries"
+    )
+    parser.add_argument(
+        "--embed-model", type=str, default="offline:hash", help="Embedding model"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--output", type=str, default=None, help="Output JSON file (default: stdout)"
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    results = run_benchmarks(
+        args.datasets,
+        args.chunk_sizes,
+        args.top_ks,
+        args.num_queries,
+        args.embed_model,
+        args.seed,
+    )
+    results_str = json.dumps(results, indent=2)
+    if args.output is None:
+        print(results_str)
+    else:
+        with open(args.output, "w") as f:
+            f.write(results_str)
+
+
+if __name__ == "__main__":
+    main()
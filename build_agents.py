@@ -0,0 +1,182 @@
+"""Build agents in bulk from a declarative spec.
+
+Builds agents directly through `RAGAgentBuilder` (no builder LLM round-trips)
+and registers them in the agent cache registry. Agents are built in parallel
+threads, so loading and embedding of different agents overlap.
+
+    python build_agents.py agents.yaml --workers 8
+
+Spec (YAML or JSON):
+
+    defaults:                 # optional, merged into every agent
+      rag_params:
+        embed_model: default
+    agents:
+      - agent_id: books_agent
+        system_prompt: You are a helpful assistant that recommends books.
+        file_names: [data/books.csv]    # or `directory` or `urls`
+        rag_params:
+          top_k: 3
+          chunk_size: 512
+        tools: [web_search]              # optional
+
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List
+
+from core.agent_builder.base import RAGAgentBuilder
+from core.agent_builder.registry import AgentCacheRegistry
+from core.constants import AGENT_CACHE_DIR
+from core.param_cache import ParamCache
+
+logger = logging.getLogger(__name__)
+
+
+def load_spec(spec_path: Path) -> List[Dict[str, Any]]:
+    """Load agent specs, with the defaults merged in."""
+    with open(spec_path) as f:
+        if spec_path.suffix.lower() in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError(
+                    "`pyyaml` package not found, please run `pip install pyyaml` "
+                    "or use a JSON spec."
+                )
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+
+    defaults = spec.get("defaults", {})
+    agent_specs = []
+    for agent_spec in spec["agents"]:
+        if "agent_id" not in agent_spec:
+            raise ValueError(f"Agent spec {agent_spec} has no `agent_id`.")
+        if not agent_spec.get("system_prompt", defaults.get("system_prompt")):
+            raise ValueError(f"Agent {agent_spec['agent_id']} has no system prompt.")
+        merged = {**defaults, **agent_spec}
+        merged["rag_params"] = {
+            **defaults.get("rag_params", {}),
+            **agent_spec.get("rag_params", {}),
+        }
+        agent_specs.append(merged)
+
+    agent_ids = [agent_spec["agent_id"] for agent_spec in agent_specs]
+    duplicates = {agent_id for agent_id in agent_ids if agent_ids.count(agent_id) > 1}
+    if duplicates:
+        raise ValueError(f"Duplicate agent ids in spec: {sorted(duplicates)}")
+    return agent_specs
+
+
+def build_agent(
+    agent_spec: Dict[str, Any], registry: AgentCacheRegistry, replace: bool = False
+) -> float:
+    """Build and register one agent. Returns build time in seconds.
+
+    With replace, an existing agent with the same id is replaced once the new
+    one is built (it's kept if the build fails).
+
+    """
+    start = time.perf_counter()
+    builder = RAGAgentBuilder(cache=ParamCache(), agent_registry=registry)
+    builder.cache.system_prompt = agent_spec["system_prompt"]
+    builder.load_data(
+        file_names=agent_spec.get("file_names"),
+        directory=agent_spec.get("directory"),
+        urls=agent_spec.get("urls"),
+    )
+    for tool in agent_spec.get("tools", []):
+        if tool != "web_search":
+            raise ValueError(f"Tool {tool} not recognized.")
+        builder.add_web_tool()
+    builder.set_rag_params(**agent_spec["rag_params"])
+    if replace and agent_spec["agent_id"] in registry.get_agent_ids():
+        builder.cache.agent_id = agent_spec["agent_id"]
+        builder.update_agent(agent_spec["agent_id"])
+    else:
+        builder.create_agent(agent_id=agent_spec["agent_id"])
+    return time.perf_counter() - start
+
+
+def build_agents(
+    agent_specs: List[Dict[str, Any]],
+    registry: AgentCacheRegistry,
+    workers: int = 4,
+    replace: bool = False,
+) -> Dict[str, str]:
+    """Build agents in parallel. Returns errors by agent id."""
+    errors: Dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                build_agent, agent_spec, registry, replace
+            ): agent_spec["agent_id"]
+            for agent_spec in agent_specs
+        }
+        for future in as_completed(futures):
+            agent_id = futures[future]
+            try:
+                secs = future.result()
+            except Exception as e:
+                logger.exception("Failed to build agent %s", agent_id)
+                errors[agent_id] = str(e)
+                continue
+            print(f"Built {agent_id} in {secs:.1f}s", file=sys.stderr)
+    return errors
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Build agents from a spec file")
+    parser.add_argument("spec", type=str, help="Spec file (.yaml/.yml or .json)")
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Number of agents built in parallel"
+    )
+    parser.add_argument(
+        "--cache-dir", type=str, default=str(AGENT_CACHE_DIR), help="Agent cache dir"
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Rebuild agents that already exist (default: skip them)",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    registry = AgentCacheRegistry(args.cache_dir)
+    agent_specs = load_spec(Path(args.spec))
+
+    existing_ids = set(registry.get_agent_ids())
+    # with rebuild, existing agents are replaced (kept if their build fails)
+    if not args.rebuild:
+        skipped = [a["agent_id"] for a in agent_specs if a["agent_id"] in existing_ids]
+        if skipped:
+            print(f"Skipping existing agents: {skipped}", file=sys.stderr)
+        agent_specs = [a for a in agent_specs if a["agent_id"] not in existing_ids]
+
+    start = time.perf_counter()
+    errors = build_agents(
+        agent_specs, registry, workers=args.workers, replace=args.rebuild
+    )
+    print(
+        f"Built {len(agent_specs) - len(errors)}/{len(agent_specs)} agents "
+        f"in {time.perf_counter() - start:.1f}s",
+        file=sys.stderr,
+    )
+    if errors:
+        for agent_id, error in errors.items():
+            print(f"  {agent_id}: {error}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,20 +2,27 @@
 
 from llama_index.core.llms import ChatMessage
 from llama_index.core.prompts import ChatPromptTemplate
+from llama_index.core import VectorStoreIndex
 from typing import List, cast, Optional
 from core.builder_config import BUILDER_LLM
 from typing import Dict, Any
 import uuid
+from pathlib import Path
 from core.constants import AGENT_CACHE_DIR
 from abc import ABC, abstractmethod
 
 from core.param_cache import ParamCache, RAGParams
+from core.compact import copy_index
 from core.utils import (
+    _resolve_embed_model,
     load_data,
+    load_data_sources,
+    insert_docs,
     get_tool_objects,
     construct_agent,
 )
 from core.agent_builder.registry import AgentCacheRegistry
+from core.llm_scheduler import Priority, llm_request_context
 
 
 # System prompt tool
@@ -132,6 +139,103 @@ class RAGAgentBuilder(BaseRAGAgentBuilder):
         self._cache.directory = directory
         return "Data loaded successfully."
 
+    def add_data(
+        self,
+        file_names: Optional[List[str]] = None,
+        directory: Optional[str] = None,
+        urls: Optional[List[str]] = None,
+    ) -> str:
+        """Add data to the agent, in addition to the data already loaded.
+
+        Unlike `load_data`, this keeps the data already loaded, and if the agent
+        has already been created only the new data is indexed. Saving the
+        agent still rewrites its whole storage (or copies its shared corpus).
+
+        Args:
+            file_names (Optional[List[str]]): List of file names to add.
+                Defaults to None.
+            directory (Optional[str]): Directory to add files from.
+            urls (Optional[List[str]]): List of urls to add.
+                Defaults to None.
+
+        """
+        new_file_names = list(file_names or [])
+        if directory:
+            # add the files of the directory (non-recursive, like `load_data`)
+            new_file_names.extend(
+                sorted(
+                    str(path)
+                    for path in Path(directory).iterdir()
+                    if path.is_file() and not path.name.startswith(".")
+                )
+            )
+        loaded_file_names = set(self._cache.file_names)
+        if self._cache.directory:
+            loaded_file_names.update(
+                str(path) for path in Path(self._cache.directory).iterdir()
+            )
+        new_file_names = [f for f in new_file_names if f not in loaded_file_names]
+        new_urls = [url for url in urls or [] if url not in self._cache.urls]
+        if not new_file_names and not new_urls:
+            return "Data already loaded."
+
+        new_docs = load_data_sources(file_names=new_file_names, urls=new_urls)
+        # NOTE: don't modify in place, docs / sources may be shared with other
+        # agents (see `core.corpus_store`)
+        self._cache.docs = self._cache.docs + new_docs
+        self._cache.file_names = self._cache.file_names + new_file_names
+        self._cache.urls = self._cache.urls + new_urls
+        if self._cache.vector_index is None:
+            return (
+                "Data added successfully. "
+                "It will be indexed when the agent is created."
+            )
+
+        rag_params = cast(RAGParams, self._cache.rag_params)
+        with llm_request_context(priority=Priority.BACKGROUND):
+            if self._cache.corpus_id is not None:
+                corpus_store = self._agent_registry.corpus_store
+                corpus_id, vector_index = corpus_store.extend(
+                    self._cache.corpus_id,
+                    new_docs,
+                    rag_params,
+                    file_names=self._cache.file_names,
+                    directory=self._cache.directory,
+                    urls=self._cache.urls,
+                )
+                self._cache.corpus_id = corpus_id
+                self._cache.vector_index = vector_index
+            else:
+                # the loaded index may be shared with other loaded copies of the
+                # agent (see `core.param_cache`): modify a private copy
+                vector_index = cast(
+                    VectorStoreIndex,
+                    copy_index(
+                        self._cache.vector_index,
+                        embed_model=_resolve_embed_model(rag_params.embed_model),
+                    ),
+                )
+                insert_docs(vector_index, new_docs, rag_params)
+                self._cache.vector_index = vector_index
+            # rebuild agent over the updated index (no re-indexing)
+            agent, _ = construct_agent(
+                cast(str, self._cache.system_prompt),
+                rag_params,
+                self._cache.docs,
+                vector_index=self._cache.vector_index,
+                additional_tools=get_tool_objects(self._cache.tools),
+                agent_id=self._cache.agent_id,
+            )
+        self._cache.agent = agent
+        self._cache.compact()
+
+        # NOTE: not incremental, the storage files (vector store, docstore) are
+        # single JSON files: adding data costs as much disk I/O as saving the
+        # whole agent, only the embedding work is saved
+        if self._cache.agent_id in self._agent_registry.get_agent_ids():
+            self._agent_registry.save_agent_cache(self._cache.agent_id, self._cache)
+        return f"Added {len(new_docs)} documents to agent {self._cache.agent_id}."
+
     def add_web_tool(self) -> str:
         """Add a web tool to enable agent to solve a task."""
         # TODO: make this not hardcoded to a web tool
@@ -175,27 +279,56 @@ class RAGAgentBuilder(BaseRAGAgentBuilder):
         functions should have already been called to set up the agent.
 
         """
+        agent_id = self._build_agent(agent_id)
+        # save the cache to disk
+        self._agent_registry.add_new_agent_cache(agent_id, self._cache)
+        return "Agent created successfully."
+
+    def _build_agent(self, agent_id: Optional[str] = None) -> str:
+        """Build the agent into the cache (not saved). Returns the agent id."""
         if self._cache.system_prompt is None:
             raise ValueError("Must set system prompt before creating agent.")
 
+        # if agent_id not specified, randomly generate one
+        agent_id = agent_id or self._cache.agent_id or f"Agent_{str(uuid.uuid4())}"
+
         # construct additional tools
         additional_tools = get_tool_objects(self.cache.tools)
-        agent, extra_info = construct_agent(
-            cast(str, self._cache.system_prompt),
-            cast(RAGParams, self._cache.rag_params),
-            self._cache.docs,
-            additional_tools=additional_tools,
-        )
+        # index builds yield to interactive chat when rate limited
+        with llm_request_context(priority=Priority.BACKGROUND):
+            # agents over the same data share the index, if data was loaded
+            # from sources we can fingerprint
+            vector_index = None
+            has_sources = (
+                self._cache.file_names or self._cache.directory or self._cache.urls
+            )
+            if has_sources:
+                corpus_store = self._agent_registry.corpus_store
+                corpus_id, vector_index = corpus_store.get_or_build(
+                    self._cache.docs,
+                    cast(RAGParams, self._cache.rag_params),
+                    file_names=self._cache.file_names,
+                    directory=self._cache.directory,
+                    urls=self._cache.urls,
+                )
+                self._cache.corpus_id = corpus_id
+            else:
+                self._cache.corpus_id = None
+            agent, extra_info = construct_agent(
+                cast(str, self._cache.system_prompt),
+                cast(RAGParams, self._cache.rag_params),
+                self._cache.docs,
+                vector_index=vector_index,
+                additional_tools=additional_tools,
+                agent_id=agent_id,
+            )
 
-        # if agent_id not specified, randomly generate one
-        agent_id = agent_id or self._cache.agent_id or f"Agent_{str(uuid.uuid4())}"
         self._cache.vector_index = extra_info["vector_index"]
         self._cache.agent_id = agent_id
         self._cache.agent = agent
-
-        # save the cache to disk
-        self._agent_registry.add_new_agent_cache(agent_id, self._cache)
-        return "Agent created successfully."
+        # once indexed, docs can be dropped in favor of references
+        self._cache.compact()
+        return agent_id
 
     def update_agent(
         self,
@@ -207,19 +340,37 @@ class RAGAgentBuilder(BaseRAGAgentBuilder):
         embed_model: Optional[str] = None,
         llm: Optional[str] = None,
         additional_tools: Optional[List] = None,
+        compact_memory: Optional[bool] = None,
+        compress_docstore: Optional[bool] = None,
+        metadata_filtering: Optional[bool] = None,
+        reranker: Optional[str] = None,
+        rerank_fetch_k: Optional[int] = None,
+        adaptive_top_k: Optional[bool] = None,
+        min_top_k: Optional[int] = None,
+        max_top_k: Optional[int] = None,
+        context_packing: Optional[bool] = None,
+        context_token_budget: Optional[int] = None,
+        memory_window_tokens: Optional[int] = None,
+        speculative_retrieval: Optional[bool] = None,
     ) -> None:
         """Update agent.
 
-        Delete old agent by ID and create a new one.
+        Build a new agent, then replace the old agent by ID with it.
         Optionally update the system prompt and RAG parameters.
 
+        The old agent keeps serving until the new one is saved; if building
+        the new one fails, the old one (and its parameters) are kept.
+
         NOTE: Currently is manually called, not meant for agent use.
 
         """
-        self._agent_registry.delete_agent_cache(self.cache.agent_id)
-
-        # set agent id
-        self.cache.agent_id = agent_id
+        old_agent_id = self.cache.agent_id
+        old_params = (
+            self.cache.system_prompt,
+            self.cache.rag_params,
+            self.cache.tools,
+            self.cache.corpus_id,
+        )
 
         # set system prompt
         if system_prompt is not None:
@@ -239,6 +390,32 @@ class RAGAgentBuilder(BaseRAGAgentBuilder):
             rag_params_dict["embed_model"] = embed_model
         if llm is not None:
             rag_params_dict["llm"] = llm
+        if compact_memory is not None:
+            rag_params_dict["compact_memory"] = compact_memory
+        if compress_docstore is not None:
+            rag_params_dict["compress_docstore"] = compress_docstore
+        if metadata_filtering is not None:
+            rag_params_dict["metadata_filtering"] = metadata_filtering
+        if reranker is not None:
+            # empty string: no reranker
+            rag_params_dict["reranker"] = reranker or None
+        if rerank_fetch_k is not None:
+            rag_params_dict["rerank_fetch_k"] = rerank_fetch_k
+        if adaptive_top_k is not None:
+            rag_params_dict["adaptive_top_k"] = adaptive_top_k
+        if min_top_k is not None:
+            rag_params_dict["min_top_k"] = min_top_k
+        if max_top_k is not None:
+            rag_params_dict["max_top_k"] = max_top_k
+        if context_packing is not None:
+            rag_params_dict["context_packing"] = context_packing
+        if context_token_budget is not None:
+            rag_params_dict["context_token_budget"] = context_token_budget
+        if memory_window_tokens is not None:
+            # 0: the whole chat history is sent
+            rag_params_dict["memory_window_tokens"] = memory_window_tokens or None
+        if speculative_retrieval is not None:
+            rag_params_dict["speculative_retrieval"] = speculative_retrieval
 
         self.set_rag_params(**rag_params_dict)
 
@@ -247,4 +424,19 @@ class RAGAgentBuilder(BaseRAGAgentBuilder):
             self.cache.tools = additional_tools
 
         # this will update the agent in the cache
-        self.create_agent()
+        try:
+            self._build_agent(agent_id)
+        except Exception:
+            (
+                self.cache.system_prompt,
+                self.cache.rag_params,
+                self.cache.tools,
+                self.cache.corpus_id,
+            ) = old_params
+            raise
+        if old_agent_id in self._agent_registry.get_agent_ids():
+            self._agent_registry.replace_agent_cache(
+                old_agent_id, agent_id, self._cache
+            )
+        else:
+            self._agent_registry.add_new_agent_cache(agent_id, self._cache)
@@ -1,10 +1,21 @@
 """Loader agent."""
 
-from typing import List, cast, Optional
-from llama_index.core.tools import FunctionTool
+from typing import Any, Dict, List, cast, Optional
+from llama_index.core.tools import FunctionTool, ToolMetadata
 from llama_index.core.base.agent.types import BaseAgent
+from llama_index.core.chat_engine.types import (
+    AGENT_CHAT_RESPONSE_TYPE,
+    AgentChatResponse,
+    StreamingAgentChatResponse,
+)
+from llama_index.core.llms import ChatMessage
 from core.builder_config import BUILDER_LLM
-from typing import Tuple, Callable
+from typing import Tuple
+from functools import lru_cache
+from pathlib import Path
+from pydantic import BaseModel, Field
+import re
+import threading
 import streamlit as st
 
 from core.param_cache import ParamCache
@@ -14,6 +25,7 @@ from core.utils import (
 from core.agent_builder.registry import AgentCacheRegistry
 from core.agent_builder.base import RAGAgentBuilder, BaseRAGAgentBuilder
 from core.agent_builder.multimodal import MultimodalRAGAgentBuilder
+from core.offline import is_offline_mode
 
 ####################
 #### META Agent ####
@@ -43,47 +55,389 @@ have available (e.g. "Do you want to set the number of documents to retrieve?")
 # please make sure to update the LLM above if you change the function below
 
 
+# tool schemas only depend on the builder class and method, so they are
+# introspected once per process (not for every session / agent switch)
+_TOOL_METADATA: Dict[Tuple[type, str], ToolMetadata] = {}
+_TOOL_METADATA_LOCK = threading.Lock()
+
+
+def _get_fn_tools(
+    agent_builder: BaseRAGAgentBuilder, fn_names: List[str]
+) -> List[FunctionTool]:
+    """Get function tools over methods of the agent builder."""
+    fn_tools: List[FunctionTool] = []
+    for fn_name in fn_names:
+        fn = getattr(agent_builder, fn_name)
+        key = (type(agent_builder), fn_name)
+        with _TOOL_METADATA_LOCK:
+            if key not in _TOOL_METADATA:
+                _TOOL_METADATA[key] = FunctionTool.from_defaults(fn=fn).metadata
+            metadata = _TOOL_METADATA[key]
+        fn_tools.append(FunctionTool(fn=fn, metadata=metadata))
+    return fn_tools
+
+
+@lru_cache(maxsize=None)
+def _has_metaphor_key() -> bool:
+    """Whether the metaphor api key is set (secrets are read once per process)."""
+    # NOTE: no secrets (and no web search) in offline mode
+    return not is_offline_mode() and "metaphor_key" in st.secrets
+
+
 def _get_builder_agent_tools(agent_builder: RAGAgentBuilder) -> List[FunctionTool]:
     """Get list of builder agent tools to pass to the builder agent."""
     # see if metaphor api key is set, otherwise don't add web tool
     # TODO: refactor this later
-
-    if "metaphor_key" in st.secrets:
-        fns: List[Callable] = [
-            agent_builder.create_system_prompt,
-            agent_builder.load_data,
-            agent_builder.add_web_tool,
-            agent_builder.get_rag_params,
-            agent_builder.set_rag_params,
-            agent_builder.create_agent,
+    if _has_metaphor_key():
+        fn_names = [
+            "create_system_prompt",
+            "load_data",
+            "add_data",
+            "add_web_tool",
+            "get_rag_params",
+            "set_rag_params",
+            "create_agent",
         ]
     else:
-        fns = [
-            agent_builder.create_system_prompt,
-            agent_builder.load_data,
-            agent_builder.get_rag_params,
-            agent_builder.set_rag_params,
-            agent_builder.create_agent,
+        fn_names = [
+            "create_system_prompt",
+            "load_data",
+            "add_data",
+            "get_rag_params",
+            "set_rag_params",
+            "create_agent",
         ]
-
-    fn_tools: List[FunctionTool] = [FunctionTool.from_defaults(fn=fn) for fn in fns]
-    return fn_tools
+    return _get_fn_tools(agent_builder, fn_names)
 
 
 def _get_mm_builder_agent_tools(
     agent_builder: MultimodalRAGAgentBuilder,
 ) -> List[FunctionTool]:
     """Get list of builder agent tools to pass to the builder agent."""
-    fns: List[Callable] = [
-        agent_builder.create_system_prompt,
-        agent_builder.load_data,
-        agent_builder.get_rag_params,
-        agent_builder.set_rag_params,
-        agent_builder.create_agent,
+    fn_names = [
+        "create_system_prompt",
+        "load_data",
+        "get_rag_params",
+        "set_rag_params",
+        "create_agent",
     ]
+    return _get_fn_tools(agent_builder, fn_names)
 
-    fn_tools: List[FunctionTool] = [FunctionTool.from_defaults(fn=fn) for fn in fns]
-    return fn_tools
+
+##########################
+#### Template planner ####
+##########################
+
+# tasks that mention one of these (and no explicit data source) use the
+# bundled dataset
+TASK_DATASETS: Dict[str, str] = {
+    "book": "data/books.csv",
+    "movie": "data/movies",
+    "film": "data/movies",
+}
+# tasks that mention a file type (and no explicit data source) use the files
+# of that type in this directory, e.g. "search over my CSV documents"
+USER_DATA_DIR = "data"
+# file types that `SimpleDirectoryReader` can load
+DATA_FILE_EXTS = {
+    "csv",
+    "docx",
+    "epub",
+    "html",
+    "ipynb",
+    "json",
+    "md",
+    "pdf",
+    "pptx",
+    "txt",
+}
+
+URL_RE = re.compile(r"https?://[^\s)\]]+")
+PATH_RE = re.compile(r"[\w\-.~/]+")
+TOP_K_RES = [
+    re.compile(r"\btop[\s_-]?k\D{0,5}(\d+)", re.IGNORECASE),
+    re.compile(
+        r"\b(?:retrieve|fetch|return|get)\s+(\d+)\s+"
+        r"(?:docs|documents|chunks|results|passages|nodes)",
+        re.IGNORECASE,
+    ),
+]
+CHUNK_SIZE_RE = re.compile(r"\bchunk[\s_-]?size\D{0,5}(\d+)", re.IGNORECASE)
+SUMMARIZATION_RE = re.compile(r"\bsummar(?:y|ies|i[sz]e|i[sz]ation)", re.IGNORECASE)
+WEB_RE = re.compile(r"\b(?:web|internet|online|google)\b", re.IGNORECASE)
+# words introducing a data source, removed with it from the system prompt
+SOURCE_CONNECTORS = "and|or|in|from|over|of|on|at|with|using|about"
+SOURCE_MARKER = "\x00"
+# fallback description of the task if nothing but data sources / params is left
+DEFAULT_TASK_STR = "answer questions over the loaded data"
+
+TEMPLATE_SYS_PROMPT_STR = """\
+You are an assistant that helps the user with the following task: {task}
+
+ALWAYS use the tools given to answer the user. \
+NEVER give an answer without using a tool.
+"""
+
+
+class TaskPlan(BaseModel):
+    """Builder steps for a task, extracted without the LLM."""
+
+    system_prompt: str = Field(..., description="System prompt for the agent.")
+    file_names: List[str] = Field(default_factory=list, description="Files to load.")
+    directory: Optional[str] = Field(default=None, description="Directory to load.")
+    urls: List[str] = Field(default_factory=list, description="URLs to load.")
+    rag_params: Dict[str, Any] = Field(
+        default_factory=dict, description="RAG params to set."
+    )
+
+
+def _is_data_path(token: str) -> bool:
+    """Whether a token looks like a path to data (existing or not)."""
+    suffix = Path(token).suffix.lstrip(".").lower()
+    return suffix in DATA_FILE_EXTS or "/" in token
+
+
+def _mentions(task: str, word: str) -> bool:
+    return re.search(rf"\b{re.escape(word)}s?\b", task, re.IGNORECASE) is not None
+
+
+def _get_task_str(task: str) -> str:
+    """Task description for the system prompt, without data sources / params.
+
+    Data sources and RAG params are removed along with the words introducing
+    them (e.g. "from a.csv and b.csv"), so that no dangling words are left.
+
+    """
+    task_str = task
+    # RAG params are removed the same way, e.g. "with top k 3 and chunk size 256"
+    for param_re in [*TOP_K_RES, CHUNK_SIZE_RE]:
+        task_str = param_re.sub(SOURCE_MARKER, task_str)
+
+    def _sub_path(match: re.Match) -> str:
+        token = match.group(0)
+        path_str = token.rstrip(".,;:")
+        if not _is_data_path(path_str):
+            return token
+        return SOURCE_MARKER + token[len(path_str) :]
+
+    task_str = URL_RE.sub(SOURCE_MARKER, task_str)
+    task_str = PATH_RE.sub(_sub_path, task_str)
+    task_str = re.sub(rf"\(\s*{SOURCE_MARKER}\s*\)", SOURCE_MARKER, task_str)
+    # lists of sources, e.g. "a.csv, b.csv and c.csv"
+    task_str = re.sub(
+        rf"{SOURCE_MARKER}(?:[\s,]*(?:\b(?:and|or)\b)?[\s,]*{SOURCE_MARKER})+",
+        SOURCE_MARKER,
+        task_str,
+    )
+    task_str = re.sub(
+        rf"(?:\s*\b(?:{SOURCE_CONNECTORS})\b)*\s*{SOURCE_MARKER}",
+        "",
+        task_str,
+        flags=re.IGNORECASE,
+    )
+    task_str = re.sub(r"\(\s*\)", "", task_str)
+    task_str = re.sub(r"\s+([,.;:])", r"\1", task_str)
+    task_str = re.sub(r"[,;:]+(?=[,.;:])", "", task_str)
+    task_str = re.sub(r"\s+", " ", task_str).strip(" ,;:")
+    # e.g. "top k 5 of data/books.csv"
+    if not re.search(r"[^\W\d_]{3,}", task_str):
+        return DEFAULT_TASK_STR
+    return task_str
+
+
+def plan_task(task: str) -> Optional[TaskPlan]:
+    """Plan builder steps for a common task shape, with local parsing only.
+
+    Recognizes tasks with explicit data sources (file / directory paths or
+    URLs), that mention one of the bundled datasets, or that mention a file
+    type (the files of that type in `USER_DATA_DIR`), plus optional RAG
+    params (top k, chunk size, summarization).
+
+    Returns None if the task is ambiguous (no data source, several kinds of
+    sources, missing files, web search, ...), in which case the LLM builder
+    should handle it.
+
+    """
+    if WEB_RE.search(URL_RE.sub("", task)):
+        return None
+
+    urls = URL_RE.findall(task)
+    file_names: List[str] = []
+    directories: List[str] = []
+    for token in PATH_RE.findall(URL_RE.sub(" ", task)):
+        token = token.rstrip(".,;:")
+        if not _is_data_path(token):
+            continue
+        path = Path(token)
+        if path.is_file():
+            file_names.append(token)
+        elif path.is_dir():
+            directories.append(token.rstrip("/"))
+        else:
+            # user points to data we can't find, let the LLM ask about it
+            return None
+
+    if not (urls or file_names or directories):
+        datasets = {
+            dataset
+            for keyword, dataset in TASK_DATASETS.items()
+            if _mentions(task, keyword)
+        }
+        exts = {ext for ext in DATA_FILE_EXTS if _mentions(task, ext)}
+        if len(datasets) == 1 and not exts:
+            dataset = datasets.pop()
+            if not Path(dataset).exists():
+                return None
+            if Path(dataset).is_dir():
+                directories.append(dataset)
+            else:
+                file_names.append(dataset)
+        elif len(exts) == 1 and not datasets:
+            file_names = sorted(
+                str(path)
+                for path in Path(USER_DATA_DIR).rglob(f"*.{exts.pop()}")
+                if path.is_file()
+            )
+            if not file_names:
+                return None
+        else:
+            return None
+
+    # only one kind of data source (and one directory) can be loaded
+    if sum(1 for v in [urls, file_names, directories] if v) != 1:
+        return None
+    if len(directories) > 1:
+        return None
+
+    rag_params: Dict[str, Any] = {}
+    for top_k_re in TOP_K_RES:
+        match = top_k_re.search(task)
+        if match:
+            rag_params["top_k"] = int(match.group(1))
+            break
+    match = CHUNK_SIZE_RE.search(task)
+    if match:
+        rag_params["chunk_size"] = int(match.group(1))
+    if SUMMARIZATION_RE.search(task):
+        rag_params["include_summarization"] = True
+
+    return TaskPlan(
+        system_prompt=TEMPLATE_SYS_PROMPT_STR.format(task=_get_task_str(task)),
+        file_names=file_names,
+        directory=directories[0] if directories else None,
+        urls=urls,
+        rag_params=rag_params,
+    )
+
+
+def run_task_plan(plan: TaskPlan, agent_builder: RAGAgentBuilder) -> str:
+    """Run the builder steps of a plan, same as the builder agent would."""
+    agent_builder.cache.system_prompt = plan.system_prompt
+    agent_builder.load_data(
+        file_names=plan.file_names, directory=plan.directory, urls=plan.urls
+    )
+    agent_builder.set_rag_params(**plan.rag_params)
+    agent_builder.create_agent()
+
+    cache = agent_builder.cache
+    source = ", ".join(cache.file_names or cache.urls) or cache.directory
+    return (
+        f"I created agent {cache.agent_id} over {source} with these "
+        f"parameters: {cache.rag_params.dict()}.\n\n"
+        "You can go to the RAG Config page to view / change its parameters, "
+        "or the Generated RAG Agent page to start chatting with it. "
+        "Let me know if you want anything else!"
+    )
+
+
+class TemplateBuilderAgent(BaseAgent):
+    """Builder agent with a deterministic fast path for common tasks.
+
+    As long as nothing was set up yet (no agent, system prompt or data in
+    the cache, no builder conversation), a message that `plan_task`
+    recognizes runs the builder steps directly (no LLM calls). Anything else goes to the
+    LLM builder agent. Fast path turns are recorded in the LLM agent's memory,
+    so follow-up requests have the context.
+
+    """
+
+    def __init__(self, builder_agent: BaseAgent, agent_builder: RAGAgentBuilder):
+        """Init params."""
+        self._builder_agent = builder_agent
+        self._agent_builder = agent_builder
+        super().__init__(callback_manager=builder_agent.callback_manager)
+
+    def __getattr__(self, name: str) -> Any:
+        # expose attributes of the LLM builder agent (e.g. `memory`)
+        if name.startswith("__") or name == "_builder_agent":
+            raise AttributeError(name)
+        return getattr(self._builder_agent, name)
+
+    @property
+    def chat_history(self) -> List[ChatMessage]:
+        return self._builder_agent.chat_history
+
+    def reset(self) -> None:
+        self._builder_agent.reset()
+
+    def _is_untouched(self) -> bool:
+        """Whether nothing was set up yet, in the cache or the conversation."""
+        cache = self._agent_builder.cache
+        return (
+            cache.agent is None
+            and cache.system_prompt is None
+            and not (cache.file_names or cache.urls or cache.directory)
+            and not cache.docs
+            and not cache.tools
+            and not self._builder_agent.chat_history
+        )
+
+    def _run_fast_path(self, message: str) -> Optional[AgentChatResponse]:
+        if not self._is_untouched():
+            return None
+        plan = plan_task(message)
+        if plan is None:
+            return None
+        response = run_task_plan(plan, self._agent_builder)
+        memory = getattr(self._builder_agent, "memory", None)
+        if memory is not None:
+            memory.put(ChatMessage(role="user", content=message))
+            memory.put(ChatMessage(role="assistant", content=response))
+        return AgentChatResponse(response=response)
+
+    def chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> AGENT_CHAT_RESPONSE_TYPE:
+        """Main chat interface."""
+        if chat_history is None:
+            response = self._run_fast_path(message)
+            if response is not None:
+                return response
+        return self._builder_agent.chat(message, chat_history=chat_history)
+
+    async def achat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> AGENT_CHAT_RESPONSE_TYPE:
+        """Async version of main chat interface."""
+        if chat_history is None:
+            response = self._run_fast_path(message)
+            if response is not None:
+                return response
+        return await self._builder_agent.achat(message, chat_history=chat_history)
+
+    def stream_chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> StreamingAgentChatResponse:
+        """Stream chat interface."""
+        return self._builder_agent.stream_chat(message, chat_history=chat_history)
+
+    async def astream_chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> StreamingAgentChatResponse:
+        """Async version of stream chat interface."""
+        return await self._builder_agent.astream_chat(
+            message, chat_history=chat_history
+        )
 
 
 # define agent
@@ -91,8 +445,14 @@ def load_meta_agent_and_tools(
     cache: Optional[ParamCache] = None,
     agent_registry: Optional[AgentCacheRegistry] = None,
     is_multimodal: bool = False,
+    use_templates: bool = True,
 ) -> Tuple[BaseAgent, BaseRAGAgentBuilder]:
-    """Load meta agent and tools."""
+    """Load meta agent and tools.
+
+    If `use_templates` is set, common tasks are built without the LLM (see
+    `TemplateBuilderAgent`).
+
+    """
 
     if is_multimodal:
         agent_builder: BaseRAGAgentBuilder = MultimodalRAGAgentBuilder(
@@ -111,5 +471,7 @@ def load_meta_agent_and_tools(
         builder_agent = load_meta_agent(
             fn_tools, llm=BUILDER_LLM, system_prompt=RAG_BUILDER_SYS_STR, verbose=True
         )
+        if use_templates:
+            builder_agent = TemplateBuilderAgent(builder_agent, agent_builder)
 
     return builder_agent, agent_builder
@@ -13,6 +13,7 @@ from core.utils import (
     construct_mm_agent,
 )
 from core.agent_builder.registry import AgentCacheRegistry
+from core.llm_scheduler import Priority, llm_request_context
 from core.agent_builder.base import GEN_SYS_PROMPT_TMPL, BaseRAGAgentBuilder
 
 from llama_index.core.chat_engine.types import BaseChatEngine
@@ -182,15 +183,23 @@ class MultimodalRAGAgentBuilder(BaseRAGAgentBuilder):
         functions should have already been called to set up the agent.
 
         """
+        agent_id = self._build_agent(agent_id)
+        # save the cache to disk
+        self._agent_registry.add_new_agent_cache(agent_id, self._cache)
+        return "Agent created successfully."
+
+    def _build_agent(self, agent_id: Optional[str] = None) -> str:
+        """Build the agent into the cache (not saved). Returns the agent id."""
         if self._cache.system_prompt is None:
             raise ValueError("Must set system prompt before creating agent.")
 
         # construct additional tools
-        agent, extra_info = construct_mm_agent(
-            cast(str, self._cache.system_prompt),
-            cast(RAGParams, self._cache.rag_params),
-            self._cache.docs,
-        )
+        with llm_request_context(priority=Priority.BACKGROUND):
+            agent, extra_info = construct_mm_agent(
+                cast(str, self._cache.system_prompt),
+                cast(RAGParams, self._cache.rag_params),
+                self._cache.docs,
+            )
 
         # if agent_id not specified, randomly generate one
         agent_id = agent_id or self._cache.agent_id or f"Agent_{str(uuid.uuid4())}"
@@ -198,10 +207,7 @@ class MultimodalRAGAgentBuilder(BaseRAGAgentBuilder):
         self._cache.vector_index = extra_info["vector_index"]
         self._cache.agent_id = agent_id
         self._cache.agent = agent
-
-        # save the cache to disk
-        self._agent_registry.add_new_agent_cache(agent_id, self._cache)
-        return "Agent created successfully."
+        return agent_id
 
     def update_agent(
         self,
@@ -216,16 +222,17 @@ class MultimodalRAGAgentBuilder(BaseRAGAgentBuilder):
     ) -> None:
         """Update agent.
 
-        Delete old agent by ID and create a new one.
+        Build a new agent, then replace the old agent by ID with it.
         Optionally update the system prompt and RAG parameters.
 
+        The old agent keeps serving until the new one is saved; if building
+        the new one fails, the old one (and its parameters) are kept.
+
         NOTE: Currently is manually called, not meant for agent use.
 
         """
-        self._agent_registry.delete_agent_cache(self.cache.agent_id)
-
-        # set agent id
-        self.cache.agent_id = agent_id
+        old_agent_id = self.cache.agent_id
+        old_params = (self.cache.system_prompt, self.cache.rag_params, self.cache.tools)
 
         # set system prompt
         if system_prompt is not None:
@@ -253,4 +260,16 @@ class MultimodalRAGAgentBuilder(BaseRAGAgentBuilder):
             self.cache.tools = additional_tools
 
         # this will update the agent in the cache
-        self.create_agent()
+        try:
+            self._build_agent(agent_id)
+        except Exception:
+            self.cache.system_prompt, self.cache.rag_params, self.cache.tools = (
+                old_params
+            )
+            raise
+        if old_agent_id in self._agent_registry.get_agent_ids():
+            self._agent_registry.replace_agent_cache(
+                old_agent_id, agent_id, self._cache
+            )
+        else:
+            self._agent_registry.add_new_agent_cache(agent_id, self._cache)
@@ -1,78 +1,263 @@
 """Agent builder registry."""
 
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 from typing import Union
 from pathlib import Path
 import json
-import shutil
+import logging
+import os
+import threading
+import time
 
+from core.atomic_io import (
+    ORPHAN_GRACE_PERIOD,
+    FileLock,
+    cleanup_staging,
+    is_older_than,
+    remove_dir,
+    write_json_atomic,
+)
+from core.corpus_store import CORPORA_DIR_NAME, CorpusStore, get_corpus_store
 from core.param_cache import ParamCache
 
+logger = logging.getLogger(__name__)
+
+
+# a cache being replaced is briefly missing, loads retry this many times
+LOAD_RETRIES = 20
+LOAD_RETRY_INTERVAL = 0.05
+
+# one lock per registry directory, shared by all registry instances
+_REGISTRY_LOCKS: Dict[str, FileLock] = {}
+_REGISTRY_LOCKS_LOCK = threading.Lock()
+# writes of agent ids by this process, per registry directory
+_REGISTRY_GENERATIONS: Dict[str, int] = {}
+# agent ids per registry directory, with the version they were read at
+_AGENT_IDS_CACHE: Dict[str, Tuple[Tuple[int, ...], List[str]]] = {}
+# registry directories cleaned up by this process
+_CLEANED_UP_DIRS: Set[str] = set()
+
+
+def _get_registry_lock(dir: Union[str, Path]) -> FileLock:
+    """Get lock for a registry directory (also locks out other processes)."""
+    key = str(Path(dir).resolve())
+    with _REGISTRY_LOCKS_LOCK:
+        if key not in _REGISTRY_LOCKS:
+            _REGISTRY_LOCKS[key] = FileLock(Path(key) / ".agent_ids.json.lock")
+        return _REGISTRY_LOCKS[key]
+
 
 class AgentCacheRegistry:
     """Registry for agent caches, in disk.
 
     Can register new agent caches, load agent caches, delete agent caches, etc.
 
+    Thread / process-safe: updates of `agent_ids.json` (and the agent caches
+    they publish) are serialized per directory with a lock file, and written
+    atomically (temp file + rename), so agents can be registered from several
+    threads or processes (app, server, CLIs) without losing ids.
+
+    Agents built over the same data / chunking / embedding params share a
+    corpus (see `core.corpus_store`), reference-counted by agent id.
+
+    Crash-safe: agent caches are written to a staging directory and moved in
+    place (see `core.atomic_io`) before they're published in `agent_ids.json`,
+    so registered agents are always complete. What interrupted writes leave
+    behind is cleaned up the first time a process opens the registry.
+
     """
 
     def __init__(self, dir: Union[str, Path]) -> None:
         """Init params."""
         self._dir = dir
+        self._key = str(Path(dir).resolve())
+        self._lock = _get_registry_lock(dir)
+        self._corpus_store = get_corpus_store(Path(dir) / CORPORA_DIR_NAME)
+        with _REGISTRY_LOCKS_LOCK:
+            is_cleaned_up = self._key in _CLEANED_UP_DIRS
+            _CLEANED_UP_DIRS.add(self._key)
+        if not is_cleaned_up:
+            cleaned = self.cleanup_orphans()
+            if cleaned:
+                logger.warning("Cleaned up %s in %s", cleaned, self._dir)
+
+    @property
+    def corpus_store(self) -> CorpusStore:
+        """Corpus store of the registry."""
+        return self._corpus_store
+
+    def _write_agent_ids(self, agent_ids: List[str]) -> None:
+        """Atomically write agent ids."""
+        write_json_atomic(Path(self._dir) / "agent_ids.json", {"agent_ids": agent_ids})
+        _REGISTRY_GENERATIONS[self._key] = _REGISTRY_GENERATIONS.get(self._key, 0) + 1
 
     def _add_agent_id_to_directory(self, agent_id: str) -> None:
         """Save agent id to directory."""
-        full_path = Path(self._dir) / "agent_ids.json"
-        if not full_path.exists():
-            with open(full_path, "w") as f:
-                json.dump({"agent_ids": [agent_id]}, f)
-        else:
-            with open(full_path, "r") as f:
-                agent_ids = json.load(f)["agent_ids"]
+        with self._lock:
+            agent_ids = self.get_agent_ids()
             if agent_id in agent_ids:
                 raise ValueError(f"Agent id {agent_id} already exists.")
-            agent_ids_set = set(agent_ids)
-            agent_ids_set.add(agent_id)
-            with open(full_path, "w") as f:
-                json.dump({"agent_ids": list(agent_ids_set)}, f)
+            self._write_agent_ids(agent_ids + [agent_id])
+
+    def _get_corpus_id(self, agent_id: str) -> Optional[str]:
+        """Get corpus id of a saved agent cache, if any."""
+        cache_json_path = Path(self._dir) / agent_id / "cache.json"
+        if not cache_json_path.exists():
+            return None
+        with open(cache_json_path, "r") as f:
+            return json.load(f).get("corpus_id")
 
     def add_new_agent_cache(self, agent_id: str, cache: ParamCache) -> None:
         """Register agent."""
-        # save the cache to disk
-        agent_cache_path = f"{self._dir}/{agent_id}"
-        cache.save_to_disk(agent_cache_path)
-        # save to agent ids
-        self._add_agent_id_to_directory(agent_id)
+        # under the lock from check to registration, so that concurrent builds
+        # of the same id can't overwrite each other's cache
+        with self._lock:
+            # check first, don't overwrite the cache of an existing agent
+            if agent_id in self.get_agent_ids():
+                raise ValueError(f"Agent id {agent_id} already exists.")
+            # save the cache to disk (replaces what a failed attempt left, if any)
+            agent_cache_path = f"{self._dir}/{agent_id}"
+            cache.save_to_disk(agent_cache_path)
+            if cache.corpus_id is not None:
+                self._corpus_store.add_ref(cache.corpus_id, agent_id)
+            # save to agent ids (the agent is only visible once this is done)
+            self._add_agent_id_to_directory(agent_id)
+
+    def save_agent_cache(self, agent_id: str, cache: ParamCache) -> None:
+        """Save the cache of a registered agent (e.g. after adding data)."""
+        self.replace_agent_cache(agent_id, agent_id, cache)
+
+    def replace_agent_cache(
+        self, old_agent_id: str, agent_id: str, cache: ParamCache
+    ) -> None:
+        """Replace a registered agent with a new one (possibly with the same id).
+
+        The old agent stays registered (and loadable) until the new one is
+        saved, then the new one takes its place in the agent ids.
+
+        """
+        with self._lock:
+            agent_ids = self.get_agent_ids()
+            if old_agent_id not in agent_ids:
+                raise ValueError(f"Agent id {old_agent_id} does not exist.")
+            if agent_id != old_agent_id and agent_id in agent_ids:
+                raise ValueError(f"Agent id {agent_id} already exists.")
+            old_corpus_id = self._get_corpus_id(old_agent_id)
+            cache.save_to_disk(f"{self._dir}/{agent_id}")
+            if cache.corpus_id is not None:
+                self._corpus_store.add_ref(cache.corpus_id, agent_id)
+            if agent_id != old_agent_id:
+                self._write_agent_ids(
+                    [agent_id if id == old_agent_id else id for id in agent_ids]
+                )
+                remove_dir(Path(self._dir) / old_agent_id)
+            # release the old corpus (after referencing the new one, may be the
+            # same)
+            is_same_ref = (old_corpus_id, old_agent_id) == (cache.corpus_id, agent_id)
+            if old_corpus_id is not None and not is_same_ref:
+                self._corpus_store.remove_ref(old_corpus_id, old_agent_id)
+
+    def get_version(self) -> Tuple[int, ...]:
+        """Get version of the agent ids, changes whenever agents are added / removed.
+
+        Cheap (a stat, no read), so that sessions can compare it with the
+        version of the agent ids they have and only reload them on changes.
+        Agent ids are written atomically (to a new file), so the file identity
+        changes with every write, also by other processes; writes by this
+        process also bump a generation number.
+
+        """
+        try:
+            stat = os.stat(Path(self._dir) / "agent_ids.json")
+        except FileNotFoundError:
+            file_version: Tuple[int, ...] = (0, 0, 0)
+        else:
+            file_version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        return (_REGISTRY_GENERATIONS.get(self._key, 0), *file_version)
 
     def get_agent_ids(self) -> List[str]:
-        """Get agent ids."""
+        """Get agent ids (only read from disk if they changed)."""
+        # version first: if ids change in between, they are read again next time
+        version = self.get_version()
+        cached = _AGENT_IDS_CACHE.get(self._key)
+        if cached is not None and cached[0] == version:
+            return list(cached[1])
+
         full_path = Path(self._dir) / "agent_ids.json"
         if not full_path.exists():
             return []
         with open(full_path, "r") as f:
             agent_ids = json.load(f)["agent_ids"]
 
-        return agent_ids
+        _AGENT_IDS_CACHE[self._key] = (version, agent_ids)
+        return list(agent_ids)
 
     def get_agent_cache(self, agent_id: str) -> ParamCache:
-        """Get agent cache."""
+        """Get agent cache.
+
+        While a cache is replaced (see `replace_agent_cache`), its directory
+        is briefly missing: loads of registered agents retry on a miss.
+
+        """
         full_path = Path(self._dir) / f"{agent_id}"
-        if not full_path.exists():
-            raise ValueError(f"Cache for agent {agent_id} does not exist.")
-        cache = ParamCache.load_from_disk(str(full_path))
-        return cache
+        for attempt in range(LOAD_RETRIES):
+            try:
+                return ParamCache.load_from_disk(
+                    str(full_path), corpus_store=self._corpus_store
+                )
+            except FileNotFoundError:
+                is_last_attempt = attempt == LOAD_RETRIES - 1
+                if is_last_attempt or agent_id not in self.get_agent_ids():
+                    break
+                time.sleep(LOAD_RETRY_INTERVAL)
+        raise ValueError(f"Cache for agent {agent_id} does not exist.")
 
     def delete_agent_cache(self, agent_id: str) -> None:
         """Delete agent cache."""
-        # modify / resave agent_ids
-        agent_ids = self.get_agent_ids()
-        new_agent_ids = [id for id in agent_ids if id != agent_id]
-        full_path = Path(self._dir) / "agent_ids.json"
-        with open(full_path, "w") as f:
-            json.dump({"agent_ids": new_agent_ids}, f)
+        with self._lock:
+            # modify / resave agent_ids
+            agent_ids = self.get_agent_ids()
+            new_agent_ids = [id for id in agent_ids if id != agent_id]
+            self._write_agent_ids(new_agent_ids)
 
-        # remove agent cache
-        full_path = Path(self._dir) / f"{agent_id}"
-        if full_path.exists():
-            # recursive delete
-            shutil.rmtree(full_path)
+            # remove agent cache (and release its corpus)
+            corpus_id = self._get_corpus_id(agent_id)
+            if corpus_id is not None:
+                self._corpus_store.remove_ref(corpus_id, agent_id)
+            remove_dir(Path(self._dir) / f"{agent_id}")
+
+    def cleanup_orphans(self, grace_period: float = ORPHAN_GRACE_PERIOD) -> List[str]:
+        """Delete what interrupted writes left behind.
+
+        That is, staging directories and agent caches that were saved but
+        never registered (and corpora no agent references, see
+        `CorpusStore.cleanup_orphans`). Only those older than `grace_period`
+        are deleted, others may be writes in progress. Returns the names of
+        the deleted paths.
+
+        """
+        if not Path(self._dir).is_dir():
+            return []
+        # caches are saved and registered under the lock: unregistered caches
+        # seen under it aren't being registered
+        with self._lock:
+            cleaned = [path.name for path in cleanup_staging(self._dir, grace_period)]
+            if not (Path(self._dir) / "agent_ids.json").exists():
+                # no agent was ever registered: not a registry we wrote, keep it
+                return cleaned
+            agent_ids = set(self.get_agent_ids())
+            for path in Path(self._dir).iterdir():
+                if (
+                    not path.is_dir()
+                    or path.name.startswith(".")
+                    or path.name == CORPORA_DIR_NAME
+                    or path.name in agent_ids
+                    or not is_older_than(path, grace_period)
+                ):
+                    continue
+                corpus_id = self._get_corpus_id(path.name)
+                if corpus_id is not None:
+                    self._corpus_store.remove_ref(corpus_id, path.name)
+                remove_dir(path)
+                cleaned.append(path.name)
+        return cleaned + self._corpus_store.cleanup_orphans(grace_period)
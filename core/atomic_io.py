@@ -0,0 +1,245 @@
+"""Crash-safe persistence of files and directories.
+
+Files and directories are written to a staging path next to their final path
+(`.<name>.<random>.staging`), fsynced, then renamed into place, so readers
+(also in other processes) see either the previous or the new version, never a
+partial one.
+
+A directory can't be atomically renamed over a non-empty one, so replacing
+one takes two renames: the previous version is moved aside
+(`.<name>.<random>.trash`) first, and deleted once the new one is in place.
+
+A crash leaves at most staging / trash paths behind: `cleanup_staging` deletes
+them (and restores moved aside directories whose replacement never landed)
+once they are older than a grace period, so that writes in progress in other
+processes are left alone.
+
+Read-modify-writes of files shared by processes (e.g. the agent ids of a
+registry) are serialized with a `FileLock`.
+
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Any, Iterator, List, Optional, Union
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+STAGING_SUFFIX = ".staging"
+TRASH_SUFFIX = ".trash"
+# leftovers younger than this may belong to a write in progress
+ORPHAN_GRACE_PERIOD = 3600.0
+
+
+class FileLock:
+    """Lock shared by the threads of this process and by other processes.
+
+    Reentrant. Other processes are locked out with `flock` on the lock file
+    (on platforms without `fcntl`, e.g. Windows, only threads are).
+
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        """Init params."""
+        self._path = Path(path)
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file: Optional[IO] = None
+
+    def acquire(self) -> None:
+        self._thread_lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            try:
+                self._path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = open(self._path, "a")
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            except BaseException:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+
+    def release(self) -> None:
+        self._depth -= 1
+        if self._depth == 0 and self._file is not None:
+            # closing the file releases the lock
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.release()
+
+
+def fsync_path(path: Union[str, Path]) -> None:
+    """Flush a file, or the entries of a directory, to disk."""
+    is_dir = Path(path).is_dir()
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # directories can't be opened on Windows (renames are durable there)
+        if is_dir:
+            return
+        raise
+    try:
+        os.fsync(fd)
+    except OSError:
+        # some file systems don't support flushing directories
+        if not is_dir:
+            raise
+    finally:
+        os.close(fd)
+
+
+def fsync_tree(path: Union[str, Path]) -> None:
+    """Flush all files and directories under path to disk."""
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            fsync_path(Path(dir_path) / file_name)
+        fsync_path(dir_path)
+
+
+def _get_temp_path(path: Path, suffix: str, is_dir: bool) -> Path:
+    """Unique temp path next to path (same file system, so renames are atomic)."""
+    prefix = f".{path.name}."
+    if is_dir:
+        return Path(tempfile.mkdtemp(dir=path.parent, prefix=prefix, suffix=suffix))
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=prefix, suffix=suffix)
+    os.close(fd)
+    return Path(temp_path)
+
+
+def _remove(path: Path) -> None:
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def write_json_atomic(path: Union[str, Path], data: Any) -> None:
+    """Write JSON to path atomically (staging file in the same dir + rename)."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = _get_temp_path(path, STAGING_SUFFIX, is_dir=False)
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    fsync_path(path.parent)
+
+
+@contextmanager
+def staged_dir(path: Union[str, Path], overwrite: bool = True) -> Iterator[Path]:
+    """Write a directory in a staging directory, then move it to path.
+
+    Yields the staging directory. If the block raises, path is left untouched.
+    Without overwrite, raises `FileExistsError` if path exists (also if it was
+    created by someone else in the meantime).
+
+    NOTE: when replacing, path doesn't exist between the two renames, readers
+    missing it should retry (see `AgentCacheRegistry.get_agent_cache`).
+
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if not overwrite and path.exists():
+        raise FileExistsError(f"{path} already exists.")
+    staging_path = _get_temp_path(path, STAGING_SUFFIX, is_dir=True)
+    trash_path = None
+    try:
+        yield staging_path
+        fsync_tree(staging_path)
+        if path.exists():
+            if not overwrite:
+                raise FileExistsError(f"{path} already exists.")
+            trash_path = _get_temp_path(path, TRASH_SUFFIX, is_dir=True)
+            os.replace(path, trash_path)
+        try:
+            os.rename(staging_path, path)
+        except OSError:
+            if trash_path is not None and not path.exists():
+                os.rename(trash_path, path)
+                trash_path = None
+            if path.exists():
+                # created by someone else since the check
+                raise FileExistsError(f"{path} already exists.")
+            raise
+        fsync_path(path.parent)
+    finally:
+        _remove(staging_path)
+        if trash_path is not None:
+            _remove(trash_path)
+
+
+def remove_dir(path: Union[str, Path]) -> None:
+    """Delete a directory, atomically: it's renamed away first."""
+    path = Path(path)
+    if not path.exists():
+        return
+    garbage_path = _get_temp_path(path, STAGING_SUFFIX, is_dir=True)
+    os.replace(path, garbage_path)
+    fsync_path(path.parent)
+    _remove(garbage_path)
+
+
+def is_older_than(path: Union[str, Path], secs: float) -> bool:
+    """Whether path was last modified more than secs ago."""
+    try:
+        return time.time() - Path(path).stat().st_mtime > secs
+    except FileNotFoundError:
+        return False
+
+
+def cleanup_staging(
+    dir: Union[str, Path], grace_period: float = ORPHAN_GRACE_PERIOD
+) -> List[Path]:
+    """Delete staging / trash paths left in dir by interrupted writes.
+
+    A directory moved aside whose replacement never landed is restored
+    instead. Returns the paths deleted or restored.
+
+    """
+    dir = Path(dir)
+    if not dir.is_dir():
+        return []
+    cleaned = []
+    for path in dir.iterdir():
+        is_staging = path.name.endswith(STAGING_SUFFIX)
+        is_trash = path.name.endswith(TRASH_SUFFIX)
+        if not path.name.startswith(".") or not (is_staging or is_trash):
+            continue
+        if not is_older_than(path, grace_period):
+            continue
+        # `.<name>.<random><suffix>`, random has no dots
+        name = path.name[1:].rsplit(".", 2)[0]
+        if is_trash and not (dir / name).exists():
+            logger.warning("Restoring %s, its replacement was not written", name)
+            os.rename(path, dir / name)
+        else:
+            logger.warning("Deleting %s, left by an interrupted write", path)
+            _remove(path)
+        cleaned.append(path)
+    return cleaned
@@ -5,16 +5,33 @@ import os
 ### DEFINE BUILDER_LLM #####
 ## Uncomment the LLM you want to use to construct the meta agent
 
-## OpenAI
-from llama_index.llms.openai import OpenAI
+## Offline stand-in (no network / keys, for benchmarking): set RAGS_OFFLINE=1
+from core.offline import OfflineLLM, is_offline_mode
 
-# set OpenAI Key - use Streamlit secrets
-os.environ["OPENAI_API_KEY"] = st.secrets.openai_key
-# load LLM
-BUILDER_LLM = OpenAI(model="gpt-4o")
+if is_offline_mode():
+    BUILDER_LLM = OfflineLLM()
+else:
+    ## OpenAI
+    from llama_index.llms.openai import OpenAI
+
+    # set OpenAI Key - use Streamlit secrets
+    os.environ["OPENAI_API_KEY"] = st.secrets.openai_key
+    # load LLM
+    BUILDER_LLM = OpenAI(model="gpt-4o")
 
 # # Anthropic (make sure you `pip install anthropic`)
 # from llama_index.llms.anthropic import Anthropic
 # # set Anthropic key
 # os.environ["ANTHROPIC_API_KEY"] = st.secrets.anthropic_key
 # BUILDER_LLM = Anthropic()
+
+### LLM RATE LIMITS #####
+## Every LLM / embedding call in the process goes through a shared scheduler
+## (see core/llm_scheduler.py). Keys are "<provider>:<model>", "<model>" or "*".
+from core.llm_scheduler import RateLimit, get_llm_scheduler, install_llm_scheduler
+
+LLM_RATE_LIMITS = {
+    # "gpt-4o": RateLimit(requests_per_minute=500, tokens_per_minute=30_000),
+    # "text-embedding-ada-002": RateLimit(requests_per_minute=3_000),
+}
+install_llm_scheduler(get_llm_scheduler(limits=LLM_RATE_LIMITS))
@@ -1,12 +1,28 @@
 """Streaming callback manager."""
 from llama_index.core.callbacks.base_handler import BaseCallbackHandler
-from llama_index.core.callbacks.schema import CBEventType
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+from llama_index.core.utils import get_tokenizer
 
-from typing import Optional, Dict, Any, List, Callable
+from typing import Optional, Dict, Any, List, Callable, Deque
+from collections import defaultdict, deque
+from contextvars import ContextVar
+from pathlib import Path
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from core.constants import METRICS_DIR, METRICS_EXPORT_ENV_VAR
+from core.llm_scheduler import get_request_context
 
 STORAGE_DIR = "./storage"  # directory to cache the generated index
 DATA_DIR = "./data"  # directory containing the documents to index
 
+logger = logging.getLogger(__name__)
+
 
 class StreamlitFunctionsCallbackHandler(BaseCallbackHandler):
     """Callback handler that outputs streamlit components given events."""
@@ -68,3 +84,352 @@ class StreamlitFunctionsCallbackHandler(BaseCallbackHandler):
     ) -> None:
         """Run when an overall trace is exited."""
         pass
+
+
+def _count_tokens(text: str) -> int:
+    """Count tokens with the default (cached) tokenizer."""
+    return len(get_tokenizer()(text))
+
+
+def _get_llm_token_counts(
+    start_payload: Dict[str, Any], end_payload: Dict[str, Any]
+) -> Dict[str, int]:
+    """Get prompt / completion token counts of an LLM event.
+
+    Uses the usage reported by the provider if available, otherwise counts
+    tokens of the prompt / messages and the response.
+
+    """
+    response = end_payload.get(EventPayload.RESPONSE) or end_payload.get(
+        EventPayload.COMPLETION
+    )
+    raw = getattr(response, "raw", None)
+    usage = raw.get("usage") if isinstance(raw, dict) else getattr(raw, "usage", None)
+    if usage is not None:
+        if isinstance(usage, dict):
+            get = usage.get
+        else:
+            get = lambda k: getattr(usage, k, None)  # noqa: E731
+        if get("prompt_tokens") is not None:
+            return {
+                "prompt_tokens": int(get("prompt_tokens") or 0),
+                "completion_tokens": int(get("completion_tokens") or 0),
+            }
+
+    if EventPayload.MESSAGES in start_payload:
+        messages = start_payload[EventPayload.MESSAGES]
+        prompt = "\n".join(str(message.content or "") for message in messages)
+    else:
+        prompt = str(start_payload.get(EventPayload.PROMPT, ""))
+    if response is None:
+        completion = ""
+    elif hasattr(response, "message"):
+        completion = str(response.message.content or "")
+    else:
+        completion = str(getattr(response, "text", response))
+    return {
+        "prompt_tokens": _count_tokens(prompt),
+        "completion_tokens": _count_tokens(completion),
+    }
+
+
+class _Trace:
+    """Spans recorded for one top-level trace (e.g. one chat turn)."""
+
+    def __init__(self, trace_id: str) -> None:
+        """Init params."""
+        self.trace_id = trace_id
+        self.session_id = get_request_context().session_id
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.spans: Dict[str, Dict[str, Any]] = {}
+        # start payloads, needed to count tokens at the end of LLM events
+        self.start_payloads: Dict[str, Dict[str, Any]] = {}
+
+
+_current_trace: ContextVar[Optional[_Trace]] = ContextVar(
+    "metrics_current_trace", default=None
+)
+
+
+class TraceExporter:
+    """Appends trace records to a JSONL file, from a background thread.
+
+    The file is rotated once it would exceed `max_bytes` (`traces.jsonl.1`,
+    ... up to `backup_count` old files are kept). If the writer falls behind
+    by more than `max_queued` records, new records are dropped rather than
+    slowing down requests.
+
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 3,
+        max_queued: int = 1000,
+    ) -> None:
+        """Init params."""
+        self._path = Path(path)
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(
+            maxsize=max_queued
+        )
+        self.num_dropped = 0
+        self._thread = threading.Thread(
+            target=self._run, name="metrics-exporter", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def export(self, record: Dict[str, Any]) -> None:
+        """Queue a record to be written (never blocks)."""
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.num_dropped += 1
+
+    def flush(self) -> None:
+        """Wait until queued records are written."""
+        self._queue.join()
+
+    def close(self) -> None:
+        """Write queued records and stop the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _get_backup_path(self, i: int) -> Path:
+        return self._path.with_name(f"{self._path.name}.{i}")
+
+    def _rotate(self) -> None:
+        if self._backup_count == 0:
+            self._path.unlink()
+            return
+        for i in range(self._backup_count - 1, 0, -1):
+            if self._get_backup_path(i).exists():
+                os.replace(self._get_backup_path(i), self._get_backup_path(i + 1))
+        os.replace(self._path, self._get_backup_path(1))
+
+    def _write(self, records: List[Dict[str, Any]]) -> None:
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        size = self._path.stat().st_size if self._path.exists() else 0
+        f = open(self._path, "a")
+        try:
+            for record in records:
+                line = json.dumps(record, default=str) + "\n"
+                if size and size + len(line) > self._max_bytes:
+                    f.close()
+                    self._rotate()
+                    f = open(self._path, "a")
+                    size = 0
+                f.write(line)
+                size += len(line)
+        finally:
+            f.close()
+
+    def _run(self) -> None:
+        while True:
+            records = [self._queue.get()]
+            # write what's queued in one go
+            while not self._queue.empty():
+                records.append(self._queue.get_nowait())
+            stop = None in records
+            try:
+                self._write([record for record in records if record is not None])
+            except Exception:
+                logger.exception("Failed to export %d metrics traces", len(records))
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+            if stop:
+                return
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Callback handler that records per-stage latency and token counts.
+
+    Every top-level trace (a chat turn, a query, an index build) becomes a
+    record with one span per event (retrieval, embedding, LLM call, function
+    call, chunking, ...) linked to its parent, with timings relative to the
+    start of the trace. Records are kept in memory (see `get_latest_trace`,
+    `get_summary`) and optionally appended to a JSONL file, off the request
+    thread (see `TraceExporter`).
+
+    """
+
+    def __init__(
+        self, export_path: Optional[str] = None, max_traces: int = 100
+    ) -> None:
+        """Init params."""
+        self._exporter = TraceExporter(export_path) if export_path else None
+        self._traces: Deque[Dict[str, Any]] = deque(maxlen=max_traces)
+        self._lock = threading.Lock()
+        # event type -> aggregated stats over all traces
+        self._summary: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: {"count": 0, "total_ms": 0.0, "max_ms": 0.0}
+        )
+        super().__init__([], [])
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        """Run when an event starts and return id of event."""
+        trace = _current_trace.get()
+        if trace is None:
+            return event_id
+        payload = payload or {}
+        span: Dict[str, Any] = {
+            "id": event_id,
+            "parent_id": parent_id,
+            "type": event_type.value,
+            "start_ms": (time.perf_counter() - trace.start) * 1000,
+            "end_ms": None,
+        }
+        if event_type == CBEventType.FUNCTION_CALL and EventPayload.TOOL in payload:
+            span["tool"] = payload[EventPayload.TOOL].name
+        if EventPayload.TOP_K in payload:
+            span["top_k"] = payload[EventPayload.TOP_K]
+        trace.spans[event_id] = span
+        if event_type == CBEventType.LLM:
+            trace.start_payloads[event_id] = payload
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        """Run when an event ends."""
+        trace = _current_trace.get()
+        if trace is None or event_id not in trace.spans:
+            return
+        payload = payload or {}
+        span = trace.spans[event_id]
+        span["end_ms"] = (time.perf_counter() - trace.start) * 1000
+        if event_type == CBEventType.LLM:
+            span.update(
+                _get_llm_token_counts(trace.start_payloads.pop(event_id, {}), payload)
+            )
+        elif event_type in (CBEventType.CHUNKING, CBEventType.EMBEDDING):
+            span["num_chunks"] = len(payload.get(EventPayload.CHUNKS, []))
+        elif EventPayload.NODES in payload:
+            span["num_nodes"] = len(payload[EventPayload.NODES])
+        if EventPayload.TOP_K in payload:
+            span["top_k"] = payload[EventPayload.TOP_K]
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        """Run when an overall trace is launched."""
+        _current_trace.set(_Trace(trace_id or "trace"))
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        """Run when an overall trace is exited."""
+        trace = _current_trace.get()
+        if trace is None:
+            return
+        _current_trace.set(None)
+
+        duration_ms = (time.perf_counter() - trace.start) * 1000
+        spans = list(trace.spans.values())
+        for span in spans:
+            # events that never ended (e.g. errors) end with the trace
+            if span["end_ms"] is None:
+                span["end_ms"] = duration_ms
+            span["duration_ms"] = span["end_ms"] - span["start_ms"]
+
+        totals: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: {"count": 0, "total_ms": 0.0}
+        )
+        for span in spans:
+            totals[span["type"]]["count"] += 1
+            totals[span["type"]]["total_ms"] += span["duration_ms"]
+        record = {
+            "trace_id": trace.trace_id,
+            "session_id": trace.session_id,
+            "start_time": trace.start_time,
+            "duration_ms": duration_ms,
+            "prompt_tokens": sum(s.get("prompt_tokens", 0) for s in spans),
+            "completion_tokens": sum(s.get("completion_tokens", 0) for s in spans),
+            "totals": dict(totals),
+            "spans": spans,
+        }
+
+        with self._lock:
+            self._traces.append(record)
+            for span in spans:
+                stats = self._summary[span["type"]]
+                stats["count"] += 1
+                stats["total_ms"] += span["duration_ms"]
+                stats["max_ms"] = max(stats["max_ms"], span["duration_ms"])
+        if self._exporter is not None:
+            self._exporter.export(record)
+
+    def get_traces(self) -> List[Dict[str, Any]]:
+        """Get recent trace records (oldest first)."""
+        with self._lock:
+            return list(self._traces)
+
+    def get_latest_trace(
+        self, session_id: Optional[str] = None, trace_id: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Get latest trace record, optionally of a given session / trace type."""
+        with self._lock:
+            for record in reversed(self._traces):
+                if session_id is not None and record["session_id"] != session_id:
+                    continue
+                if trace_id is not None and record["trace_id"] != trace_id:
+                    continue
+                return record
+        return None
+
+    def get_summary(self) -> Dict[str, Dict[str, float]]:
+        """Get per event type latency stats over all traces."""
+        with self._lock:
+            return {
+                event_type: {
+                    **stats,
+                    "avg_ms": (
+                        stats["total_ms"] / stats["count"] if stats["count"] else 0.0
+                    ),
+                }
+                for event_type, stats in self._summary.items()
+            }
+
+
+# process-wide handler, attached by default to the agents we build
+_METRICS_HANDLER: Optional[MetricsCallbackHandler] = None
+_METRICS_HANDLER_LOCK = threading.Lock()
+
+
+def _get_export_path() -> Optional[str]:
+    value = os.environ.get(METRICS_EXPORT_ENV_VAR, "")
+    if value.lower() in ("", "0", "false", "no"):
+        return None
+    if value.lower() in ("1", "true", "yes"):
+        return str(METRICS_DIR / "traces.jsonl")
+    return value
+
+
+def get_metrics_handler() -> MetricsCallbackHandler:
+    """Get process-wide metrics handler.
+
+    Traces are only exported to a file if METRICS_EXPORT_ENV_VAR is set.
+
+    """
+    global _METRICS_HANDLER
+    with _METRICS_HANDLER_LOCK:
+        if _METRICS_HANDLER is None:
+            _METRICS_HANDLER = MetricsCallbackHandler(export_path=_get_export_path())
+        return _METRICS_HANDLER
@@ -0,0 +1,343 @@
+"""Memory-compact agent storage.
+
+- `DocumentRef`: lightweight reference to a loaded document (source, position
+  in the source, text hash), used instead of the document once it's indexed.
+  `rehydrate_docs` loads the documents back from disk when needed (e.g. to
+  build a summary index).
+- `CompressedDocumentStore`: docstore keeping node JSON zlib-compressed in
+  memory, persisted gzip-compressed (`docstore.json.gz`).
+- `get_memory_report`: approximate memory used by an agent's docs / index.
+
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import zlib
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import fsspec
+from llama_index.core import (
+    Document,
+    SimpleDirectoryReader,
+    StorageContext,
+    VectorStoreIndex,
+    load_index_from_storage,
+)
+from llama_index.core.indices.base import BaseIndex
+from llama_index.core.storage.docstore.simple_docstore import SimpleDocumentStore
+from llama_index.core.storage.kvstore.simple_kvstore import SimpleKVStore
+from llama_index.core.storage.kvstore.types import DEFAULT_COLLECTION
+from llama_index.core.vector_stores.types import BasePydanticVectorStore
+from pydantic import BaseModel, Field
+
+from core.metadata_index import (
+    METADATA_INDEX_FNAME,
+    MetadataIndex,
+    get_metadata_index,
+    set_metadata_index,
+)
+from core.vector_stores import (
+    QuantizedVectorStore,
+    ShardedVectorStore,
+    load_vector_stores,
+)
+
+logger = logging.getLogger(__name__)
+
+COMPRESSED_DOCSTORE_FNAME = "docstore.json.gz"
+
+
+def get_text_hash(text: str) -> str:
+    """Hash of document text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class DocumentRef(BaseModel):
+    """Reference to a document loaded from a file."""
+
+    doc_id: str = Field(..., description="Id of the document when it was loaded.")
+    source: str = Field(..., description="File path the document was loaded from.")
+    index: int = Field(
+        ..., description="Position of the document in the documents of the file."
+    )
+    text_hash: str = Field(..., description="Hash of the document text.")
+    num_chars: int = Field(..., description="Length of the document text.")
+
+
+DocOrRef = Union[Document, DocumentRef]
+
+
+def make_doc_refs(docs: Sequence[DocOrRef]) -> List[DocOrRef]:
+    """Replace documents by references where possible.
+
+    Only documents loaded from files (with a `file_path` in their metadata) can
+    be rehydrated, others (e.g. web pages) are kept as is.
+
+    """
+    doc_refs: List[DocOrRef] = []
+    num_per_source: Dict[str, int] = defaultdict(int)
+    for doc in docs:
+        if isinstance(doc, DocumentRef):
+            num_per_source[doc.source] = max(num_per_source[doc.source], doc.index + 1)
+            doc_refs.append(doc)
+            continue
+        source = doc.metadata.get("file_path")
+        if source is None:
+            doc_refs.append(doc)
+            continue
+        doc_refs.append(
+            DocumentRef(
+                doc_id=doc.doc_id,
+                source=source,
+                index=num_per_source[source],
+                text_hash=get_text_hash(doc.text),
+                num_chars=len(doc.text),
+            )
+        )
+        num_per_source[source] += 1
+    return doc_refs
+
+
+def rehydrate_docs(docs: Sequence[DocOrRef]) -> List[Document]:
+    """Get documents, loading referenced documents from disk.
+
+    Each source file is read once. If a file changed since it was indexed, the
+    current content is used (and a warning logged).
+
+    """
+    if not any(isinstance(doc, DocumentRef) for doc in docs):
+        return list(docs)  # type: ignore
+
+    sources = {doc.source for doc in docs if isinstance(doc, DocumentRef)}
+    loaded: Dict[str, List[Document]] = {
+        source: SimpleDirectoryReader(input_files=[source]).load_data()
+        for source in sources
+    }
+    rehydrated: List[Document] = []
+    for doc in docs:
+        if not isinstance(doc, DocumentRef):
+            rehydrated.append(doc)
+            continue
+        source_docs = loaded[doc.source]
+        if doc.index >= len(source_docs):
+            logger.warning("Document %s no longer in %s", doc.doc_id, doc.source)
+            continue
+        source_doc = source_docs[doc.index]
+        if get_text_hash(source_doc.text) != doc.text_hash:
+            logger.warning("%s changed since it was indexed", doc.source)
+        source_doc.id_ = doc.doc_id
+        rehydrated.append(source_doc)
+    return rehydrated
+
+
+class CompressedKVStore(SimpleKVStore):
+    """In-memory key-value store keeping values zlib-compressed.
+
+    Node JSON compresses well, and only the retrieved nodes are decompressed
+    per query.
+
+    """
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        """Put a key-value pair into the store."""
+        if collection not in self._data:
+            self._data[collection] = {}
+        self._data[collection][key] = zlib.compress(  # type: ignore
+            json.dumps(val).encode("utf-8")
+        )
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        """Get a value from the store."""
+        val = self._data.get(collection, {}).get(key)
+        if val is None:
+            return None
+        return json.loads(zlib.decompress(val))  # type: ignore
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        """Get all values from the store."""
+        return {
+            key: json.loads(zlib.decompress(val))  # type: ignore
+            for key, val in self._data.get(collection, {}).items()
+        }
+
+    def get_size(self) -> int:
+        """Size of the compressed values, in bytes."""
+        return sum(
+            len(val)  # type: ignore
+            for collection_data in self._data.values()
+            for val in collection_data.values()
+        )
+
+    def to_dict(self) -> dict:
+        """Save the store as (uncompressed) dict."""
+        return {collection: self.get_all(collection) for collection in self._data}
+
+    @classmethod
+    def from_dict(cls, save_dict: dict) -> "CompressedKVStore":
+        """Load a CompressedKVStore from (uncompressed) dict."""
+        kvstore = cls()
+        for collection, collection_data in save_dict.items():
+            for key, val in collection_data.items():
+                kvstore.put(key, val, collection=collection)
+        return kvstore
+
+    def persist(
+        self, persist_path: str, fs: Optional[fsspec.AbstractFileSystem] = None
+    ) -> None:
+        """Persist the store, gzip-compressed."""
+        fs = fs or fsspec.filesystem("file")
+        dirpath = os.path.dirname(persist_path)
+        if not fs.exists(dirpath):
+            fs.makedirs(dirpath)
+        with fs.open(persist_path, "wb") as f:
+            f.write(gzip.compress(json.dumps(self.to_dict()).encode("utf-8")))
+
+    @classmethod
+    def from_persist_path(
+        cls, persist_path: str, fs: Optional[fsspec.AbstractFileSystem] = None
+    ) -> "CompressedKVStore":
+        """Load a CompressedKVStore from a persist path and filesystem."""
+        fs = fs or fsspec.filesystem("file")
+        with fs.open(persist_path, "rb") as f:
+            data = json.loads(gzip.decompress(f.read()))
+        return cls.from_dict(data)
+
+
+class CompressedDocumentStore(SimpleDocumentStore):
+    """Simple document store on top of a `CompressedKVStore`."""
+
+    def __init__(
+        self,
+        simple_kvstore: Optional[SimpleKVStore] = None,
+        namespace: Optional[str] = None,
+        **kwargs: Any,
+    ) -> None:
+        """Init params."""
+        super().__init__(
+            simple_kvstore or CompressedKVStore(), namespace=namespace, **kwargs
+        )
+
+    @classmethod
+    def from_persist_path(
+        cls,
+        persist_path: str,
+        namespace: Optional[str] = None,
+        fs: Optional[fsspec.AbstractFileSystem] = None,
+    ) -> "CompressedDocumentStore":
+        """Create a CompressedDocumentStore from a persist path."""
+        return cls(CompressedKVStore.from_persist_path(persist_path, fs=fs), namespace)
+
+
+def get_storage_context(
+    compress_docstore: bool = False,
+    vector_store: Optional[BasePydanticVectorStore] = None,
+) -> StorageContext:
+    """Get storage context for a new index."""
+    return StorageContext.from_defaults(
+        docstore=CompressedDocumentStore() if compress_docstore else None,
+        vector_store=vector_store,
+    )
+
+
+def persist_storage(index: VectorStoreIndex, persist_dir: Union[str, Path]) -> None:
+    """Persist storage of index (compressed docstore as `docstore.json.gz`).
+
+    The metadata index of the index, if any, is persisted with it.
+
+    """
+    storage_context = index.storage_context
+    if isinstance(storage_context.docstore, CompressedDocumentStore):
+        storage_context.persist(
+            persist_dir, docstore_fname=COMPRESSED_DOCSTORE_FNAME
+        )
+    else:
+        storage_context.persist(persist_dir)
+    metadata_index = get_metadata_index(index)
+    if metadata_index is not None:
+        metadata_index.persist(Path(persist_dir) / METADATA_INDEX_FNAME)
+
+
+def load_storage_context(persist_dir: Union[str, Path]) -> StorageContext:
+    """Load storage context persisted with `persist_storage`."""
+    compressed_path = Path(persist_dir) / COMPRESSED_DOCSTORE_FNAME
+    docstore = None
+    if compressed_path.exists():
+        docstore = CompressedDocumentStore.from_persist_path(str(compressed_path))
+    return StorageContext.from_defaults(
+        persist_dir=str(persist_dir),
+        docstore=docstore,
+        vector_stores=load_vector_stores(persist_dir),
+    )
+
+
+def load_index(persist_dir: Union[str, Path], **kwargs: Any) -> BaseIndex:
+    """Load index persisted with `persist_storage` (and its metadata index).
+
+    kwargs are passed to `load_index_from_storage` (e.g. `embed_model`).
+
+    """
+    index = load_index_from_storage(load_storage_context(persist_dir), **kwargs)
+    metadata_index_path = Path(persist_dir) / METADATA_INDEX_FNAME
+    if isinstance(index, VectorStoreIndex) and metadata_index_path.exists():
+        set_metadata_index(index, MetadataIndex.from_persist_path(metadata_index_path))
+    return index
+
+
+def copy_index(index: VectorStoreIndex, **kwargs: Any) -> BaseIndex:
+    """Private copy of index, through its persisted storage (see `load_index`).
+
+    For indexes that may be shared (loaded caches, corpora) and are about to be
+    modified.
+
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        persist_storage(index, tmp_dir)
+        return load_index(tmp_dir, **kwargs)
+
+
+def get_memory_report(
+    docs: Sequence[DocOrRef], vector_index: Optional[VectorStoreIndex]
+) -> Dict[str, Any]:
+    """Approximate memory used by an agent's documents and index.
+
+    Text sizes are in characters / bytes of the stored representation; the
+    embedding size of a `SimpleVectorStore` assumes Python float lists (~32
+    bytes per value).
+
+    """
+    doc_refs = [doc for doc in docs if isinstance(doc, DocumentRef)]
+    loaded_docs = [doc for doc in docs if not isinstance(doc, DocumentRef)]
+    report: Dict[str, Any] = {
+        "num_docs": len(loaded_docs),
+        "num_doc_refs": len(doc_refs),
+        "docs_chars": sum(len(doc.text) for doc in loaded_docs),
+        "doc_refs_saved_chars": sum(doc.num_chars for doc in doc_refs),
+    }
+    if vector_index is None:
+        return report
+
+    docstore = vector_index.docstore
+    kvstore = getattr(docstore, "_kvstore", None)
+    node_dicts = docstore.docs
+    report["num_nodes"] = len(node_dicts)
+    report["nodes_chars"] = sum(
+        len(node.get_content()) for node in node_dicts.values()
+    )
+    if isinstance(kvstore, CompressedKVStore):
+        report["docstore_compressed_bytes"] = kvstore.get_size()
+    vector_store = vector_index.vector_store
+    if isinstance(vector_store, (QuantizedVectorStore, ShardedVectorStore)):
+        report["num_embeddings"] = vector_store.num_vectors
+        report["embeddings_bytes_approx"] = vector_store.nbytes
+        return report
+    embedding_dict = getattr(getattr(vector_store, "data", None), "embedding_dict", {})
+    num_values = sum(len(embedding) for embedding in embedding_dict.values())
+    report["num_embeddings"] = len(embedding_dict)
+    report["embeddings_bytes_approx"] = num_values * 32
+    return report
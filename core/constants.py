@@ -2,3 +2,6 @@ from pathlib import Path
 
 AGENT_CACHE_DIR = Path(__file__).parent.parent / "cache" / "agents"
 MESSAGES_CACHE_DIR = Path(__file__).parent.parent / "cache" / "messages"
+METRICS_DIR = Path(__file__).parent.parent / "cache" / "metrics"
+# set to export metrics traces to JSONL: "1" for METRICS_DIR/traces.jsonl, or a path
+METRICS_EXPORT_ENV_VAR = "RAGS_METRICS_EXPORT"
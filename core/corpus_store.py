@@ -0,0 +1,404 @@
+"""Shared corpus store.
+
+A corpus is a vector index over a set of data sources, built with given
+chunking / embedding params. Agents built over the same sources with the same
+params reference one corpus instead of owning a copy of the index:
+
+- on disk, under `<registry dir>/_corpora/<corpus_id>`
+- in memory, one (read-only) index and one list of documents per process
+
+Corpora are content-addressed: the corpus id is a hash of the source contents,
+the chunk size and the embedding model. References are counted per agent id,
+a corpus is deleted when its last agent is deleted.
+
+"""
+
+import hashlib
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from llama_index.core import Document, VectorStoreIndex
+from llama_index.core.base.embeddings.base import BaseEmbedding
+
+from core.atomic_io import (
+    ORPHAN_GRACE_PERIOD,
+    FileLock,
+    cleanup_staging,
+    is_older_than,
+    remove_dir,
+    staged_dir,
+    write_json_atomic,
+)
+from core.compact import DocOrRef, load_index, persist_storage
+from core.utils import (
+    RAGParams,
+    _resolve_embed_model,
+    build_vector_index,
+    insert_docs,
+    load_data_sources,
+)
+
+logger = logging.getLogger(__name__)
+
+# corpora of a registry live in this subdirectory of the registry directory
+CORPORA_DIR_NAME = "_corpora"
+
+
+def get_source_fingerprint(
+    file_names: Optional[List[str]] = None,
+    directory: Optional[str] = None,
+    urls: Optional[List[str]] = None,
+) -> str:
+    """Get fingerprint of the contents of data sources.
+
+    Files (and files in directory, non-recursive like `load_data`) are hashed
+    by content. URLs can't be hashed without fetching them, so only the URLs
+    themselves are.
+
+    """
+    hasher = hashlib.sha256()
+    paths: List[Path] = [Path(file_name) for file_name in file_names or []]
+    if directory:
+        paths.extend(
+            path
+            for path in Path(directory).iterdir()
+            if path.is_file() and not path.name.startswith(".")
+        )
+    for path in sorted(paths, key=lambda p: p.name):
+        hasher.update(f"file:{path.name}\n".encode("utf-8"))
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(block)
+    for url in sorted(urls or []):
+        hasher.update(f"url:{url}\n".encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def get_corpus_id(
+    source_fingerprint: str, rag_params: RAGParams, embed_model: BaseEmbedding
+) -> str:
+    """Get corpus id for sources indexed with the chunking / embedding params."""
+    key_dict: Dict[str, Any] = {
+        "sources": source_fingerprint,
+        "chunk_size": rag_params.chunk_size,
+        "embed_model": f"{type(embed_model).__name__}:{embed_model.model_name}",
+    }
+    # only set when non-default, to keep the ids of existing corpora
+    if rag_params.embedding_precision != "float32":
+        key_dict["embedding_precision"] = rag_params.embedding_precision
+    if rag_params.embedding_dim is not None:
+        key_dict["embedding_dim"] = rag_params.embedding_dim
+    if rag_params.full_precision_rerank:
+        key_dict["full_precision_rerank"] = True
+    if rag_params.metadata_filtering:
+        key_dict["metadata_filtering"] = True
+    if rag_params.index_type != "flat":
+        key_dict["index_type"] = rag_params.index_type
+        key_dict["pq_subvector_dim"] = rag_params.pq_subvector_dim
+        key_dict["pq_num_centroids"] = rag_params.pq_num_centroids
+    if rag_params.shard_by is not None:
+        key_dict["shard_by"] = rag_params.shard_by
+        if rag_params.shard_by == "hash":
+            key_dict["num_shards"] = rag_params.num_shards
+    key_str = json.dumps(key_dict, sort_keys=True)
+    return f"Corpus_{hashlib.sha256(key_str.encode('utf-8')).hexdigest()[:24]}"
+
+
+class CorpusStore:
+    """Content-addressed, reference-counted store of corpora.
+
+    Use `get_corpus_store` to get the (process-wide) store of a directory, so
+    that indexes are shared in memory across sessions.
+
+    """
+
+    def __init__(self, dir: Union[str, Path]) -> None:
+        """Init params."""
+        self._dir = Path(dir)
+        self._lock = threading.RLock()
+        # refs are shared with other processes using the store
+        self._refs_lock = FileLock(self._dir / ".refs.json.lock")
+        # per-corpus locks, so that a corpus is only built once
+        self._corpus_locks: Dict[str, threading.Lock] = {}
+        self._indexes: Dict[str, VectorStoreIndex] = {}
+        self._docs: Dict[str, List[Document]] = {}
+        # corpus.json of the loaded corpora, to store them again if deleted
+        self._corpus_dicts: Dict[str, Dict] = {}
+
+    @property
+    def dir(self) -> Path:
+        """Store directory."""
+        return self._dir
+
+    def _get_corpus_lock(self, corpus_id: str) -> threading.Lock:
+        with self._lock:
+            if corpus_id not in self._corpus_locks:
+                self._corpus_locks[corpus_id] = threading.Lock()
+            return self._corpus_locks[corpus_id]
+
+    def _get_corpus_dir(self, corpus_id: str) -> Path:
+        return self._dir / corpus_id
+
+    def exists(self, corpus_id: str) -> bool:
+        """Whether corpus is in the store."""
+        return (self._get_corpus_dir(corpus_id) / "corpus.json").exists()
+
+    def get_or_build(
+        self,
+        docs: List[DocOrRef],
+        rag_params: RAGParams,
+        file_names: Optional[List[str]] = None,
+        directory: Optional[str] = None,
+        urls: Optional[List[str]] = None,
+    ) -> Tuple[str, VectorStoreIndex]:
+        """Get the corpus for docs loaded from the sources, build it if needed.
+
+        Returns corpus id and index.
+
+        """
+        embed_model = _resolve_embed_model(rag_params.embed_model)
+        fingerprint = get_source_fingerprint(file_names, directory, urls)
+        corpus_id = get_corpus_id(fingerprint, rag_params, embed_model)
+        with self._get_corpus_lock(corpus_id):
+            index = self._get_loaded_index(corpus_id)
+            if index is not None:
+                return corpus_id, index
+            if self.exists(corpus_id):
+                return corpus_id, self._load_index(corpus_id, rag_params.embed_model)
+
+            index = build_vector_index(docs, rag_params, embed_model=embed_model)
+            self._persist(
+                corpus_id,
+                index,
+                {
+                    "corpus_id": corpus_id,
+                    "source_fingerprint": fingerprint,
+                    "file_names": file_names or [],
+                    "directory": directory,
+                    "urls": urls or [],
+                    "chunk_size": rag_params.chunk_size,
+                    "embed_model": rag_params.embed_model,
+                },
+            )
+            self._indexes[corpus_id] = index
+            return corpus_id, index
+
+    def extend(
+        self,
+        corpus_id: str,
+        new_docs: List[Document],
+        rag_params: RAGParams,
+        file_names: Optional[List[str]] = None,
+        directory: Optional[str] = None,
+        urls: Optional[List[str]] = None,
+    ) -> Tuple[str, VectorStoreIndex]:
+        """Get the corpus of an existing corpus plus new docs.
+
+        Corpora are shared, so they're never modified: this is copy-on-write.
+        The new corpus starts from a copy of the stored one, and only new_docs
+        are chunked and embedded. The sources are those of the new corpus (old
+        and new ones).
+
+        NOTE: only the embedding work is incremental. The stored corpus is
+        loaded and written again as a whole (its storage files are single
+        JSON files), so extending costs as much memory and disk I/O as the
+        full corpus, and both versions stay on disk while referenced.
+
+        Returns corpus id and index of the new corpus.
+
+        """
+        embed_model = _resolve_embed_model(rag_params.embed_model)
+        fingerprint = get_source_fingerprint(file_names, directory, urls)
+        new_corpus_id = get_corpus_id(fingerprint, rag_params, embed_model)
+        with self._get_corpus_lock(new_corpus_id):
+            index = self._get_loaded_index(new_corpus_id)
+            if index is not None:
+                return new_corpus_id, index
+            if self.exists(new_corpus_id):
+                return new_corpus_id, self._load_index(
+                    new_corpus_id, rag_params.embed_model
+                )
+            if not self.exists(corpus_id):
+                raise ValueError(f"Corpus {corpus_id} does not exist.")
+
+            # private copy of the stored corpus, the shared one stays as is
+            index = load_index(
+                self._get_corpus_dir(corpus_id) / "storage", embed_model=embed_model
+            )
+            assert isinstance(index, VectorStoreIndex)
+            insert_docs(index, new_docs, rag_params)
+            self._persist(
+                new_corpus_id,
+                index,
+                {
+                    "corpus_id": new_corpus_id,
+                    "source_fingerprint": fingerprint,
+                    "file_names": file_names or [],
+                    "directory": directory,
+                    "urls": urls or [],
+                    "chunk_size": rag_params.chunk_size,
+                    "embed_model": rag_params.embed_model,
+                },
+            )
+            self._indexes[new_corpus_id] = index
+            if corpus_id in self._docs:
+                self._docs[new_corpus_id] = self._docs[corpus_id] + new_docs
+            return new_corpus_id, index
+
+    def _persist(
+        self, corpus_id: str, index: VectorStoreIndex, corpus_dict: Dict
+    ) -> None:
+        """Persist corpus to a staging dir, then move it in place."""
+        self._corpus_dicts[corpus_id] = corpus_dict
+        try:
+            with staged_dir(
+                self._get_corpus_dir(corpus_id), overwrite=False
+            ) as staging_dir:
+                persist_storage(index, staging_dir / "storage")
+                with open(staging_dir / "corpus.json", "w") as f:
+                    json.dump(corpus_dict, f)
+        except FileExistsError:
+            # another process stored the same corpus first, keep theirs
+            pass
+
+    def _get_loaded_index(self, corpus_id: str) -> Optional[VectorStoreIndex]:
+        """Index of a corpus loaded in this process, None if not loaded.
+
+        The corpus is stored again if it was deleted since, e.g. once its last
+        reference was removed by another process.
+
+        """
+        index = self._indexes.get(corpus_id)
+        if index is not None and not self.exists(corpus_id):
+            logger.warning("Corpus %s was deleted, storing it again", corpus_id)
+            self._persist(corpus_id, index, self._corpus_dicts[corpus_id])
+        return index
+
+    def _load_index(self, corpus_id: str, embed_model: str) -> VectorStoreIndex:
+        with open(self._get_corpus_dir(corpus_id) / "corpus.json") as f:
+            self._corpus_dicts[corpus_id] = json.load(f)
+        index = load_index(
+            self._get_corpus_dir(corpus_id) / "storage",
+            embed_model=_resolve_embed_model(embed_model),
+        )
+        assert isinstance(index, VectorStoreIndex)
+        self._indexes[corpus_id] = index
+        return index
+
+    def get_index(self, corpus_id: str, embed_model: str) -> VectorStoreIndex:
+        """Get index of a stored corpus (loaded once per process)."""
+        with self._get_corpus_lock(corpus_id):
+            index = self._get_loaded_index(corpus_id)
+            if index is not None:
+                return index
+            if not self.exists(corpus_id):
+                raise ValueError(f"Corpus {corpus_id} does not exist.")
+            return self._load_index(corpus_id, embed_model)
+
+    def get_docs(
+        self, corpus_id: str, load_fn: Callable[[], List[Document]]
+    ) -> List[Document]:
+        """Get documents of a corpus (loaded once per process with load_fn)."""
+        with self._get_corpus_lock(corpus_id):
+            if corpus_id not in self._docs:
+                self._docs[corpus_id] = load_fn()
+            return self._docs[corpus_id]
+
+    def load_docs(self, corpus_id: str) -> List[Document]:
+        """Get documents of a stored corpus, loaded from its sources."""
+        with open(self._get_corpus_dir(corpus_id) / "corpus.json") as f:
+            corpus_dict = json.load(f)
+        return self.get_docs(
+            corpus_id,
+            lambda: load_data_sources(
+                file_names=corpus_dict["file_names"],
+                directory=corpus_dict["directory"],
+                urls=corpus_dict["urls"],
+            ),
+        )
+
+    ### reference counting ###
+
+    def _get_refs(self) -> Dict[str, List[str]]:
+        refs_path = self._dir / "refs.json"
+        if not refs_path.exists():
+            return {}
+        with open(refs_path) as f:
+            return json.load(f)["refs"]
+
+    def get_refs(self, corpus_id: str) -> List[str]:
+        """Get ids of the agents referencing a corpus."""
+        with self._refs_lock:
+            return self._get_refs().get(corpus_id, [])
+
+    def add_ref(self, corpus_id: str, agent_id: str) -> None:
+        """Add reference from agent to corpus.
+
+        A corpus deleted since it was built / loaded (its last reference was
+        removed meanwhile) is stored again, raises `ValueError` if it can't be.
+
+        """
+        with self._refs_lock:
+            if not self.exists(corpus_id):
+                with self._get_corpus_lock(corpus_id):
+                    if self._get_loaded_index(corpus_id) is None:
+                        raise ValueError(f"Corpus {corpus_id} does not exist.")
+            refs = self._get_refs()
+            agent_ids = refs.setdefault(corpus_id, [])
+            if agent_id not in agent_ids:
+                agent_ids.append(agent_id)
+            write_json_atomic(self._dir / "refs.json", {"refs": refs})
+
+    def remove_ref(self, corpus_id: str, agent_id: str) -> None:
+        """Remove reference from agent to corpus, delete corpus if unreferenced."""
+        with self._refs_lock:
+            refs = self._get_refs()
+            agent_ids = [id for id in refs.get(corpus_id, []) if id != agent_id]
+            if agent_ids:
+                refs[corpus_id] = agent_ids
+            else:
+                refs.pop(corpus_id, None)
+                # agents that are still loaded keep their reference to the index
+                self._indexes.pop(corpus_id, None)
+                self._docs.pop(corpus_id, None)
+                self._corpus_dicts.pop(corpus_id, None)
+                remove_dir(self._get_corpus_dir(corpus_id))
+            write_json_atomic(self._dir / "refs.json", {"refs": refs})
+
+    def cleanup_orphans(self, grace_period: float = ORPHAN_GRACE_PERIOD) -> List[str]:
+        """Delete leftovers of interrupted writes, and unreferenced corpora.
+
+        Corpora are referenced once the agent built over them is registered,
+        so only those older than `grace_period` are deleted. Returns the names
+        of the deleted paths.
+
+        """
+        cleaned = [path.name for path in cleanup_staging(self._dir, grace_period)]
+        with self._refs_lock:
+            refs = self._get_refs()
+            for path in self._dir.glob("Corpus_*"):
+                if path.name in refs or not is_older_than(path, grace_period):
+                    continue
+                self._indexes.pop(path.name, None)
+                self._docs.pop(path.name, None)
+                self._corpus_dicts.pop(path.name, None)
+                remove_dir(path)
+                cleaned.append(path.name)
+        return cleaned
+
+
+# process-wide stores, by directory
+_CORPUS_STORES: Dict[str, CorpusStore] = {}
+_CORPUS_STORES_LOCK = threading.Lock()
+
+
+def get_corpus_store(dir: Union[str, Path]) -> CorpusStore:
+    """Get process-wide corpus store for a directory."""
+    key = str(Path(dir).resolve())
+    with _CORPUS_STORES_LOCK:
+        if key not in _CORPUS_STORES:
+            _CORPUS_STORES[key] = CorpusStore(dir)
+        return _CORPUS_STORES[key]
@@ -0,0 +1,528 @@
+"""Process-wide LLM / embedding rate limiter and fair scheduler.
+
+Every LLM and embedding call made through LlamaIndex emits instrumentation
+events before it hits the provider. We hook into the root dispatcher and block
+the calling thread until the call is allowed to go through, so no call site
+needs to be changed.
+
+Calls made from an event loop thread (async LLM / embedding calls) can't be
+blocked without freezing the loop: they go through right away, in debt if
+over the limits. Async entry points wait for capacity beforehand instead,
+with `await_capacity`, which later calls repay the debt to.
+
+- Limits are token buckets on requests/min and tokens/min per provider/model.
+- Waiting calls are granted in priority order (interactive chat before
+  background index builds) and round-robin across sessions within a priority.
+- Queue-wait time is recorded per provider/model.
+
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Any, Callable, Deque, Dict, Generator, List, Optional, Tuple
+
+from pydantic import BaseModel, Field
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events import BaseEvent
+from llama_index.core.instrumentation.events.embedding import (
+    EmbeddingEndEvent,
+    EmbeddingStartEvent,
+)
+from llama_index.core.instrumentation.events.llm import (
+    LLMChatEndEvent,
+    LLMChatStartEvent,
+    LLMCompletionEndEvent,
+    LLMCompletionStartEvent,
+)
+
+
+class Priority(IntEnum):
+    """Scheduling priority (lower value is served first)."""
+
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class RateLimit(BaseModel):
+    """Rate limit for a provider/model. `None` means unlimited."""
+
+    requests_per_minute: Optional[float] = Field(
+        default=None, description="Max number of requests per minute."
+    )
+    tokens_per_minute: Optional[float] = Field(
+        default=None,
+        description="Max number of (prompt + completion) tokens per minute.",
+    )
+
+
+class RequestContext(BaseModel):
+    """Who is making the current LLM calls."""
+
+    session_id: str = Field(default="default", description="Session id.")
+    priority: Priority = Field(
+        default=Priority.INTERACTIVE, description="Scheduling priority."
+    )
+
+
+_request_context: ContextVar[RequestContext] = ContextVar(
+    "llm_request_context", default=RequestContext()
+)
+
+
+def get_request_context() -> RequestContext:
+    """Get request context of the current thread / task."""
+    return _request_context.get()
+
+
+@contextmanager
+def llm_request_context(
+    session_id: Optional[str] = None, priority: Optional[Priority] = None
+) -> Generator[RequestContext, None, None]:
+    """Tag the LLM calls made within the block with a session and priority.
+
+    Unset values are inherited from the enclosing context.
+
+    """
+    cur_context = _request_context.get()
+    new_context = RequestContext(
+        session_id=session_id if session_id is not None else cur_context.session_id,
+        priority=priority if priority is not None else cur_context.priority,
+    )
+    token = _request_context.set(new_context)
+    try:
+        yield new_context
+    finally:
+        _request_context.reset(token)
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `per_minute / 60` per second.
+
+    The bucket may go negative when usage is reported after the fact (e.g. the
+    actual number of tokens a completion used); later calls then wait longer.
+
+    """
+
+    def __init__(self, per_minute: float, now: float) -> None:
+        """Init params."""
+        self.capacity = float(per_minute)
+        self.refill_per_sec = float(per_minute) / 60.0
+        self.level = self.capacity
+        self._last = now
+
+    def _refill(self, now: float) -> None:
+        elapsed = max(now - self._last, 0.0)
+        self.level = min(self.capacity, self.level + elapsed * self.refill_per_sec)
+        self._last = now
+
+    def _needed(self, amount: float) -> float:
+        # requests bigger than the whole bucket go through once it is full
+        return min(amount, self.capacity)
+
+    def can_consume(self, amount: float, now: float) -> bool:
+        self._refill(now)
+        return self.level >= self._needed(amount)
+
+    def consume(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.level -= amount
+
+    def time_until(self, amount: float, now: float) -> float:
+        """Seconds until `amount` can be consumed."""
+        self._refill(now)
+        missing = self._needed(amount) - self.level
+        if missing <= 0:
+            return 0.0
+        return missing / self.refill_per_sec
+
+
+class _Waiter:
+    """A call waiting for capacity."""
+
+    def __init__(
+        self, seq: int, session_id: str, priority: Priority, tokens: float
+    ) -> None:
+        """Init params."""
+        self.seq = seq
+        self.session_id = session_id
+        self.priority = priority
+        self.tokens = tokens
+
+
+class _ModelState:
+    """Buckets, wait queue and stats for one provider/model."""
+
+    def __init__(self, limit: RateLimit, now: float, max_samples: int) -> None:
+        """Init params."""
+        self.request_bucket = (
+            TokenBucket(limit.requests_per_minute, now)
+            if limit.requests_per_minute
+            else None
+        )
+        self.token_bucket = (
+            TokenBucket(limit.tokens_per_minute, now)
+            if limit.tokens_per_minute
+            else None
+        )
+        self.waiters: List[_Waiter] = []
+        # session id -> grant sequence number of its last granted call
+        self.last_served: Dict[str, int] = {}
+        self.num_requests = 0
+        self.num_tokens = 0.0
+        self.waits: Deque[float] = deque(maxlen=max_samples)
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def can_grant(self, tokens: float, now: float) -> bool:
+        if self.request_bucket is not None and not self.request_bucket.can_consume(
+            1, now
+        ):
+            return False
+        if self.token_bucket is not None and not self.token_bucket.can_consume(
+            tokens, now
+        ):
+            return False
+        return True
+
+    def grant(self, tokens: float, now: float) -> None:
+        if self.request_bucket is not None:
+            self.request_bucket.consume(1, now)
+        if self.token_bucket is not None:
+            self.token_bucket.consume(tokens, now)
+        self.num_requests += 1
+        self.num_tokens += tokens
+
+    def time_until_grant(self, tokens: float, now: float) -> float:
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.time_until(1, now))
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.time_until(tokens, now))
+        return wait
+
+    def next_waiter(self) -> _Waiter:
+        """Next waiter to serve: highest priority, then least recently served
+        session, then arrival order."""
+        return min(
+            self.waiters,
+            key=lambda w: (w.priority, self.last_served.get(w.session_id, -1), w.seq),
+        )
+
+
+class LLMScheduler:
+    """Process-wide scheduler that every LLM / embedding call goes through.
+
+    Args:
+        limits (Optional[Dict[str, RateLimit]]): limits per key. A key is either
+            "<provider>:<model>" (provider is the LlamaIndex class name, e.g.
+            "openai_llm:gpt-4o"), just "<model>", or "*" for everything else.
+        clock (Callable[[], float]): monotonic clock, injectable for testing.
+        max_wait_samples (int): number of recent queue waits kept for percentiles.
+
+    """
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, RateLimit]] = None,
+        clock: Callable[[], float] = time.monotonic,
+        max_wait_samples: int = 1000,
+    ) -> None:
+        """Init params."""
+        self._limits: Dict[str, RateLimit] = dict(limits or {})
+        self._clock = clock
+        self._max_wait_samples = max_wait_samples
+        self._cond = threading.Condition()
+        self._states: Dict[str, _ModelState] = {}
+        self._seq = 0
+        self._grant_seq = 0
+
+    def set_limits(self, limits: Dict[str, RateLimit]) -> None:
+        """Replace limits. Buckets are re-created on the next call."""
+        with self._cond:
+            self._limits = dict(limits)
+            self._states = {}
+            self._cond.notify_all()
+
+    def _get_limit(self, key: str) -> RateLimit:
+        model = key.split(":", 1)[-1]
+        for candidate in (key, model, "*"):
+            if candidate in self._limits:
+                return self._limits[candidate]
+        return RateLimit()
+
+    def _get_state(self, key: str) -> _ModelState:
+        if key not in self._states:
+            self._states[key] = _ModelState(
+                self._get_limit(key), self._clock(), self._max_wait_samples
+            )
+        return self._states[key]
+
+    def acquire(
+        self,
+        key: str,
+        tokens: float = 0,
+        session_id: Optional[str] = None,
+        priority: Optional[Priority] = None,
+        block: bool = True,
+    ) -> float:
+        """Block until a call with the estimated number of tokens may proceed.
+
+        Session and priority default to the current `llm_request_context`.
+        Without block, the call is granted right away, even over the limits
+        (the buckets go negative, later calls wait longer).
+        Returns the time spent waiting, in seconds.
+
+        """
+        context = get_request_context()
+        session_id = session_id if session_id is not None else context.session_id
+        priority = priority if priority is not None else context.priority
+
+        start = self._clock()
+        with self._cond:
+            if not block:
+                self._grant(self._get_state(key), session_id, tokens, start, start)
+                return 0.0
+            state = self._get_state(key)
+            self._seq += 1
+            waiter = _Waiter(self._seq, session_id, priority, tokens)
+            state.waiters.append(waiter)
+            try:
+                while True:
+                    # limits may have been replaced while waiting
+                    state = self._get_state(key)
+                    if waiter not in state.waiters:
+                        state.waiters.append(waiter)
+                    now = self._clock()
+                    if state.next_waiter() is waiter:
+                        if state.can_grant(tokens, now):
+                            break
+                        timeout: Optional[float] = state.time_until_grant(tokens, now)
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout=min(timeout, 1.0) if timeout else 1.0)
+            finally:
+                state.waiters.remove(waiter)
+            return self._grant(state, session_id, tokens, start, self._clock())
+
+    def _grant(
+        self,
+        state: _ModelState,
+        session_id: str,
+        tokens: float,
+        start: float,
+        now: float,
+    ) -> float:
+        state.grant(tokens, now)
+        self._grant_seq += 1
+        state.last_served[session_id] = self._grant_seq
+        wait = now - start
+        state.waits.append(wait)
+        state.total_wait += wait
+        state.max_wait = max(state.max_wait, wait)
+        self._cond.notify_all()
+        return wait
+
+    def _time_until_capacity(self, priority: Priority, now: float) -> Optional[float]:
+        """Seconds until every model has capacity for a call, None if unknown."""
+        wait = 0.0
+        for state in self._states.values():
+            if any(waiter.priority <= priority for waiter in state.waiters):
+                # blocked calls of the same or a higher priority go first
+                return None
+            wait = max(wait, state.time_until_grant(0, now))
+        return wait
+
+    async def await_capacity(
+        self, priority: Optional[Priority] = None, poll_interval: float = 0.05
+    ) -> float:
+        """Wait, without blocking the event loop, until calls may proceed.
+
+        For async entry points: their LLM / embedding calls are not blocked
+        (see `acquire`), so they wait here until no model is over its limits
+        and no call of the same or a higher priority is queued. Returns the
+        time spent waiting, in seconds.
+
+        """
+        priority = priority if priority is not None else get_request_context().priority
+        start = self._clock()
+        while True:
+            with self._cond:
+                now = self._clock()
+                wait = self._time_until_capacity(priority, now)
+            if wait == 0.0:
+                return now - start
+            await asyncio.sleep(min(wait or poll_interval, 1.0))
+
+    def debit(self, key: str, tokens: float) -> None:
+        """Report token usage after the fact (negative values give tokens back)."""
+        if tokens == 0:
+            return
+        with self._cond:
+            state = self._get_state(key)
+            if state.token_bucket is not None:
+                state.token_bucket.consume(tokens, self._clock())
+            state.num_tokens += tokens
+            self._cond.notify_all()
+
+    def get_metrics(self) -> Dict[str, Dict[str, Any]]:
+        """Get per provider/model metrics, including queue-wait percentiles."""
+        metrics = {}
+        with self._cond:
+            for key, state in self._states.items():
+                waits = sorted(state.waits)
+                metrics[key] = {
+                    "requests": state.num_requests,
+                    "tokens": state.num_tokens,
+                    "queued": len(state.waiters),
+                    "wait_avg": (
+                        state.total_wait / state.num_requests
+                        if state.num_requests
+                        else 0.0
+                    ),
+                    "wait_p50": _percentile(waits, 50),
+                    "wait_p95": _percentile(waits, 95),
+                    "wait_max": state.max_wait,
+                }
+        return metrics
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+def get_model_key(model_dict: Dict[str, Any]) -> str:
+    """Get "<provider>:<model>" key from an LLM / embedding model dict."""
+    provider = str(model_dict.get("class_name", "unknown"))
+    model = model_dict.get("model") or model_dict.get("model_name") or "default"
+    return f"{provider}:{model}"
+
+
+def _get_usage_tokens(response: Any) -> Optional[int]:
+    """Get total tokens used from a raw provider response, if reported."""
+    raw = getattr(response, "raw", None)
+    if raw is None:
+        return None
+    usage = raw.get("usage") if isinstance(raw, dict) else getattr(raw, "usage", None)
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        total = usage.get("total_tokens")
+    else:
+        total = getattr(usage, "total_tokens", None)
+    return int(total) if total is not None else None
+
+
+class LLMSchedulerEventHandler(BaseEventHandler):
+    """Instrumentation event handler that routes calls through the scheduler."""
+
+    _scheduler: LLMScheduler = PrivateAttr()
+    # span id -> (key, estimated tokens), to reconcile with actual usage
+    _estimates: Dict[str, Tuple[str, int]] = PrivateAttr(default_factory=dict)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(self, scheduler: LLMScheduler, **kwargs: Any) -> None:
+        """Init params."""
+        super().__init__(**kwargs)
+        self._scheduler = scheduler
+
+    @classmethod
+    def class_name(cls) -> str:
+        """Class name."""
+        return "LLMSchedulerEventHandler"
+
+    def _start(self, event: BaseEvent, key: str, tokens: int) -> None:
+        if event.span_id is not None:
+            with self._lock:
+                self._estimates[event.span_id] = (key, tokens)
+        try:
+            asyncio.get_running_loop()
+            in_event_loop = True
+        except RuntimeError:
+            in_event_loop = False
+        # blocking would freeze the event loop (see `LLMScheduler.await_capacity`)
+        self._scheduler.acquire(key, tokens=tokens, block=not in_event_loop)
+
+    def _end(self, event: BaseEvent, response: Any) -> None:
+        if event.span_id is None:
+            return
+        with self._lock:
+            key_and_estimate = self._estimates.pop(event.span_id, None)
+        if key_and_estimate is None:
+            return
+        key, estimate = key_and_estimate
+        actual = _get_usage_tokens(response)
+        if actual is not None:
+            self._scheduler.debit(key, actual - estimate)
+
+    def handle(self, event: BaseEvent, **kwargs: Any) -> Any:
+        """Logic for handling event."""
+        if isinstance(event, LLMChatStartEvent):
+            text = " ".join(str(message.content or "") for message in event.messages)
+            self._start(event, get_model_key(event.model_dict), estimate_tokens(text))
+        elif isinstance(event, LLMCompletionStartEvent):
+            self._start(
+                event, get_model_key(event.model_dict), estimate_tokens(event.prompt)
+            )
+        elif isinstance(event, (LLMChatEndEvent, LLMCompletionEndEvent)):
+            self._end(event, event.response)
+        elif isinstance(event, EmbeddingStartEvent):
+            # the texts are only known once the call is done, so we debit then
+            self._start(event, get_model_key(event.model_dict), 0)
+        elif isinstance(event, EmbeddingEndEvent):
+            if event.span_id is None:
+                return
+            with self._lock:
+                key_and_estimate = self._estimates.pop(event.span_id, None)
+            if key_and_estimate is not None:
+                self._scheduler.debit(
+                    key_and_estimate[0],
+                    sum(estimate_tokens(chunk) for chunk in event.chunks),
+                )
+
+
+_LLM_SCHEDULER: Optional[LLMScheduler] = None
+_INSTALLED_HANDLER: Optional[LLMSchedulerEventHandler] = None
+_INSTALL_LOCK = threading.Lock()
+
+
+def get_llm_scheduler(limits: Optional[Dict[str, RateLimit]] = None) -> LLMScheduler:
+    """Get process-wide scheduler, optionally (re)setting its limits."""
+    global _LLM_SCHEDULER
+    with _INSTALL_LOCK:
+        if _LLM_SCHEDULER is None:
+            _LLM_SCHEDULER = LLMScheduler(limits)
+        elif limits is not None:
+            _LLM_SCHEDULER.set_limits(limits)
+        return _LLM_SCHEDULER
+
+
+def install_llm_scheduler(scheduler: Optional[LLMScheduler] = None) -> LLMScheduler:
+    """Route all LLM / embedding calls through the scheduler.
+
+    Idempotent: the event handler is only added to the root dispatcher once.
+
+    """
+    global _INSTALLED_HANDLER
+    scheduler = scheduler or get_llm_scheduler()
+    with _INSTALL_LOCK:
+        if _INSTALLED_HANDLER is None:
+            _INSTALLED_HANDLER = LLMSchedulerEventHandler(scheduler)
+            get_dispatcher().add_event_handler(_INSTALLED_HANDLER)
+        else:
+            _INSTALLED_HANDLER._scheduler = scheduler
+    return scheduler
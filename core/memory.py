@@ -0,0 +1,213 @@
+"""Chat memory with a token-bounded window and a rolling summary.
+
+`SummaryWindowMemory` gives the chat engine only the most recent messages
+that fit in `token_limit` tokens, preceded by a summary of the older ones. The
+summary is updated by the LLM in a background thread after each response, so
+the prompts (and the latency) of a turn stay flat however long the
+conversation gets, and the summarization is never on the critical path: until
+it finishes, the previous summary is used.
+
+"""
+
+import contextvars
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, List, Optional
+
+from llama_index.core.base.llms.types import ChatMessage, MessageRole
+from llama_index.core.llms import LLM
+from llama_index.core.memory.types import BaseMemory
+from pydantic import Field, PrivateAttr
+
+from core.llm_scheduler import Priority, llm_request_context
+from core.postprocessors import count_tokens
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_MAX_WORDS = 200
+SUMMARY_PROMPT = (
+    "Progressively summarize the conversation between a user and an AI "
+    "assistant, adding the new lines to the previous summary. Keep the names, "
+    "facts and questions the rest of the conversation may refer to, in at most "
+    "{max_words} words.\n\n"
+    "Previous summary:\n{summary}\n\n"
+    "New lines of conversation:\n{lines}\n\n"
+    "New summary:"
+)
+SUMMARY_MESSAGE_PREFIX = "Summary of the earlier conversation: "
+
+# summarization threads, shared by all conversations of the process
+_SUMMARY_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="memory")
+
+
+class SummaryWindowMemory(BaseMemory):
+    """Recent messages within a token limit, plus a summary of older ones."""
+
+    token_limit: int = Field(
+        default=1500, description="Maximum tokens of the recent messages."
+    )
+    llm: Optional[LLM] = Field(
+        default=None, description="LLM writing the summary.", exclude=True
+    )
+
+    _all_messages: List[ChatMessage] = PrivateAttr(default_factory=list)
+    # messages not yet summarized: the window, and the older ones being summarized
+    _messages: List[ChatMessage] = PrivateAttr(default_factory=list)
+    _summary: Optional[str] = PrivateAttr(default=None)
+    _pending: Optional[Future] = PrivateAttr(default=None)
+    # bumped on reset, results of summaries started before are dropped
+    _generation: int = PrivateAttr(default=0)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def class_name(cls) -> str:
+        """Get class name."""
+        return "SummaryWindowMemory"
+
+    @classmethod
+    def from_defaults(
+        cls,
+        chat_history: Optional[List[ChatMessage]] = None,
+        llm: Optional[LLM] = None,
+        token_limit: int = 1500,
+        **kwargs: Any,
+    ) -> "SummaryWindowMemory":
+        """Create a memory, optionally with a chat history."""
+        memory = cls(token_limit=token_limit, llm=llm)
+        if chat_history:
+            memory.set(chat_history)
+        return memory
+
+    @property
+    def summary(self) -> Optional[str]:
+        """Summary of the messages older than the window, if any."""
+        return self._summary
+
+    def _get_window_start(self) -> int:
+        """Index in `_messages` of the first message of the window.
+
+        The window starts at a user message, so that tool calls stay with
+        their results; it has at least the last user message.
+
+        """
+        num_tokens = 0
+        start = len(self._messages)
+        last_user = None
+        for i in range(len(self._messages) - 1, -1, -1):
+            message = self._messages[i]
+            num_tokens += count_tokens(str(message.content or ""))
+            if message.role != MessageRole.USER:
+                continue
+            if last_user is None:
+                last_user = i
+            if num_tokens > self.token_limit:
+                break
+            start = i
+        if last_user is None:
+            return 0
+        return min(start, last_user)
+
+    def get(self, input: Optional[str] = None, **kwargs: Any) -> List[ChatMessage]:
+        """Get the summary (as a system message) and the recent messages."""
+        with self._lock:
+            messages = self._messages[self._get_window_start() :]
+            if self._summary:
+                summary_message = ChatMessage(
+                    role=MessageRole.SYSTEM,
+                    content=SUMMARY_MESSAGE_PREFIX + self._summary,
+                )
+                messages = [summary_message, *messages]
+            return messages
+
+    def get_all(self) -> List[ChatMessage]:
+        """Get all chat history."""
+        with self._lock:
+            return list(self._all_messages)
+
+    def put(self, message: ChatMessage) -> None:
+        """Put chat history, summarize older messages after a response."""
+        with self._lock:
+            self._all_messages.append(message)
+            self._messages.append(message)
+        if message.role == MessageRole.ASSISTANT and message.content:
+            self._schedule_summary()
+
+    def set(self, messages: List[ChatMessage]) -> None:
+        """Set chat history."""
+        with self._lock:
+            self._reset()
+            self._all_messages = list(messages)
+            self._messages = list(messages)
+        self._schedule_summary()
+
+    def reset(self) -> None:
+        """Reset chat history."""
+        with self._lock:
+            self._reset()
+
+    def _reset(self) -> None:
+        self._all_messages = []
+        self._messages = []
+        self._summary = None
+        self._pending = None
+        self._generation += 1
+
+    def _schedule_summary(self) -> None:
+        """Summarize the messages older than the window, in the background."""
+        if self.llm is None:
+            return
+        with self._lock:
+            if self._pending is not None and not self._pending.done():
+                # the next response will pick up what this one leaves
+                return
+            num_old = self._get_window_start()
+            if num_old == 0:
+                return
+            # in the current context (session, trace), but behind interactive
+            # calls: nobody waits for the summary
+            with llm_request_context(priority=Priority.BACKGROUND):
+                self._pending = _SUMMARY_EXECUTOR.submit(
+                    contextvars.copy_context().run,
+                    self._summarize,
+                    self._summary,
+                    self._messages[:num_old],
+                    self._generation,
+                )
+
+    def _summarize(
+        self,
+        summary: Optional[str],
+        old_messages: List[ChatMessage],
+        generation: int,
+    ) -> None:
+        lines = "\n".join(
+            f"{message.role.value}: {message.content}"
+            for message in old_messages
+            # tool calls / results are in the answers that follow them
+            if message.content
+            and message.role in (MessageRole.USER, MessageRole.ASSISTANT)
+        )
+        assert self.llm is not None
+        try:
+            summary_words = self.llm.complete(
+                SUMMARY_PROMPT.format(
+                    max_words=SUMMARY_MAX_WORDS, summary=summary or "", lines=lines
+                )
+            ).text.split()
+        except Exception:
+            # retried with the next response
+            logger.warning("Conversation summarization failed", exc_info=True)
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            # LLMs don't always stick to the length asked for
+            self._summary = " ".join(summary_words[: 2 * SUMMARY_MAX_WORDS])
+            self._messages = self._messages[len(old_messages) :]
+
+    def wait_for_summary(self, timeout: Optional[float] = None) -> None:
+        """Wait for the pending summarization, if any (e.g. in benchmarks)."""
+        pending = self._pending
+        if pending is not None:
+            pending.result(timeout=timeout)
@@ -0,0 +1,602 @@
+"""Metadata-aware retrieval over structured (CSV) sources.
+
+- `CSVRowNodeParser`: indexes CSV files one node per row, with the structured
+  fields of the row (year, genre, rating, ...) as node metadata. Other
+  documents are chunked as usual.
+- `MetadataIndex`: per-field indexes over node metadata (sorted values for
+  numeric fields, postings for keyword / tag fields), persisted with the
+  vector index, and rule-based extraction of filters from a query ("war films
+  from the 1960s" -> genre contains war, 1960 <= year <= 1969).
+- `MetadataFilteringRetriever`: restricts vector search to the nodes matching
+  the filters extracted from the query (filled from an unfiltered search if
+  too few of them match well, in case the filters misread it).
+
+"""
+
+import csv
+import json
+import logging
+import re
+import threading
+import weakref
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
+
+from llama_index.core import VectorStoreIndex
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import (
+    BaseNode,
+    Document,
+    NodeRelationship,
+    NodeWithScore,
+    QueryBundle,
+    RelatedNodeInfo,
+    TextNode,
+    TransformComponent,
+)
+from llama_index.core.vector_stores.types import (
+    FilterCondition,
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+)
+from pydantic import Field
+
+logger = logging.getLogger(__name__)
+
+METADATA_INDEX_FNAME = "metadata_index.json"
+
+# structured fields of the bundled datasets, by kind:
+# - number: sorted index, range filters
+# - keyword: exact value
+# - tags: comma-separated values, each indexed
+FIELD_KINDS: Dict[str, str] = {
+    # data/movies/*.csv
+    "year": "number",
+    "rating": "number",
+    "genre": "tags",
+    "certificate": "keyword",
+    "director": "tags",
+    # data/books.csv
+    "authors": "tags",
+    "original_publication_year": "number",
+    "average_rating": "number",
+}
+# fields filters extracted from queries apply to, by role
+YEAR_FIELDS = ("year", "original_publication_year")
+RATING_FIELDS = ("rating", "average_rating")
+NAME_FIELDS = ("director", "authors")
+GENRE_FIELDS = ("genre",)
+CERTIFICATE_FIELDS = ("certificate",)
+
+YEAR_RE = re.compile(r"\b(1[89]\d\d|20\d\d)\b")
+DECADE_RE = re.compile(r"(?<![\w'])(?:(1[89]|20)(\d)0|'?(\d)0)'?s\b", re.IGNORECASE)
+YEAR_BETWEEN_RE = re.compile(
+    r"\b(?:between|from)\s+(\d{4})\s+(?:and|to)\s+(\d{4})\b|\b(\d{4})\s*-\s*(\d{4})\b",
+    re.IGNORECASE,
+)
+YEAR_COMPARE_RE = re.compile(
+    r"\b(before|prior to|until|after|since)\s+(\d{4})\b", re.IGNORECASE
+)
+YEAR_EXACT_RE = re.compile(r"\b(?:in|from)\s+(\d{4})\b", re.IGNORECASE)
+# a number can also be a title ("the story of 1984"): an exact year and a
+# single-word genre ("the history of the Vietnam war") are only conditions when
+# the query is about the items of a dataset
+MEDIA_NOUNS = {"book", "books", "novel", "novels", "film", "films", "movie", "movies"}
+MEDIA_RE = re.compile(
+    rf"\b(?:{'|'.join(sorted(MEDIA_NOUNS))}|released|published|written)\b",
+    re.IGNORECASE,
+)
+# max words between a genre and the media noun it qualifies ("war and history
+# films", "comedy movies")
+GENRE_MEDIA_WINDOW = 3
+RATING_COMPARE_RE = re.compile(
+    r"\b(?:rated|ratings?|scores?|stars?)\s+(?:of\s+)?"
+    r"(above|over|more than|greater than|at least|below|under|less than|at most)"
+    r"\s+(\d+(?:\.\d+)?)\b",
+    re.IGNORECASE,
+)
+RATING_PLUS_RE = re.compile(r"\b(\d+(?:\.\d+)?)\+\s*(?:stars?|rating)", re.IGNORECASE)
+TOKEN_RE = re.compile(r"[\w'.-]+")
+# longest name / genre looked up in queries, in words
+MAX_NGRAM = 4
+
+
+def _tokenize(text: str) -> List[str]:
+    tokens = (token.strip(".'-") for token in TOKEN_RE.findall(text))
+    return [token for token in tokens if token]
+
+
+def _normalize_value(value: str) -> str:
+    return " ".join(_tokenize(value.lower()))
+
+
+def parse_field(field: str, value: Any) -> Any:
+    """Parse a raw CSV value of a structured field, None if missing / invalid."""
+    value = str(value).strip()
+    if not value or value.lower() in ("nan", "none", "null"):
+        return None
+    if FIELD_KINDS[field] == "number":
+        if field in YEAR_FIELDS:
+            # e.g. "2019", "2008.0", "(I) 2019"
+            match = YEAR_RE.search(value)
+            return int(match.group(1)) if match else None
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return value
+
+
+def _split_tags(value: str) -> List[str]:
+    return [tag.strip() for tag in value.split(",") if tag.strip()]
+
+
+class CSVRowNodeParser(TransformComponent):
+    """Chunk documents, CSV files into one node per row with its fields.
+
+    CSV documents (from `SimpleDirectoryReader`) are re-read from their
+    `file_path`, as the loaded text doesn't preserve row boundaries.
+
+    """
+
+    chunk_size: int = Field(default=1024, description="Chunk size of other docs.")
+
+    def _get_row_nodes(self, doc: Document) -> List[BaseNode]:
+        file_path = doc.metadata["file_path"]
+        nodes: List[BaseNode] = []
+        with open(file_path, newline="", encoding="utf-8", errors="replace") as f:
+            for i, row in enumerate(csv.DictReader(f)):
+                fields = {
+                    field: parse_field(field, value)
+                    for field, value in row.items()
+                    if field in FIELD_KINDS
+                }
+                fields = {k: v for k, v in fields.items() if v is not None}
+                text = ", ".join(" ".join(str(value).split()) for value in row.values())
+                nodes.append(
+                    TextNode(
+                        text=text,
+                        metadata={**doc.metadata, **fields},
+                        # the fields are already in the row text
+                        excluded_embed_metadata_keys=(
+                            doc.excluded_embed_metadata_keys + list(fields)
+                        ),
+                        excluded_llm_metadata_keys=(
+                            doc.excluded_llm_metadata_keys + list(fields)
+                        ),
+                        # one source per row: the docstore keeps the node ids
+                        # of each source, one list for a whole file would be
+                        # re-serialized on every insert
+                        relationships={
+                            NodeRelationship.SOURCE: RelatedNodeInfo(
+                                node_id=f"{doc.doc_id}_row_{i}"
+                            )
+                        },
+                    )
+                )
+        return nodes
+
+    def __call__(self, nodes: Sequence[BaseNode], **kwargs: Any) -> List[BaseNode]:
+        """Chunk nodes."""
+        splitter = SentenceSplitter(chunk_size=self.chunk_size)
+        parsed: List[BaseNode] = []
+        for node in nodes:
+            file_path = node.metadata.get("file_path", "")
+            if (
+                isinstance(node, Document)
+                and str(file_path).lower().endswith(".csv")
+                and Path(file_path).exists()
+            ):
+                parsed.extend(self._get_row_nodes(node))
+            else:
+                parsed.extend(splitter([node], **kwargs))
+        return parsed
+
+
+class MetadataIndex:
+    """Per-field indexes over the structured metadata of nodes."""
+
+    def __init__(self) -> None:
+        """Init params."""
+        # number fields: values sorted, with the matching node ids
+        self._numbers: Dict[str, Tuple[List[float], List[str]]] = {}
+        # keyword / tag fields: normalized value -> node ids
+        self._postings: Dict[str, Dict[str, Set[str]]] = defaultdict(
+            lambda: defaultdict(set)
+        )
+        # case-sensitive keyword values, for certificates ("R", "PG-13")
+        self._keywords: Dict[str, Set[str]] = defaultdict(set)
+        self._lock = threading.Lock()
+
+    @property
+    def fields(self) -> List[str]:
+        """Indexed fields."""
+        return sorted(set(self._numbers) | set(self._postings))
+
+    @classmethod
+    def from_nodes(cls, nodes: Iterable[BaseNode]) -> "MetadataIndex":
+        """Build index over the structured fields of nodes."""
+        metadata_index = cls()
+        metadata_index.add_nodes(nodes)
+        return metadata_index
+
+    def add_nodes(self, nodes: Iterable[BaseNode]) -> None:
+        """Index the structured fields of nodes."""
+        new_numbers: Dict[str, List[Tuple[float, str]]] = defaultdict(list)
+        with self._lock:
+            for node in nodes:
+                for field, value in node.metadata.items():
+                    kind = FIELD_KINDS.get(field)
+                    if kind is None or value is None:
+                        continue
+                    if kind == "number":
+                        new_numbers[field].append((float(value), node.node_id))
+                        continue
+                    values = _split_tags(value) if kind == "tags" else [value]
+                    for v in values:
+                        self._postings[field][_normalize_value(v)].add(node.node_id)
+                        if kind == "keyword":
+                            self._keywords[field].add(v)
+            for field, pairs in new_numbers.items():
+                values, node_ids = self._numbers.get(field, ([], []))
+                pairs.extend(zip(values, node_ids))
+                pairs.sort()
+                self._numbers[field] = (
+                    [value for value, _ in pairs],
+                    [node_id for _, node_id in pairs],
+                )
+
+    def _get_filter_node_ids(self, metadata_filter: MetadataFilter) -> Set[str]:
+        field, op, value = (
+            metadata_filter.key,
+            metadata_filter.operator,
+            metadata_filter.value,
+        )
+        if field in self._numbers:
+            values, node_ids = self._numbers[field]
+            lo, hi = 0, len(values)
+            if op in (FilterOperator.GTE, FilterOperator.EQ):
+                lo = bisect_left(values, float(value))  # type: ignore
+            if op == FilterOperator.GT:
+                lo = bisect_right(values, float(value))  # type: ignore
+            if op in (FilterOperator.LTE, FilterOperator.EQ):
+                hi = bisect_right(values, float(value))  # type: ignore
+            if op == FilterOperator.LT:
+                hi = bisect_left(values, float(value))  # type: ignore
+            return set(node_ids[lo:hi])
+        postings = self._postings.get(field, {})
+        if op == FilterOperator.IN:
+            values = cast(List[str], value)
+            return set().union(
+                *(postings.get(_normalize_value(v), set()) for v in values)
+            )
+        if op in (FilterOperator.EQ, FilterOperator.CONTAINS):
+            return set(postings.get(_normalize_value(str(value)), set()))
+        raise ValueError(f"Operator {op} not supported on field {field}.")
+
+    def get_node_ids(self, filters: MetadataFilters) -> Set[str]:
+        """Ids of the nodes matching filters."""
+        with self._lock:
+            return self._get_node_ids(filters)
+
+    def _get_node_ids(self, filters: MetadataFilters) -> Set[str]:
+        node_id_sets = [
+            (
+                self._get_node_ids(f)
+                if isinstance(f, MetadataFilters)
+                else self._get_filter_node_ids(f)
+            )
+            for f in filters.filters
+        ]
+        if not node_id_sets:
+            return set()
+        if filters.condition == FilterCondition.OR:
+            return set().union(*node_id_sets)
+        return set.intersection(*node_id_sets)
+
+    ### filter extraction ###
+
+    def _any_field(
+        self, fields: Sequence[str], filters: List[MetadataFilter]
+    ) -> Optional[MetadataFilters]:
+        """Apply filters to whichever of the (alternative) fields are indexed."""
+        field_filters = [
+            MetadataFilters(
+                filters=[
+                    MetadataFilter(key=field, operator=f.operator, value=f.value)
+                    for f in filters
+                ]
+            )
+            for field in fields
+            if field in self._numbers or field in self._postings
+        ]
+        if not field_filters:
+            return None
+        if len(field_filters) == 1:
+            return field_filters[0]
+        return MetadataFilters(filters=field_filters, condition=FilterCondition.OR)
+
+    def _extract_year_filters(self, query_str: str) -> List[MetadataFilter]:
+        match = YEAR_BETWEEN_RE.search(query_str)
+        if match:
+            years = [int(y) for y in match.groups() if y is not None]
+            return [
+                MetadataFilter(key="", operator=FilterOperator.GTE, value=min(years)),
+                MetadataFilter(key="", operator=FilterOperator.LTE, value=max(years)),
+            ]
+        match = DECADE_RE.search(query_str)
+        if match:
+            century, decade, short_decade = match.groups()
+            if century is not None:
+                start = int(century) * 100 + int(decade) * 10
+            else:
+                # '60s -> 1960s, '10s -> 2010s
+                start = (1900 if int(short_decade) >= 3 else 2000) + int(
+                    short_decade
+                ) * 10
+            return [
+                MetadataFilter(key="", operator=FilterOperator.GTE, value=start),
+                MetadataFilter(key="", operator=FilterOperator.LTE, value=start + 9),
+            ]
+        match = YEAR_COMPARE_RE.search(query_str)
+        if match:
+            word, year = match.group(1).lower(), int(match.group(2))
+            op = {
+                "before": FilterOperator.LT,
+                "prior to": FilterOperator.LT,
+                "until": FilterOperator.LTE,
+                "after": FilterOperator.GT,
+                "since": FilterOperator.GTE,
+            }[word]
+            return [MetadataFilter(key="", operator=op, value=year)]
+        match = YEAR_EXACT_RE.search(query_str)
+        if match and MEDIA_RE.search(query_str):
+            return [
+                MetadataFilter(
+                    key="", operator=FilterOperator.EQ, value=int(match.group(1))
+                )
+            ]
+        return []
+
+    def _extract_rating_filters(self, query_str: str) -> List[MetadataFilter]:
+        match = RATING_COMPARE_RE.search(query_str)
+        if match:
+            word, value = match.group(1).lower(), float(match.group(2))
+            op = {
+                "above": FilterOperator.GT,
+                "over": FilterOperator.GT,
+                "more than": FilterOperator.GT,
+                "greater than": FilterOperator.GT,
+                "at least": FilterOperator.GTE,
+                "below": FilterOperator.LT,
+                "under": FilterOperator.LT,
+                "less than": FilterOperator.LT,
+                "at most": FilterOperator.LTE,
+            }[word]
+            return [MetadataFilter(key="", operator=op, value=value)]
+        match = RATING_PLUS_RE.search(query_str)
+        if match:
+            return [
+                MetadataFilter(
+                    key="", operator=FilterOperator.GTE, value=float(match.group(1))
+                )
+            ]
+        return []
+
+    def _extract_value_filters(
+        self, query_str: str
+    ) -> List[Union[MetadataFilter, MetadataFilters]]:
+        """Filters on names / genres / certificates mentioned in the query."""
+        tokens = _tokenize(query_str)
+        lowered = [token.lower() for token in tokens]
+        ngrams = {
+            " ".join(lowered[i : i + n])
+            for n in range(2, MAX_NGRAM + 1)
+            for i in range(len(lowered) - n + 1)
+        }
+        # single words only count as genres next to a media noun ("war films"),
+        # or in the plural ("westerns", "comedies")
+        words: Set[str] = set()
+        for i, token in enumerate(lowered):
+            if token.endswith("ies"):
+                words.add(token[:-3] + "y")
+            elif token.endswith("s") and token not in MEDIA_NOUNS:
+                words.add(token[:-1])
+            if MEDIA_NOUNS & set(lowered[i + 1 : i + 1 + GENRE_MEDIA_WINDOW]):
+                words.add(token)
+
+        filters: List[Union[MetadataFilter, MetadataFilters]] = []
+        for fields, values in ((NAME_FIELDS, ngrams), (GENRE_FIELDS, ngrams | words)):
+            for value in sorted(values):
+                # a name can be e.g. both a director and an author
+                value_filters = [
+                    MetadataFilter(
+                        key=field, operator=FilterOperator.CONTAINS, value=value
+                    )
+                    for field in fields
+                    if value in self._postings.get(field, {})
+                ]
+                if len(value_filters) == 1:
+                    filters.append(value_filters[0])
+                elif value_filters:
+                    filters.append(
+                        MetadataFilters(
+                            filters=value_filters, condition=FilterCondition.OR
+                        )
+                    )
+        for field in CERTIFICATE_FIELDS:
+            # case-sensitive, so that "R" / "G" only match as ratings
+            keywords = self._keywords.get(field, set())
+            for i, token in enumerate(tokens):
+                rated = i > 0 and lowered[i - 1] == "rated"
+                if token in keywords and (
+                    rated or (len(token) > 1 and token.isupper())
+                ):
+                    filters.append(
+                        MetadataFilter(
+                            key=field, operator=FilterOperator.EQ, value=token
+                        )
+                    )
+        return filters
+
+    def extract_filters(self, query_str: str) -> Optional[MetadataFilters]:
+        """Extract filters on the indexed fields from a query, None if none."""
+        filters: List[Union[MetadataFilter, MetadataFilters]] = []
+        for fields, field_filters in (
+            (YEAR_FIELDS, self._extract_year_filters(query_str)),
+            (RATING_FIELDS, self._extract_rating_filters(query_str)),
+        ):
+            if field_filters:
+                any_field_filters = self._any_field(fields, field_filters)
+                if any_field_filters is not None:
+                    filters.append(any_field_filters)
+        with self._lock:
+            filters.extend(self._extract_value_filters(query_str))
+        if not filters:
+            return None
+        return MetadataFilters(filters=filters)
+
+    ### persistence ###
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize index."""
+        with self._lock:
+            return {
+                "numbers": {
+                    field: {"values": values, "node_ids": node_ids}
+                    for field, (values, node_ids) in self._numbers.items()
+                },
+                "postings": {
+                    field: {value: sorted(ids) for value, ids in postings.items()}
+                    for field, postings in self._postings.items()
+                },
+                "keywords": {
+                    field: sorted(values) for field, values in self._keywords.items()
+                },
+            }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "MetadataIndex":
+        """Load index from dict."""
+        metadata_index = cls()
+        for field, field_data in data["numbers"].items():
+            metadata_index._numbers[field] = (
+                field_data["values"],
+                field_data["node_ids"],
+            )
+        for field, postings in data["postings"].items():
+            for value, node_ids in postings.items():
+                metadata_index._postings[field][value] = set(node_ids)
+        for field, values in data["keywords"].items():
+            metadata_index._keywords[field] = set(values)
+        return metadata_index
+
+    def persist(self, persist_path: Union[str, Path]) -> None:
+        """Persist index to a JSON file."""
+        with open(persist_path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def from_persist_path(cls, persist_path: Union[str, Path]) -> "MetadataIndex":
+        """Load index from a JSON file."""
+        with open(persist_path) as f:
+            return cls.from_dict(json.load(f))
+
+
+# metadata index of each vector index (built / loaded with it)
+_METADATA_INDEXES: "weakref.WeakKeyDictionary[VectorStoreIndex, MetadataIndex]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_metadata_index(vector_index: VectorStoreIndex) -> Optional[MetadataIndex]:
+    """Get metadata index of a vector index, if it has one."""
+    return _METADATA_INDEXES.get(vector_index)
+
+
+def set_metadata_index(
+    vector_index: VectorStoreIndex, metadata_index: MetadataIndex
+) -> None:
+    """Attach metadata index to a vector index."""
+    _METADATA_INDEXES[vector_index] = metadata_index
+
+
+class MetadataFilteringRetriever(BaseRetriever):
+    """Vector retriever pre-filtered by the metadata conditions of the query.
+
+    Filtered queries only search the nodes matching the conditions. If fewer
+    than `similarity_top_k` of them are found (or, with `min_score`, fewer
+    score at least that), the rest is filled from an unfiltered search, in
+    case the conditions misread the query. If the query has no conditions on
+    the indexed fields, or no node matches them, retrieval is unfiltered.
+
+    """
+
+    def __init__(
+        self,
+        vector_index: VectorStoreIndex,
+        metadata_index: MetadataIndex,
+        similarity_top_k: int = 2,
+        min_score: Optional[float] = None,
+        callback_manager: Optional[CallbackManager] = None,
+    ) -> None:
+        """Init params."""
+        self._vector_index = vector_index
+        self._metadata_index = metadata_index
+        self._similarity_top_k = similarity_top_k
+        self._min_score = min_score
+        super().__init__(callback_manager=callback_manager)
+
+    def _search(
+        self, query_bundle: QueryBundle, node_ids: Optional[List[str]] = None
+    ) -> List[NodeWithScore]:
+        # not `as_retriever`, which always restricts to all the index's nodes
+        retriever = VectorIndexRetriever(
+            self._vector_index,
+            similarity_top_k=self._similarity_top_k,
+            node_ids=node_ids,
+            callback_manager=self.callback_manager,
+        )
+        return retriever.retrieve(query_bundle)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        filters = self._metadata_index.extract_filters(query_bundle.query_str)
+        if filters is None:
+            return self._search(query_bundle)
+        matching_ids = self._metadata_index.get_node_ids(filters)
+        logger.debug(
+            "Filters %s match %d nodes", filters.model_dump(), len(matching_ids)
+        )
+        if not matching_ids:
+            return self._search(query_bundle)
+        nodes = self._search(query_bundle, node_ids=sorted(matching_ids))
+        if self._min_score is not None:
+            nodes = [node for node in nodes if (node.score or 0.0) >= self._min_score]
+        if len(nodes) >= self._similarity_top_k:
+            return nodes
+        # too few good matches: the filters may have misread the query (the
+        # query embedding is reused)
+        seen_ids = {node.node.node_id for node in nodes}
+        unfiltered_nodes = [
+            node
+            for node in self._search(query_bundle)
+            if node.node.node_id not in seen_ids
+        ]
+        return nodes + unfiltered_nodes[: self._similarity_top_k - len(nodes)]
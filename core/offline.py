@@ -0,0 +1,427 @@
+"""Offline, deterministic stand-in LLM and embedding backends.
+
+Lets ingestion, indexing, retrieval and agent turns run (and be benchmarked)
+without network access or API keys.
+
+- `HashEmbedding`: feature-hashing embedding, same text -> same vector.
+- `OfflineLLM`: echoes the user or plays back a script, with configurable
+  latency and token rate. Supports OpenAI-style function calling, so the
+  `OpenAIAgent` paths work, and the ReAct output format, so `ReActAgent` works.
+
+Select them with an `offline:` prefix (e.g. `llm="offline:echo"`,
+`embed_model="offline:hash"`), or set `RAGS_OFFLINE=1` to swap every LLM /
+embedding model for the offline ones.
+
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    ChatResponseGen,
+    LLMMetadata,
+    MessageRole,
+)
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.llms.openai import OpenAI
+from openai.types.chat.chat_completion_message_tool_call import (
+    ChatCompletionMessageToolCall,
+    Function,
+)
+
+OFFLINE_ENV_VAR = "RAGS_OFFLINE"
+OFFLINE_LATENCY_ENV_VAR = "RAGS_OFFLINE_LATENCY"
+OFFLINE_TOKENS_PER_SEC_ENV_VAR = "RAGS_OFFLINE_TOKENS_PER_SEC"
+
+# marker of the ReAct system header (see REACT_CHAT_SYSTEM_HEADER)
+_REACT_MARKER = "Action Input:"
+
+# a script step is either text to answer with, a tool call
+# ({"tool": name, "arguments": {...}}), or a list of tool calls
+ScriptStep = Union[str, Dict[str, Any], List[Dict[str, Any]]]
+
+
+def is_offline_mode() -> bool:
+    """Whether every LLM / embedding model should be replaced by offline ones."""
+    return os.environ.get(OFFLINE_ENV_VAR, "").lower() in ("1", "true", "yes")
+
+
+def _env_float(name: str, default: Optional[float]) -> Optional[float]:
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+def _tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+class HashEmbedding(BaseEmbedding):
+    """Deterministic hashing embedding.
+
+    Each word (and word bigram) is hashed to a signed dimension, and the vector
+    is L2-normalized. Texts that share words get similar vectors, which is
+    enough to make retrieval behave realistically for benchmarks.
+
+    """
+
+    dim: int = Field(default=256, description="Embedding dimension.")
+    latency: float = Field(
+        default=0.0, description="Simulated latency per embedding call (seconds)."
+    )
+
+    def __init__(self, dim: int = 256, latency: float = 0.0, **kwargs: Any) -> None:
+        """Init params."""
+        kwargs.setdefault("model_name", f"offline-hash-{dim}")
+        super().__init__(dim=dim, latency=latency, **kwargs)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashEmbedding"
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dim
+        words = _tokenize(text)
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        for feature in features:
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            sign = 1.0 if (value >> 63) & 1 else -1.0
+            vector[value % self.dim] += sign
+        norm = math.sqrt(sum(v * v for v in vector))
+        if norm == 0:
+            # keep empty texts well-defined for cosine similarity
+            vector[0] = 1.0
+            return vector
+        return [v / norm for v in vector]
+
+    def _sleep(self) -> None:
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        self._sleep()
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        self._sleep()
+        return self._embed(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        # latency is per call (i.e. per batch), like a remote API
+        self._sleep()
+        return [self._embed(text) for text in texts]
+
+
+class OfflineLLM(OpenAI):
+    """Offline LLM that echoes or plays back a script.
+
+    Subclasses `OpenAI` only so that it's accepted by `OpenAIAgent`; it never
+    creates an OpenAI client.
+
+    Args:
+        mode (str): "echo" answers with (a prefix of) the last user message.
+            "script" plays back `script` steps in order, then falls back to echo.
+        script (List[ScriptStep]): steps for "script" mode.
+        latency (float): simulated time to first token (seconds).
+        tokens_per_sec (Optional[float]): simulated generation speed.
+        function_calling (bool): whether to advertise function calling. If False,
+            `load_meta_agent` uses the ReAct agent instead of the OpenAI agent.
+
+    """
+
+    mode: str = Field(default="echo", description="'echo' or 'script'.")
+    script: List[Any] = Field(default_factory=list, description="Script steps.")
+    latency: float = Field(default=0.0, description="Time to first token (s).")
+    tokens_per_sec: Optional[float] = Field(
+        default=None, description="Generation speed (tokens/s). None = instant."
+    )
+    function_calling: bool = Field(
+        default=True, description="Whether to advertise function calling."
+    )
+    context_window: int = Field(default=128000, description="Context window.")
+    echo_max_words: int = Field(
+        default=64, description="Max number of words echoed back."
+    )
+
+    _script_pos: int = PrivateAttr(default=0)
+    _script_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(
+        self,
+        mode: str = "echo",
+        script: Optional[List[ScriptStep]] = None,
+        latency: Optional[float] = None,
+        tokens_per_sec: Optional[float] = None,
+        function_calling: bool = True,
+        **kwargs: Any,
+    ) -> None:
+        """Init params."""
+        if mode not in ("echo", "script"):
+            raise ValueError(f"Offline LLM mode {mode} not recognized.")
+        kwargs.setdefault("model", f"offline-{mode}")
+        kwargs.setdefault("api_key", "offline")
+        super().__init__(
+            mode=mode,
+            script=script or [],
+            latency=(
+                latency
+                if latency is not None
+                else _env_float(OFFLINE_LATENCY_ENV_VAR, 0.0)
+            ),
+            tokens_per_sec=(
+                tokens_per_sec
+                if tokens_per_sec is not None
+                else _env_float(OFFLINE_TOKENS_PER_SEC_ENV_VAR, None)
+            ),
+            function_calling=function_calling,
+            **kwargs,
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "offline_llm"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(
+            context_window=self.context_window,
+            num_output=self.max_tokens or -1,
+            is_chat_model=True,
+            is_function_calling_model=self.function_calling,
+            model_name=self.model,
+        )
+
+    @property
+    def _tokenizer(self) -> None:
+        return None
+
+    def reset_script(self) -> None:
+        """Start playing the script from the beginning again."""
+        with self._script_lock:
+            self._script_pos = 0
+
+    ### response generation ###
+
+    def _next_script_step(self) -> Optional[ScriptStep]:
+        if self.mode != "script":
+            return None
+        with self._script_lock:
+            if self._script_pos >= len(self.script):
+                return None
+            step = self.script[self._script_pos]
+            self._script_pos += 1
+        return step
+
+    def _echo(self, messages: Sequence[ChatMessage]) -> str:
+        last_message = next(
+            (
+                m
+                for m in reversed(messages)
+                if m.role in (MessageRole.USER, MessageRole.TOOL)
+            ),
+            None,
+        )
+        content = str(last_message.content or "") if last_message else ""
+        words = content.split()
+        return " ".join(words[: self.echo_max_words])
+
+    def _make_tool_calls(
+        self, calls: List[Dict[str, Any]]
+    ) -> List[ChatCompletionMessageToolCall]:
+        return [
+            ChatCompletionMessageToolCall(
+                id=f"call_{uuid.uuid4().hex[:24]}",
+                type="function",
+                function=Function(
+                    name=call["tool"], arguments=json.dumps(call.get("arguments", {}))
+                ),
+            )
+            for call in calls
+        ]
+
+    def _echo_tool_call(
+        self, messages: Sequence[ChatMessage], tools: List[Dict[str, Any]]
+    ) -> Optional[Dict[str, Any]]:
+        """In echo mode, call the first tool once per user turn with the message."""
+        if not messages or messages[-1].role != MessageRole.USER:
+            return None
+        fn_schema = tools[0].get("function", {})
+        parameters = fn_schema.get("parameters", {})
+        properties = parameters.get("properties", {})
+        arguments = {
+            name: self._echo(messages)
+            for name in parameters.get("required", [])
+            if properties.get(name, {}).get("type", "string") == "string"
+        }
+        return {"tool": fn_schema.get("name"), "arguments": arguments}
+
+    def _respond(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatMessage:
+        """Decide on the next assistant message."""
+        tools = kwargs.get("tools") or []
+        is_react = any(
+            m.role == MessageRole.SYSTEM and _REACT_MARKER in str(m.content)
+            for m in messages
+        )
+        step = self._next_script_step()
+        if step is None and tools and self.mode == "echo":
+            step = self._echo_tool_call(messages, tools)
+
+        if step is None:
+            text = self._echo(messages)
+            if is_react:
+                text = (
+                    "Thought: I can answer without using any more tools.\n"
+                    f"Answer: {text}"
+                )
+            return ChatMessage(role=MessageRole.ASSISTANT, content=text)
+        if isinstance(step, str):
+            if is_react and not step.startswith("Thought:"):
+                step = (
+                    "Thought: I can answer without using any more tools.\n"
+                    f"Answer: {step}"
+                )
+            return ChatMessage(role=MessageRole.ASSISTANT, content=step)
+
+        calls = step if isinstance(step, list) else [step]
+        if is_react:
+            # the ReAct format only supports one action per step
+            call = calls[0]
+            return ChatMessage(
+                role=MessageRole.ASSISTANT,
+                content=(
+                    "Thought: I need to use a tool to help me answer the question.\n"
+                    f"Action: {call['tool']}\n"
+                    f"Action Input: {json.dumps(call.get('arguments', {}))}"
+                ),
+            )
+        return ChatMessage(
+            role=MessageRole.ASSISTANT,
+            content=None,
+            additional_kwargs={"tool_calls": self._make_tool_calls(calls)},
+        )
+
+    def _usage(self, messages: Sequence[ChatMessage], message: ChatMessage) -> Dict:
+        prompt_tokens = sum(len(str(m.content or "").split()) for m in messages)
+        completion_tokens = len(str(message.content or "").split())
+        return {
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+        }
+
+    def _generation_time(self, message: ChatMessage) -> float:
+        if not self.tokens_per_sec:
+            return 0.0
+        return len(str(message.content or "").split()) / self.tokens_per_sec
+
+    def _stream_deltas(self, message: ChatMessage) -> List[str]:
+        # tool calls are sent in one chunk (agents check the first chunk for them)
+        if message.content is None or "tool_calls" in message.additional_kwargs:
+            return [message.content or ""]
+        words = message.content.split(" ")
+        return [w if i == 0 else " " + w for i, w in enumerate(words)]
+
+    ### OpenAI overrides ###
+
+    def _chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        message = self._respond(messages, **kwargs)
+        time.sleep(self.latency + self._generation_time(message))
+        return ChatResponse(message=message, raw=self._usage(messages, message))
+
+    def _stream_chat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponseGen:
+        message = self._respond(messages, **kwargs)
+        deltas = self._stream_deltas(message)
+        delay = self._generation_time(message) / max(len(deltas), 1)
+
+        def gen() -> ChatResponseGen:
+            time.sleep(self.latency)
+            content = ""
+            for delta in deltas:
+                time.sleep(delay)
+                content += delta
+                yield ChatResponse(
+                    message=ChatMessage(
+                        role=MessageRole.ASSISTANT,
+                        content=content,
+                        additional_kwargs=message.additional_kwargs,
+                    ),
+                    delta=delta,
+                    raw=self._usage(messages, message),
+                )
+
+        return gen()
+
+    async def _achat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponse:
+        message = self._respond(messages, **kwargs)
+        await asyncio.sleep(self.latency + self._generation_time(message))
+        return ChatResponse(message=message, raw=self._usage(messages, message))
+
+    async def _astream_chat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponseAsyncGen:
+        message = self._respond(messages, **kwargs)
+        deltas = self._stream_deltas(message)
+        delay = self._generation_time(message) / max(len(deltas), 1)
+
+        async def gen() -> ChatResponseAsyncGen:
+            await asyncio.sleep(self.latency)
+            content = ""
+            for delta in deltas:
+                await asyncio.sleep(delay)
+                content += delta
+                yield ChatResponse(
+                    message=ChatMessage(
+                        role=MessageRole.ASSISTANT,
+                        content=content,
+                        additional_kwargs=message.additional_kwargs,
+                    ),
+                    delta=delta,
+                    raw=self._usage(messages, message),
+                )
+
+        return gen()
+
+
+def resolve_offline_llm(llm_str: str) -> OfflineLLM:
+    """Resolve an offline LLM string.
+
+    - "offline" / "offline:echo": echo LLM with function calling
+    - "offline:react": echo LLM without function calling (ReAct agent path)
+    - anything else (in offline mode): echo LLM with function calling
+
+    """
+    tokens = llm_str.split(":")
+    if tokens[0] == "offline" and len(tokens) > 1 and tokens[1] == "react":
+        return OfflineLLM(function_calling=False)
+    return OfflineLLM()
+
+
+def resolve_offline_embed_model(embed_model_str: str) -> HashEmbedding:
+    """Resolve an offline embedding model string ("offline:hash[:<dim>]")."""
+    tokens = embed_model_str.split(":")
+    if tokens[0] == "offline" and len(tokens) > 2:
+        return HashEmbedding(dim=int(tokens[2]))
+    return HashEmbedding()
@@ -1,24 +1,68 @@
 """Param cache."""
 
 from pydantic import BaseModel, Field
-from llama_index.core import (
-    VectorStoreIndex,
-    StorageContext,
-    load_index_from_storage,
-)
-from typing import List, cast, Optional
+from llama_index.core import VectorStoreIndex
+from typing import Any, Callable, Dict, List, Tuple, cast, Optional
 from llama_index.core.chat_engine.types import BaseChatEngine
+from collections import OrderedDict
 from pathlib import Path
 import json
+import os
+import threading
 import uuid
 from core.utils import (
-    load_data,
+    load_data_sources,
     get_tool_objects,
     construct_agent,
     RAGParams,
     construct_mm_agent,
+    _resolve_embed_model,
+)
+from core.atomic_io import staged_dir
+from core.corpus_store import CORPORA_DIR_NAME, CorpusStore, get_corpus_store
+from core.compact import (
+    DocumentRef,
+    get_memory_report,
+    load_index,
+    make_doc_refs,
+    persist_storage,
+    rehydrate_docs,
 )
 
+# indexes / docs of loaded agent caches, shared by all sessions of the process
+# (agents and their memory are still built per load). Keyed by cache dir and
+# version of its cache.json, so that a replaced cache is loaded again.
+LOADED_CACHES_SIZE = 16
+_LOADED_CACHES: "OrderedDict[Tuple, Tuple[VectorStoreIndex, List]]" = OrderedDict()
+_LOADED_CACHES_LOCK = threading.Lock()
+_LOADED_CACHE_LOCKS: Dict[Tuple, threading.Lock] = {}
+
+
+def _get_loaded(
+    key: Tuple, load_fn: Callable[[], Tuple[VectorStoreIndex, List]]
+) -> Tuple[VectorStoreIndex, List]:
+    """Get index / docs of a cache version, loaded once with load_fn."""
+    with _LOADED_CACHES_LOCK:
+        key_lock = _LOADED_CACHE_LOCKS.setdefault(key, threading.Lock())
+    # other sessions loading the same cache wait instead of loading it again
+    with key_lock:
+        with _LOADED_CACHES_LOCK:
+            if key in _LOADED_CACHES:
+                _LOADED_CACHES.move_to_end(key)
+                return _LOADED_CACHES[key]
+        try:
+            loaded = load_fn()
+        except BaseException:
+            with _LOADED_CACHES_LOCK:
+                _LOADED_CACHE_LOCKS.pop(key, None)
+            raise
+        with _LOADED_CACHES_LOCK:
+            _LOADED_CACHES[key] = loaded
+            while len(_LOADED_CACHES) > LOADED_CACHES_SIZE:
+                _LOADED_CACHES.popitem(last=False)
+            _LOADED_CACHE_LOCKS.pop(key, None)
+        return loaded
+
 
 class ParamCache(BaseModel):
     """Cache for RAG agent builder.
@@ -64,12 +108,59 @@ class ParamCache(BaseModel):
     vector_index: Optional[VectorStoreIndex] = Field(
         default=None, description="Vector index for RAG agent."
     )
+    corpus_id: Optional[str] = Field(
+        default=None,
+        description=(
+            "Id of the shared corpus the vector index comes from (if any). "
+            "If set, the index is stored in the corpus store, not with the agent."
+        ),
+    )
     agent_id: str = Field(
         default_factory=lambda: f"Agent_{str(uuid.uuid4())}",
         description="Agent ID for RAG agent.",
     )
     agent: Optional[BaseChatEngine] = Field(default=None, description="RAG agent.")
 
+    def create_agent(
+        self, msg_handler: Optional[Callable[[str], None]] = None
+    ) -> BaseChatEngine:
+        """Create a new agent over the cached vector index.
+
+        The new agent has its own conversation memory, so one cache can serve
+        several independent conversations without re-indexing.
+
+        """
+        if self.vector_index is None:
+            raise ValueError("Must specify vector index in order to create agent.")
+        if self.builder_type == "multimodal":
+            # multimodal chat engine has no conversation state, share it
+            if self.agent is None:
+                raise ValueError("Must specify agent for multimodal builder.")
+            return self.agent
+        agent, _ = construct_agent(
+            cast(str, self.system_prompt),
+            self.rag_params,
+            self.docs,
+            vector_index=self.vector_index,
+            additional_tools=get_tool_objects(self.tools),
+            agent_id=self.agent_id,
+            msg_handler=msg_handler,
+        )
+        return agent
+
+    def compact(self) -> None:
+        """Replace indexed documents by references (if `compact_memory` is set)."""
+        if self.rag_params.compact_memory and self.vector_index is not None:
+            self.docs = make_doc_refs(self.docs)
+
+    def load_docs(self) -> List:
+        """Get documents, loading them from disk if compacted."""
+        return rehydrate_docs(self.docs)
+
+    def get_memory_report(self) -> Dict[str, Any]:
+        """Get approximate memory used by documents and index."""
+        return get_memory_report(self.docs, self.vector_index)
+
     def save_to_disk(self, save_dir: str) -> None:
         """Save cache to disk."""
         # NOTE: more complex than just calling dict() because we want to
@@ -85,55 +176,105 @@ class ParamCache(BaseModel):
             "rag_params": self.rag_params.dict(),
             "builder_type": self.builder_type,
             "agent_id": self.agent_id,
+            "corpus_id": self.corpus_id,
         }
-        # store the vector store within the agent
+        # store the vector store within the agent, unless it's a shared corpus
         if self.vector_index is None:
             raise ValueError("Must specify vector index in order to save.")
-        self.vector_index.storage_context.persist(Path(save_dir) / "storage")
+        # in compact mode, save the doc references (no need to reload the docs)
+        doc_refs = [doc for doc in self.docs if isinstance(doc, DocumentRef)]
+        if doc_refs:
+            dict_to_serialize["doc_refs"] = [doc_ref.dict() for doc_ref in doc_refs]
 
-        # if save_path directories don't exist, create it
-        if not Path(save_dir).exists():
-            Path(save_dir).mkdir(parents=True)
-        with open(Path(save_dir) / "cache.json", "w") as f:
-            json.dump(dict_to_serialize, f)
-
-    @classmethod
-    def load_from_disk(
-        cls,
-        save_dir: str,
-    ) -> "ParamCache":
-        """Load cache from disk."""
-        with open(Path(save_dir) / "cache.json", "r") as f:
-            cache_dict = json.load(f)
+        # staged, so that a crash (or a concurrent save) never leaves a partial
+        # cache: save_dir has the previous version until this one is complete
+        with staged_dir(save_dir) as staging_dir:
+            if self.corpus_id is None:
+                persist_storage(self.vector_index, staging_dir / "storage")
+            with open(staging_dir / "cache.json", "w") as f:
+                json.dump(dict_to_serialize, f)
 
-        storage_context = StorageContext.from_defaults(
-            persist_dir=str(Path(save_dir) / "storage")
-        )
-        if cache_dict["builder_type"] == "multimodal":
+    @staticmethod
+    def _load_index_and_docs(
+        save_dir: str, cache_dict: Dict[str, Any], corpus_store: Optional[CorpusStore]
+    ) -> Tuple[VectorStoreIndex, List]:
+        """Load index and docs of a cache (see `load_from_disk`)."""
+        corpus_id = cache_dict.get("corpus_id")
+        if corpus_id is not None:
+            corpus_store = corpus_store or get_corpus_store(
+                Path(save_dir).parent / CORPORA_DIR_NAME
+            )
+            vector_index = corpus_store.get_index(
+                corpus_id, cache_dict["rag_params"].embed_model
+            )
+        elif cache_dict["builder_type"] == "multimodal":
             from llama_index.indices.multi_modal.base import MultiModalVectorStoreIndex
 
             vector_index: VectorStoreIndex = cast(
-                MultiModalVectorStoreIndex, load_index_from_storage(storage_context)
+                MultiModalVectorStoreIndex, load_index(Path(save_dir) / "storage")
             )
         else:
+            # query with the same embedding model the index was built with
             vector_index = cast(
-                VectorStoreIndex, load_index_from_storage(storage_context)
+                VectorStoreIndex,
+                load_index(
+                    Path(save_dir) / "storage",
+                    embed_model=_resolve_embed_model(
+                        cache_dict["rag_params"].embed_model
+                    ),
+                ),
             )
 
+        # load docs (once per process for shared corpora)
+        doc_refs = cache_dict.get("doc_refs")
+        if doc_refs is not None and cache_dict["rag_params"].compact_memory:
+            # compact mode: only reload docs that can't be referenced (urls)
+            docs = [DocumentRef(**doc_ref) for doc_ref in doc_refs]
+            docs += load_data_sources(urls=cache_dict["urls"])
+        elif corpus_id is not None:
+            assert corpus_store is not None
+            docs = corpus_store.load_docs(corpus_id)
+        else:
+            docs = load_data_sources(
+                file_names=cache_dict["file_names"],
+                urls=cache_dict["urls"],
+                directory=cache_dict["directory"],
+            )
+        return vector_index, docs
+
+    @classmethod
+    def load_from_disk(
+        cls,
+        save_dir: str,
+        corpus_store: Optional[CorpusStore] = None,
+    ) -> "ParamCache":
+        """Load cache from disk.
+
+        Shared corpora are looked up in `corpus_store` (by default, the store of
+        the registry directory containing save_dir).
+
+        """
+        with open(Path(save_dir) / "cache.json", "r") as f:
+            # same file as the one read, even if the cache is replaced meanwhile
+            stat = os.fstat(f.fileno())
+            cache_dict = json.load(f)
+
         # replace rag params with RAGParams object
         cache_dict["rag_params"] = RAGParams(**cache_dict["rag_params"])
 
-        # add in the missing fields
-        # load docs
-        cache_dict["docs"] = load_data(
-            file_names=cache_dict["file_names"],
-            urls=cache_dict["urls"],
-            directory=cache_dict["directory"],
+        key = (str(Path(save_dir).resolve()), stat.st_ino, stat.st_mtime_ns)
+        vector_index, docs = _get_loaded(
+            key, lambda: cls._load_index_and_docs(save_dir, cache_dict, corpus_store)
         )
+        cache_dict.pop("doc_refs", None)
+        cache_dict["docs"] = list(docs)
+
         # load agent from index
         additional_tools = get_tool_objects(cache_dict["tools"])
 
         if cache_dict["builder_type"] == "multimodal":
+            from llama_index.indices.multi_modal.base import MultiModalVectorStoreIndex
+
             vector_index = cast(MultiModalVectorStoreIndex, vector_index)
             agent, _ = construct_mm_agent(
                 cache_dict["system_prompt"],
@@ -148,9 +289,12 @@ class ParamCache(BaseModel):
                 cache_dict["docs"],
                 vector_index=vector_index,
                 additional_tools=additional_tools,
+                agent_id=cache_dict["agent_id"],
                 # TODO: figure out tools
             )
         cache_dict["vector_index"] = vector_index
         cache_dict["agent"] = agent
 
-        return cls(**cache_dict)
+        cache = cls(**cache_dict)
+        cache.compact()
+        return cache
@@ -0,0 +1,402 @@
+"""Node postprocessors applied between retrieval and the LLM.
+
+- `BatchedRerank`: re-scores the retrieved candidates with a reranker (a
+  cross-encoder, or any scorer function) and keeps the best `top_n`. The
+  retriever over-fetches `rerank_fetch_k` candidates (see `get_retriever`), so
+  the LLM prompt stays at `top_k` chunks while the chunks are better ones.
+- `AdaptiveTopK`: keeps a variable number of chunks per query, cutting the
+  list at a score threshold or at a large score gap.
+- `ContextPacker`: drops near-duplicate chunks and repeated metadata, and
+  packs the chunks into a token budget.
+
+Rerankers are selected with a string, like LLMs / embedding models:
+
+- `cross-encoder:<model>` (or just `<model>`): a sentence-transformers
+  cross-encoder, e.g. `cross-encoder:cross-encoder/ms-marco-MiniLM-L-6-v2`
+- `offline:overlap`: word overlap between query and chunk, no model (any
+  reranker is replaced by it in offline mode)
+
+"""
+
+import functools
+import logging
+import math
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from llama_index.core.callbacks import CallbackManager, CBEventType, EventPayload
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import (
+    BaseNode,
+    MetadataMode,
+    NodeWithScore,
+    QueryBundle,
+    TextNode,
+)
+from llama_index.core.utils import get_tokenizer
+from pydantic import Field, PrivateAttr
+
+from core.offline import is_offline_mode
+
+logger = logging.getLogger(__name__)
+
+# scores of a batch of texts against a query
+RerankScorer = Callable[[str, Sequence[str]], List[float]]
+
+DEFAULT_RERANK_BATCH_SIZE = 32
+# (query, chunk) scores cached per reranker
+RERANK_CACHE_SIZE = 100_000
+TOKEN_COUNT_CACHE_SIZE = 16384
+# word n-grams compared to find near-duplicate chunks
+SHINGLE_SIZE = 3
+# a chunk is truncated to fit the context budget only if this much is left
+MIN_TRUNCATED_TOKENS = 64
+
+
+class ScoreCache:
+    """Thread-safe LRU cache of (query, chunk hash) -> score."""
+
+    def __init__(self, max_size: int = RERANK_CACHE_SIZE) -> None:
+        """Init params."""
+        self._max_size = max_size
+        self._scores: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, str]) -> Optional[float]:
+        """Get cached score, None if not cached."""
+        with self._lock:
+            score = self._scores.get(key)
+            if score is not None:
+                self._scores.move_to_end(key)
+            return score
+
+    def put(self, key: Tuple[str, str], score: float) -> None:
+        """Cache score, evicting the least recently used ones."""
+        with self._lock:
+            self._scores[key] = score
+            self._scores.move_to_end(key)
+            while len(self._scores) > self._max_size:
+                self._scores.popitem(last=False)
+
+
+class CrossEncoderScorer:
+    """Scores (query, text) pairs with a sentence-transformers cross-encoder."""
+
+    def __init__(self, model_name: str) -> None:
+        """Init params."""
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError:
+            raise ImportError(
+                "`sentence-transformers` package not found, please run "
+                "`pip install sentence-transformers` to use a cross-encoder "
+                "reranker."
+            )
+        self._model = CrossEncoder(model_name)
+        # models aren't guaranteed to be thread-safe
+        self._lock = threading.Lock()
+
+    def __call__(self, query: str, texts: Sequence[str]) -> List[float]:
+        with self._lock:
+            scores = self._model.predict(
+                [(query, text) for text in texts],
+                batch_size=len(texts),
+                show_progress_bar=False,
+            )
+        return [float(score) for score in scores]
+
+
+def _tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def overlap_scorer(query: str, texts: Sequence[str]) -> List[float]:
+    """Offline scorer: query words found in the text, length-normalized."""
+    query_words = set(_tokenize(query))
+    scores = []
+    for text in texts:
+        words = _tokenize(text)
+        matches = sum(1 for word in set(words) if word in query_words)
+        scores.append(matches / math.sqrt(len(words) + 1))
+    return scores
+
+
+# process-wide scorers (models are loaded once) and their score caches
+_SCORERS: Dict[str, Tuple[RerankScorer, ScoreCache]] = {}
+_SCORERS_LOCK = threading.Lock()
+
+
+def _resolve_scorer(reranker: str) -> Tuple[RerankScorer, ScoreCache]:
+    """Resolve reranker string to a scorer (with its score cache)."""
+    if reranker.split(":")[0] == "offline" or is_offline_mode():
+        reranker = "offline:overlap"
+    with _SCORERS_LOCK:
+        if reranker not in _SCORERS:
+            scorer: RerankScorer
+            if reranker == "offline:overlap":
+                scorer = overlap_scorer
+            elif reranker.startswith("cross-encoder:"):
+                scorer = CrossEncoderScorer(reranker[len("cross-encoder:") :])
+            else:
+                scorer = CrossEncoderScorer(reranker)
+            _SCORERS[reranker] = (scorer, ScoreCache())
+        return _SCORERS[reranker]
+
+
+class BatchedRerank(BaseNodePostprocessor):
+    """Rerank nodes with a scorer, in batches, keeping the top_n.
+
+    Scores are cached per (query, chunk content), so repeated questions (and
+    chunks retrieved again for follow-ups) aren't re-scored.
+
+    """
+
+    top_n: int = Field(default=2, description="Number of nodes to keep.")
+    batch_size: int = Field(
+        default=DEFAULT_RERANK_BATCH_SIZE, description="Pairs scored per call."
+    )
+
+    _scorer: RerankScorer = PrivateAttr()
+    _cache: ScoreCache = PrivateAttr()
+
+    def __init__(
+        self,
+        scorer: RerankScorer,
+        top_n: int = 2,
+        batch_size: int = DEFAULT_RERANK_BATCH_SIZE,
+        cache: Optional[ScoreCache] = None,
+        callback_manager: Optional[CallbackManager] = None,
+    ) -> None:
+        """Init params."""
+        super().__init__(
+            top_n=top_n,
+            batch_size=batch_size,
+            callback_manager=callback_manager or CallbackManager(),
+        )
+        self._scorer = scorer
+        self._cache = cache or ScoreCache()
+
+    @classmethod
+    def class_name(cls) -> str:
+        """Class name."""
+        return "BatchedRerank"
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if query_bundle is None or len(nodes) <= 1:
+            return nodes[: self.top_n]
+        query_str = query_bundle.query_str
+        with self.callback_manager.event(
+            CBEventType.RERANKING,
+            payload={
+                EventPayload.NODES: nodes,
+                EventPayload.QUERY_STR: query_str,
+                EventPayload.TOP_K: self.top_n,
+            },
+        ) as event:
+            keys = [(query_str, node.node.hash) for node in nodes]
+            scores = [self._cache.get(key) for key in keys]
+            missing = [i for i, score in enumerate(scores) if score is None]
+            for start in range(0, len(missing), self.batch_size):
+                batch = missing[start : start + self.batch_size]
+                batch_scores = self._scorer(
+                    query_str,
+                    [
+                        nodes[i].node.get_content(metadata_mode=MetadataMode.EMBED)
+                        for i in batch
+                    ],
+                )
+                for i, score in zip(batch, batch_scores):
+                    scores[i] = score
+                    self._cache.put(keys[i], score)
+
+            reranked = [
+                NodeWithScore(node=node.node, score=score)
+                for node, score in zip(nodes, scores)
+            ]
+            reranked.sort(key=lambda node: node.score or 0.0, reverse=True)
+            reranked = reranked[: self.top_n]
+            event.on_end(payload={EventPayload.NODES: reranked})
+        return reranked
+
+
+def get_reranker(
+    reranker: str,
+    top_n: int,
+    callback_manager: Optional[CallbackManager] = None,
+) -> BatchedRerank:
+    """Get rerank postprocessor for a reranker string (see module docstring)."""
+    scorer, cache = _resolve_scorer(reranker)
+    return BatchedRerank(
+        scorer, top_n=top_n, cache=cache, callback_manager=callback_manager
+    )
+
+
+class AdaptiveTopK(BaseNodePostprocessor):
+    """Keep between min_k and max_k nodes, cut at a score threshold or gap.
+
+    Nodes are sorted by score, and the list is cut before the first node past
+    min_k that scores below `similarity_cutoff`, or `score_gap` (relative to
+    the top score) below the previous node. The k chosen for each query is
+    reported as the top_k of a reranking event (see the metrics traces).
+
+    """
+
+    min_k: int = Field(default=1, description="Minimum number of nodes kept.")
+    max_k: int = Field(default=10, description="Maximum number of nodes kept.")
+    similarity_cutoff: Optional[float] = Field(
+        default=None, description="Nodes scoring below are cut (None: no cutoff)."
+    )
+    score_gap: Optional[float] = Field(
+        default=0.25,
+        description="Relative score drop the list is cut at (None: no gap cut).",
+    )
+
+    @classmethod
+    def class_name(cls) -> str:
+        """Class name."""
+        return "AdaptiveTopK"
+
+    def _get_k(self, scores: List[float]) -> int:
+        top_score = abs(scores[0]) or 1.0
+        for k in range(max(self.min_k, 1), min(self.max_k, len(scores))):
+            if self.similarity_cutoff is not None and (
+                scores[k] < self.similarity_cutoff
+            ):
+                return k
+            if self.score_gap is not None and (
+                (scores[k - 1] - scores[k]) / top_score >= self.score_gap
+            ):
+                return k
+        return min(self.max_k, len(scores))
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if not nodes:
+            return nodes
+        with self.callback_manager.event(
+            CBEventType.RERANKING, payload={EventPayload.NODES: nodes}
+        ) as event:
+            nodes = sorted(nodes, key=lambda node: node.score or 0.0, reverse=True)
+            k = self._get_k([node.score or 0.0 for node in nodes])
+            logger.debug("Adaptive top_k: kept %d of %d nodes", k, len(nodes))
+            event.on_end(payload={EventPayload.NODES: nodes[:k], EventPayload.TOP_K: k})
+        return nodes[:k]
+
+
+@functools.lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+def count_tokens(text: str) -> int:
+    """Count tokens with the default tokenizer, cached per text."""
+    return len(get_tokenizer()(text))
+
+
+def _get_shingles(text: str) -> Set[int]:
+    """Hashes of the word n-grams of a text."""
+    words = _tokenize(text)
+    if len(words) < SHINGLE_SIZE:
+        return {hash(" ".join(words))}
+    return {
+        hash(" ".join(words[i : i + SHINGLE_SIZE]))
+        for i in range(len(words) - SHINGLE_SIZE + 1)
+    }
+
+
+class ContextPacker(BaseNodePostprocessor):
+    """Pack retrieved nodes into a token budget for the LLM prompt.
+
+    Nodes are taken in order (best first), and:
+
+    - near-duplicates of a node already taken are dropped (Jaccard similarity
+      of their word n-grams above `duplicate_threshold`)
+    - metadata already shown with a previous node (e.g. the same file path) is
+      not repeated
+    - nodes are added while they fit in `token_budget` tokens; the first one
+      that doesn't is truncated if enough of the budget is left
+
+    Nodes are copied, the ones in the docstore are left untouched.
+
+    """
+
+    token_budget: int = Field(
+        default=3000, description="Maximum tokens of the packed context."
+    )
+    duplicate_threshold: float = Field(
+        default=0.8, description="Word n-gram Jaccard similarity of duplicates."
+    )
+
+    @classmethod
+    def class_name(cls) -> str:
+        """Class name."""
+        return "ContextPacker"
+
+    def _truncate(self, node: BaseNode, max_tokens: int) -> BaseNode:
+        """Copy of a text node, truncated to max_tokens (with its metadata)."""
+        content = node.get_content(metadata_mode=MetadataMode.LLM)
+        text = node.get_content(metadata_mode=MetadataMode.NONE)
+        num_tokens = count_tokens(content)
+        while num_tokens > max_tokens and text:
+            # cut proportionally, then re-count
+            text = text[: int(len(text) * max_tokens / num_tokens * 0.95)]
+            truncated = node.model_copy(update={"text": text})
+            num_tokens = count_tokens(
+                truncated.get_content(metadata_mode=MetadataMode.LLM)
+            )
+        return node.model_copy(update={"text": text})
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        packed: List[NodeWithScore] = []
+        packed_shingles: List[Set[int]] = []
+        shown_metadata: Set[Tuple[str, str]] = set()
+        num_tokens = 0
+        for node_with_score in nodes:
+            node = node_with_score.node
+            text = node.get_content(metadata_mode=MetadataMode.NONE)
+            shingles = _get_shingles(text)
+            if any(
+                len(shingles & other) / len(shingles | other)
+                >= self.duplicate_threshold
+                for other in packed_shingles
+            ):
+                continue
+
+            metadata_items = {
+                (key, str(value))
+                for key, value in node.metadata.items()
+                if key not in node.excluded_llm_metadata_keys
+            }
+            repeated_keys = [key for key, value in metadata_items & shown_metadata]
+            if repeated_keys:
+                node = node.model_copy(
+                    update={
+                        "excluded_llm_metadata_keys": (
+                            node.excluded_llm_metadata_keys + repeated_keys
+                        )
+                    }
+                )
+            node_tokens = count_tokens(node.get_content(metadata_mode=MetadataMode.LLM))
+            remaining = self.token_budget - num_tokens
+            if node_tokens > remaining:
+                if remaining < MIN_TRUNCATED_TOKENS or not isinstance(node, TextNode):
+                    break
+                node = self._truncate(node, remaining)
+                node_tokens = remaining
+
+            packed.append(NodeWithScore(node=node, score=node_with_score.score))
+            packed_shingles.append(shingles)
+            shown_metadata |= metadata_items
+            num_tokens += node_tokens
+            if num_tokens >= self.token_budget:
+                break
+        return packed
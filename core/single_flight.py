@@ -0,0 +1,344 @@
+"""Single-flight request coalescing.
+
+When several sessions ask the same agent the same question at the same time,
+only one of them actually runs retrieval / the LLM call. The others wait for
+that execution to finish and share its result.
+
+"""
+
+import asyncio
+import hashlib
+import json
+import re
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.response.schema import RESPONSE_TYPE
+from llama_index.core.chat_engine.types import (
+    AGENT_CHAT_RESPONSE_TYPE,
+    BaseChatEngine,
+    StreamingAgentChatResponse,
+)
+from llama_index.core.llms import ChatMessage
+from llama_index.core.prompts.mixin import PromptMixinType
+from llama_index.core.schema import QueryBundle
+
+from core.llm_scheduler import get_llm_scheduler
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query so trivially different spellings coalesce."""
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+def make_request_key(
+    kind: str,
+    agent_id: str,
+    query: str,
+    params: Optional[Dict[str, Any]] = None,
+    chat_history: Optional[List[ChatMessage]] = None,
+) -> str:
+    """Make a key identifying a request.
+
+    Two requests share an execution only if they are of the same kind (e.g. a
+    chat turn vs. a tool query), target the same agent, have the same normalized
+    query, the same params and (for chat) the same history.
+
+    NOTE: the kind matters, a chat turn typically makes a tool query with the
+    same text while it's in flight.
+
+    """
+    key_dict = {
+        "kind": kind,
+        "agent_id": agent_id,
+        "query": normalize_query(query),
+        "params": params or {},
+        "history": [
+            [str(message.role), str(message.content)] for message in chat_history or []
+        ],
+    }
+    key_str = json.dumps(key_dict, sort_keys=True, default=str)
+    return hashlib.sha256(key_str.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    """An in-flight execution that waiters can attach to."""
+
+    def __init__(self) -> None:
+        """Init params."""
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesce identical concurrent calls into one execution.
+
+    Thread-safe: Streamlit runs every session in its own script thread, so the
+    leader / follower hand-off is done with a lock and a per-call event.
+
+    """
+
+    def __init__(self) -> None:
+        """Init params."""
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._executions = 0
+        self._merged = 0
+
+    def _join(self, key: str) -> Tuple[_Call, bool]:
+        """Join an in-flight call for key, or register a new one.
+
+        Returns the call and whether the caller is the leader.
+
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self._merged += 1
+                return call, False
+            call = _Call()
+            self._calls[key] = call
+            self._executions += 1
+            return call, True
+
+    def _finish(self, key: str, call: _Call) -> None:
+        """Unregister call and wake up its waiters."""
+        with self._lock:
+            self._calls.pop(key, None)
+        call.done.set()
+
+    @staticmethod
+    def _get_result(call: _Call) -> Any:
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """Run fn once for all concurrent callers with the same key."""
+        call, is_leader = self._join(key)
+        if not is_leader:
+            call.done.wait()
+            return self._get_result(call)
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._finish(key, call)
+        return call.result
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Async version of `do`.
+
+        Followers may live on a different event loop than the leader (each
+        Streamlit session has its own), so they wait on the thread event in an
+        executor instead of sharing an asyncio future.
+
+        """
+        call, is_leader = self._join(key)
+        if not is_leader:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, call.done.wait)
+            return self._get_result(call)
+
+        try:
+            # LLM calls aren't rate limited on the event loop, see `LLMScheduler`
+            await get_llm_scheduler().await_capacity()
+            call.result = await fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._finish(key, call)
+        return call.result
+
+    def get_metrics(self) -> Dict[str, int]:
+        """Get coalescing metrics.
+
+        - executions: number of calls that actually ran
+        - merged: number of calls that were served by another call's execution
+        - in_flight: number of executions currently running
+
+        """
+        with self._lock:
+            return {
+                "executions": self._executions,
+                "merged": self._merged,
+                "in_flight": len(self._calls),
+            }
+
+    def reset_metrics(self) -> None:
+        """Reset counters."""
+        with self._lock:
+            self._executions = 0
+            self._merged = 0
+
+
+# process-wide instance, shared by all sessions
+_SINGLE_FLIGHT = SingleFlight()
+
+
+def get_single_flight() -> SingleFlight:
+    """Get process-wide single-flight instance."""
+    return _SINGLE_FLIGHT
+
+
+class SingleFlightQueryEngine(BaseQueryEngine):
+    """Query engine that coalesces identical concurrent queries.
+
+    Used in front of the tool query engines (e.g. `vector_tool`).
+
+    """
+
+    def __init__(
+        self,
+        query_engine: BaseQueryEngine,
+        agent_id: str,
+        params: Optional[Dict[str, Any]] = None,
+        single_flight: Optional[SingleFlight] = None,
+    ) -> None:
+        """Init params."""
+        self._query_engine = query_engine
+        self._agent_id = agent_id
+        self._params = params or {}
+        self._single_flight = single_flight or get_single_flight()
+        super().__init__(callback_manager=query_engine.callback_manager)
+
+    def _get_prompt_modules(self) -> PromptMixinType:
+        """Get prompt sub-modules."""
+        return {"query_engine": self._query_engine}
+
+    def _get_key(self, query_bundle: QueryBundle) -> str:
+        return make_request_key(
+            "query", self._agent_id, query_bundle.query_str, params=self._params
+        )
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        """Answer a query."""
+        return self._single_flight.do(
+            self._get_key(query_bundle),
+            lambda: self._query_engine.query(query_bundle),
+        )
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        """Answer a query."""
+        return await self._single_flight.ado(
+            self._get_key(query_bundle),
+            lambda: self._query_engine.aquery(query_bundle),
+        )
+
+
+class SingleFlightChatEngine(BaseChatEngine):
+    """Chat engine that coalesces identical concurrent chat turns.
+
+    Only turns with the same message *and* the same conversation history are
+    merged. The followers still record the turn in their own memory so that
+    follow-up questions see it.
+
+    Streaming turns are passed through as-is: a token stream can only be
+    consumed once.
+
+    """
+
+    def __init__(
+        self,
+        chat_engine: BaseChatEngine,
+        agent_id: str,
+        params: Optional[Dict[str, Any]] = None,
+        single_flight: Optional[SingleFlight] = None,
+    ) -> None:
+        """Init params."""
+        self._chat_engine = chat_engine
+        self._agent_id = agent_id
+        self._params = params or {}
+        self._single_flight = single_flight or get_single_flight()
+
+    @property
+    def chat_engine(self) -> BaseChatEngine:
+        """Wrapped chat engine."""
+        return self._chat_engine
+
+    def __getattr__(self, name: str) -> Any:
+        # expose attributes of the wrapped engine (e.g. `memory`, `callback_manager`)
+        if name.startswith("__") or name == "_chat_engine":
+            raise AttributeError(name)
+        return getattr(self._chat_engine, name)
+
+    def reset(self) -> None:
+        """Reset conversation state."""
+        self._chat_engine.reset()
+
+    @property
+    def chat_history(self) -> List[ChatMessage]:
+        return self._chat_engine.chat_history
+
+    def _get_key(self, message: str, chat_history: Optional[List[ChatMessage]]) -> str:
+        history = (
+            chat_history if chat_history is not None else self._chat_engine.chat_history
+        )
+        return make_request_key(
+            "chat", self._agent_id, message, params=self._params, chat_history=history
+        )
+
+    def _record_turn(self, message: str, response: AGENT_CHAT_RESPONSE_TYPE) -> None:
+        """Record a turn that was answered by another session's execution."""
+        memory = getattr(self._chat_engine, "memory", None) or getattr(
+            self._chat_engine, "_memory", None
+        )
+        if memory is None:
+            return
+        memory.put(ChatMessage(role="user", content=message))
+        memory.put(ChatMessage(role="assistant", content=str(response)))
+
+    def chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> AGENT_CHAT_RESPONSE_TYPE:
+        """Main chat interface."""
+        ran_here = False
+
+        def _run() -> AGENT_CHAT_RESPONSE_TYPE:
+            nonlocal ran_here
+            ran_here = True
+            return self._chat_engine.chat(message, chat_history=chat_history)
+
+        response = self._single_flight.do(self._get_key(message, chat_history), _run)
+        if not ran_here:
+            self._record_turn(message, response)
+        return response
+
+    def stream_chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> StreamingAgentChatResponse:
+        """Stream chat interface."""
+        return self._chat_engine.stream_chat(message, chat_history=chat_history)
+
+    async def achat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> AGENT_CHAT_RESPONSE_TYPE:
+        """Async version of main chat interface."""
+        ran_here = False
+
+        async def _run() -> AGENT_CHAT_RESPONSE_TYPE:
+            nonlocal ran_here
+            ran_here = True
+            return await self._chat_engine.achat(message, chat_history=chat_history)
+
+        response = await self._single_flight.ado(
+            self._get_key(message, chat_history), _run
+        )
+        if not ran_here:
+            self._record_turn(message, response)
+        return response
+
+    async def astream_chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> StreamingAgentChatResponse:
+        """Async version of main chat interface."""
+        await get_llm_scheduler().await_capacity()
+        return await self._chat_engine.astream_chat(message, chat_history=chat_history)
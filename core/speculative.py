@@ -0,0 +1,153 @@
+"""Speculative retrieval for the condense + context chat engine.
+
+`CondensePlusContextChatEngine` first asks the LLM to condense the chat
+history and the new message into a standalone question, then retrieves with
+it: a full LLM round-trip before retrieval can start. Follow-ups that already
+stand on their own condense to (almost) the message itself, so
+`SpeculativeCondensePlusContextChatEngine` retrieves with the raw message while
+the condense call runs, and keeps those results if the condensed question is
+close enough to the message (word Jaccard similarity), else retrieves again.
+
+"""
+
+import asyncio
+import contextvars
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional, Set, Tuple
+
+from llama_index.core.chat_engine import CondensePlusContextChatEngine
+from llama_index.core.llms import ChatMessage
+from llama_index.core.response_synthesizers import CompactAndRefine
+from llama_index.core.schema import NodeWithScore
+from llama_index.core.tools import ToolOutput
+
+from core.llm_scheduler import get_llm_scheduler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REUSE_THRESHOLD = 0.6
+
+# speculative retrievals, shared by all chat engines of the process
+_SPECULATIVE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix="speculative"
+)
+
+
+def _get_words(text: str) -> Set[str]:
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def get_query_similarity(query: str, other_query: str) -> float:
+    """Jaccard similarity of the words of two queries."""
+    words, other_words = _get_words(query), _get_words(other_query)
+    if not words and not other_words:
+        return 1.0
+    return len(words & other_words) / len(words | other_words)
+
+
+class SpeculativeCondensePlusContextChatEngine(CondensePlusContextChatEngine):
+    """Condense + context chat engine retrieving while the question condenses.
+
+    Set `reuse_threshold` (after `from_defaults`) to tune how close the
+    condensed question must be to the message for the speculative results to
+    be used.
+
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        """Init params."""
+        super().__init__(*args, **kwargs)
+        self.reuse_threshold = DEFAULT_REUSE_THRESHOLD
+
+    def _get_context_source(
+        self, condensed_question: str, context_nodes: List[NodeWithScore]
+    ) -> ToolOutput:
+        return ToolOutput(
+            tool_name="retriever",
+            content=str(context_nodes),
+            raw_input={"message": condensed_question},
+            raw_output=context_nodes,
+        )
+
+    def _reuse(self, message: str, condensed_question: str) -> bool:
+        similarity = get_query_similarity(message, condensed_question)
+        logger.debug(
+            "Condensed question similarity %.2f: %s", similarity, condensed_question
+        )
+        return similarity >= self.reuse_threshold
+
+    def _run_c3(
+        self,
+        message: str,
+        chat_history: Optional[List[ChatMessage]] = None,
+        streaming: bool = False,
+    ) -> Tuple[CompactAndRefine, ToolOutput, List[NodeWithScore]]:
+        if chat_history is not None:
+            self._memory.set(chat_history)
+
+        chat_history = self._memory.get(input=message)
+        if self._skip_condense or len(chat_history) == 0:
+            # nothing to condense, no LLM call to overlap with
+            condensed_question = message
+            context_nodes = self._get_nodes(message)
+        else:
+            # in the current context, so that retrieval is traced with the turn
+            speculative_nodes = _SPECULATIVE_EXECUTOR.submit(
+                contextvars.copy_context().run, self._get_nodes, message
+            )
+            try:
+                condensed_question = self._condense_question(chat_history, message)
+            except BaseException:
+                speculative_nodes.cancel()
+                raise
+            logger.info(f"Condensed question: {condensed_question}")
+            if self._reuse(message, condensed_question):
+                context_nodes = speculative_nodes.result()
+            else:
+                speculative_nodes.cancel()
+                context_nodes = self._get_nodes(condensed_question)
+
+        return (
+            self._get_response_synthesizer(chat_history, streaming=streaming),
+            self._get_context_source(condensed_question, context_nodes),
+            context_nodes,
+        )
+
+    async def _arun_c3(
+        self,
+        message: str,
+        chat_history: Optional[List[ChatMessage]] = None,
+        streaming: bool = False,
+    ) -> Tuple[CompactAndRefine, ToolOutput, List[NodeWithScore]]:
+        if chat_history is not None:
+            self._memory.set(chat_history)
+        # LLM calls aren't rate limited on the event loop, see `LLMScheduler`
+        await get_llm_scheduler().await_capacity()
+
+        chat_history = self._memory.get(input=message)
+        if self._skip_condense or len(chat_history) == 0:
+            condensed_question = message
+            context_nodes = await self._aget_nodes(message)
+        else:
+            speculative_nodes = asyncio.ensure_future(self._aget_nodes(message))
+            try:
+                condensed_question = await self._acondense_question(
+                    chat_history, message
+                )
+            except BaseException:
+                speculative_nodes.cancel()
+                raise
+            logger.info(f"Condensed question: {condensed_question}")
+            if self._reuse(message, condensed_question):
+                context_nodes = await speculative_nodes
+            else:
+                speculative_nodes.cancel()
+                context_nodes = await self._aget_nodes(condensed_question)
+
+        return (
+            self._get_response_synthesizer(chat_history, streaming=streaming),
+            self._get_context_source(condensed_question, context_nodes),
+            context_nodes,
+        )
@@ -1,5 +1,6 @@
 import os
-from typing import List, cast, Optional, Dict, Tuple, Any
+from pathlib import Path
+from typing import List, cast, Optional, Dict, Tuple, Any, Callable, Union
 
 import streamlit as st
 from pydantic import BaseModel, Field
@@ -26,12 +27,39 @@ from llama_index.llms.replicate import Replicate
 from llama_index.core.llms.utils import resolve_llm
 from llama_index.core.llms import LLM
 from llama_index.core.tools import QueryEngineTool, ToolMetadata
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import TransformComponent
 
 # Custom config import
 from core.builder_config import BUILDER_LLM
 
 from llama_index.core.callbacks import CallbackManager, trace_method
-from core.callback_manager import StreamlitFunctionsCallbackHandler
+from core.callback_manager import (
+    StreamlitFunctionsCallbackHandler,
+    get_metrics_handler,
+)
+from core.single_flight import SingleFlightChatEngine, SingleFlightQueryEngine
+from core.compact import DocOrRef, get_storage_context, rehydrate_docs
+from core.vector_stores import get_vector_store
+from core.memory import SummaryWindowMemory
+from core.speculative import SpeculativeCondensePlusContextChatEngine
+from core.postprocessors import AdaptiveTopK, ContextPacker, get_reranker
+from core.metadata_index import (
+    CSVRowNodeParser,
+    MetadataFilteringRetriever,
+    MetadataIndex,
+    get_metadata_index,
+    set_metadata_index,
+)
+from core.offline import (
+    is_offline_mode,
+    resolve_offline_llm,
+    resolve_offline_embed_model,
+)
+from llama_index.core.base.embeddings.base import BaseEmbedding
 from llama_index.core.schema import ImageNode, NodeWithScore
 
 ### BETA: Multi-modal
@@ -74,6 +102,130 @@ class RAGParams(BaseModel):
     llm: str = Field(
         default="gpt-4o", description="LLM to use for summarization."
     )
+    compact_memory: bool = Field(
+        default=False,
+        description=(
+            "Whether to drop the loaded documents once indexed (keeping only "
+            "references to reload them from disk when needed)."
+        ),
+    )
+    compress_docstore: bool = Field(
+        default=False,
+        description="Whether to keep the indexed text compressed (in memory / disk).",
+    )
+    embedding_precision: str = Field(
+        default="float32",
+        description="Precision embeddings are stored at: float32, float16 or int8.",
+    )
+    embedding_dim: Optional[int] = Field(
+        default=None,
+        description=(
+            "Number of leading embedding dimensions to keep (only for embedding "
+            "models that support truncation). Defaults to all."
+        ),
+    )
+    full_precision_rerank: bool = Field(
+        default=False,
+        description=(
+            "Whether to re-score the top candidates with full precision embeddings "
+            "(kept on disk), when embeddings are stored at reduced precision."
+        ),
+    )
+    index_type: str = Field(
+        default="flat",
+        description=(
+            "Vector index type: flat (every embedding stored, at "
+            "embedding_precision) or pq (product quantization, for very large "
+            "agents)."
+        ),
+    )
+    pq_subvector_dim: int = Field(
+        default=8,
+        description=(
+            "Dimensions per product quantization subvector (each stored in one "
+            "byte: 8 is 32x smaller than float32)."
+        ),
+    )
+    pq_num_centroids: int = Field(
+        default=256, description="Centroids per product quantization subvector."
+    )
+    metadata_filtering: bool = Field(
+        default=False,
+        description=(
+            "Whether to index CSV files row by row, with their structured fields "
+            "(year, genre, rating, ...) as metadata, and to pre-filter retrieval "
+            "with the conditions of the query on these fields."
+        ),
+    )
+    shard_by: Optional[str] = Field(
+        default=None,
+        description=(
+            "Split the vector index in shards searched in parallel by worker "
+            "processes, one per source file (source) or num_shards buckets of "
+            "documents (hash). None for a single index."
+        ),
+    )
+    num_shards: int = Field(
+        default=8, description="Number of shards, when sharding by hash."
+    )
+    reranker: Optional[str] = Field(
+        default=None,
+        description=(
+            "Reranker re-scoring the retrieved chunks before the top_k best are "
+            "passed to the LLM, e.g. "
+            "cross-encoder:cross-encoder/ms-marco-MiniLM-L-6-v2 (None: no "
+            "reranking)."
+        ),
+    )
+    rerank_fetch_k: int = Field(
+        default=10, description="Number of chunks retrieved for the reranker."
+    )
+    adaptive_top_k: bool = Field(
+        default=False,
+        description=(
+            "Whether to pass a variable number of chunks (between min_top_k and "
+            "max_top_k, instead of top_k) to the LLM, cutting the retrieved list "
+            "at similarity_cutoff or at a score_gap."
+        ),
+    )
+    min_top_k: int = Field(default=1, description="Minimum adaptive top k.")
+    max_top_k: int = Field(default=10, description="Maximum adaptive top k.")
+    similarity_cutoff: Optional[float] = Field(
+        default=None,
+        description="Adaptive top k: chunks scoring below are dropped.",
+    )
+    score_gap: Optional[float] = Field(
+        default=0.25,
+        description=(
+            "Adaptive top k: the list is cut where the score drops by this much "
+            "(relative to the best score) from one chunk to the next."
+        ),
+    )
+    memory_window_tokens: Optional[int] = Field(
+        default=None,
+        description=(
+            "Tokens of recent chat history sent with each turn; older turns are "
+            "summarized in the background (None: the whole history is sent)."
+        ),
+    )
+    speculative_retrieval: bool = Field(
+        default=False,
+        description=(
+            "Whether the condense + context chat engine retrieves with the raw "
+            "message while the LLM condenses the question, and keeps the results "
+            "if the condensed question is close to the message."
+        ),
+    )
+    context_packing: bool = Field(
+        default=False,
+        description=(
+            "Whether to drop near-duplicate chunks and repeated metadata from "
+            "the retrieved context, and pack it into context_token_budget tokens."
+        ),
+    )
+    context_token_budget: int = Field(
+        default=3000, description="Maximum tokens of retrieved context per prompt."
+    )
 
 
 def _resolve_llm(llm_str: str) -> LLM:
@@ -83,7 +235,9 @@ def _resolve_llm(llm_str: str) -> LLM:
     # - if there isn't, assume it's an OpenAI model
     # - if there is, resolve it
     tokens = llm_str.split(":")
-    if len(tokens) == 1:
+    if tokens[0] == "offline" or is_offline_mode():
+        llm = resolve_offline_llm(llm_str)
+    elif len(tokens) == 1:
         os.environ["OPENAI_API_KEY"] = st.secrets.openai_key
         llm: LLM = OpenAI(model=llm_str)
     elif tokens[0] == "local":
@@ -102,6 +256,18 @@ def _resolve_llm(llm_str: str) -> LLM:
     return llm
 
 
+def _resolve_embed_model(embed_model_str: str) -> BaseEmbedding:
+    """Resolve embedding model.
+
+    Same as `resolve_embed_model`, with support for the offline hash embedding
+    ("offline:hash", or any model if offline mode is enabled).
+
+    """
+    if embed_model_str.split(":")[0] == "offline" or is_offline_mode():
+        return resolve_offline_embed_model(embed_model_str)
+    return resolve_embed_model(embed_model_str)
+
+
 def load_data(
     file_names: Optional[List[str]] = None,
     directory: Optional[str] = None,
@@ -137,33 +303,189 @@ def load_data(
     return docs
 
 
+def load_data_sources(
+    file_names: Optional[List[str]] = None,
+    directory: Optional[str] = None,
+    urls: Optional[List[str]] = None,
+) -> List[Document]:
+    """Load data from any combination of sources (unlike `load_data`).
+
+    Used to reload agents whose data was added over several calls.
+
+    """
+    docs: List[Document] = []
+    if file_names:
+        docs.extend(load_data(file_names=file_names))
+    if directory:
+        docs.extend(load_data(directory=directory))
+    if urls:
+        docs.extend(load_data(urls=urls))
+    return docs
+
+
+def get_transformations(rag_params: RAGParams) -> List[TransformComponent]:
+    """Get transformations chunking docs for the vector index."""
+    if rag_params.metadata_filtering:
+        return [CSVRowNodeParser(chunk_size=rag_params.chunk_size)]
+    return [SentenceSplitter(chunk_size=rag_params.chunk_size)]
+
+
+def build_vector_index(
+    docs: List[DocOrRef],
+    rag_params: RAGParams,
+    embed_model: Optional[BaseEmbedding] = None,
+) -> VectorStoreIndex:
+    """Build vector index over docs, with the chunking / embedding of rag_params."""
+    embed_model = embed_model or _resolve_embed_model(rag_params.embed_model)
+    callback_manager = CallbackManager([get_metrics_handler()])
+    embed_model.callback_manager = callback_manager
+    vector_store = get_vector_store(
+        rag_params.embedding_precision,
+        rag_params.embedding_dim,
+        rag_params.full_precision_rerank,
+        index_type=rag_params.index_type,
+        pq_subvector_dim=rag_params.pq_subvector_dim,
+        pq_num_centroids=rag_params.pq_num_centroids,
+        shard_by=rag_params.shard_by,
+        num_shards=rag_params.num_shards,
+    )
+    vector_index = VectorStoreIndex.from_documents(
+        rehydrate_docs(docs),
+        storage_context=get_storage_context(
+            rag_params.compress_docstore, vector_store=vector_store
+        ),
+        embed_model=embed_model,
+        transformations=get_transformations(rag_params),
+        callback_manager=callback_manager,
+    )
+    if rag_params.metadata_filtering:
+        set_metadata_index(
+            vector_index, MetadataIndex.from_nodes(vector_index.docstore.docs.values())
+        )
+    return vector_index
+
+
+def insert_docs(
+    vector_index: VectorStoreIndex, docs: List[Document], rag_params: RAGParams
+) -> None:
+    """Chunk docs like `build_vector_index` does and insert them into the index.
+
+    Only the new chunks are embedded.
+
+    """
+    nodes = docs
+    for transformation in get_transformations(rag_params):
+        nodes = transformation(nodes)
+    vector_index.insert_nodes(nodes)
+    metadata_index = get_metadata_index(vector_index)
+    if metadata_index is not None:
+        metadata_index.add_nodes(nodes)
+
+
+def _get_top_k(rag_params: RAGParams) -> int:
+    """Number of chunks that can be passed to the LLM."""
+    return rag_params.max_top_k if rag_params.adaptive_top_k else rag_params.top_k
+
+
+def get_retriever(
+    vector_index: VectorStoreIndex, rag_params: RAGParams
+) -> BaseRetriever:
+    """Get retriever over the vector index (metadata pre-filtered if indexed).
+
+    With a reranker, the retriever over-fetches `rerank_fetch_k` candidates,
+    with adaptive top k, `max_top_k` (see `get_node_postprocessors`).
+
+    """
+    similarity_top_k = _get_top_k(rag_params)
+    if rag_params.reranker is not None:
+        similarity_top_k = max(rag_params.rerank_fetch_k, similarity_top_k)
+    metadata_index = get_metadata_index(vector_index)
+    if metadata_index is not None:
+        return MetadataFilteringRetriever(
+            vector_index, metadata_index, similarity_top_k=similarity_top_k
+        )
+    return vector_index.as_retriever(similarity_top_k=similarity_top_k)
+
+
+def get_node_postprocessors(
+    rag_params: RAGParams, callback_manager: Optional[CallbackManager] = None
+) -> List[BaseNodePostprocessor]:
+    """Get postprocessors of the retrieved nodes.
+
+    Reranking, adaptive top k, then context packing.
+
+    """
+    node_postprocessors: List[BaseNodePostprocessor] = []
+    if rag_params.reranker is not None:
+        node_postprocessors.append(
+            get_reranker(
+                rag_params.reranker,
+                top_n=_get_top_k(rag_params),
+                callback_manager=callback_manager,
+            )
+        )
+    if rag_params.adaptive_top_k:
+        node_postprocessors.append(
+            AdaptiveTopK(
+                min_k=rag_params.min_top_k,
+                max_k=rag_params.max_top_k,
+                similarity_cutoff=rag_params.similarity_cutoff,
+                score_gap=rag_params.score_gap,
+                callback_manager=callback_manager or CallbackManager(),
+            )
+        )
+    if rag_params.context_packing:
+        node_postprocessors.append(
+            ContextPacker(
+                token_budget=rag_params.context_token_budget,
+                callback_manager=callback_manager or CallbackManager(),
+            )
+        )
+    return node_postprocessors
+
+
 def load_agent(
     tools: List,
     llm: LLM,
     system_prompt: str,
     extra_kwargs: Optional[Dict] = None,
+    msg_handler: Optional[Callable[[str], None]] = None,
     **kwargs: Any,
 ) -> BaseChatEngine:
-    """Load agent."""
+    """Load agent.
+
+    `msg_handler` receives the function call messages of the agent, by default
+    they're shown in the Streamlit page.
+
+    """
     extra_kwargs = extra_kwargs or {}
+    rag_params = cast(Optional[RAGParams], extra_kwargs.get("rag_params"))
+    memory = None
+    if rag_params is not None and rag_params.memory_window_tokens is not None:
+        memory = SummaryWindowMemory.from_defaults(
+            llm=llm, token_limit=rag_params.memory_window_tokens
+        )
     if isinstance(llm, OpenAI) and llm.metadata.is_function_calling_model:
-        # TODO: use default msg handler
         # TODO: separate this from agent_utils.py...
-        def _msg_handler(msg: str) -> None:
+        def _st_msg_handler(msg: str) -> None:
             """Message handler."""
             st.info(msg)
-            st.session_state.agent_messages.append(
-                {"role": "assistant", "content": msg, "msg_type": "info"}
-            )
+            # NOTE: not set when running outside of the Streamlit pages
+            # (e.g. offline benchmarks)
+            if "agent_messages" in st.session_state.keys():
+                st.session_state.agent_messages.append(
+                    {"role": "assistant", "content": msg, "msg_type": "info"}
+                )
 
         # add streamlit callbacks (to inject events)
-        handler = StreamlitFunctionsCallbackHandler(_msg_handler)
-        callback_manager = CallbackManager([handler])
+        handler = StreamlitFunctionsCallbackHandler(msg_handler or _st_msg_handler)
+        callback_manager = CallbackManager([handler, get_metrics_handler()])
         # get OpenAI Agent
         agent: BaseChatEngine = OpenAIAgent.from_tools(
             tools=tools,
             llm=llm,
             system_prompt=system_prompt,
+            memory=memory,
             **kwargs,
             callback_manager=callback_manager,
         )
@@ -173,10 +495,20 @@ def load_agent(
                 "Must pass in vector index for CondensePlusContextChatEngine."
             )
         vector_index = cast(VectorStoreIndex, extra_kwargs["vector_index"])
-        rag_params = cast(RAGParams, extra_kwargs["rag_params"])
+        rag_params = cast(RAGParams, rag_params)
         # use condense + context chat engine
-        agent = CondensePlusContextChatEngine.from_defaults(
-            vector_index.as_retriever(similarity_top_k=rag_params.top_k),
+        callback_manager = CallbackManager([get_metrics_handler()])
+        chat_engine_cls = (
+            SpeculativeCondensePlusContextChatEngine
+            if rag_params.speculative_retrieval
+            else CondensePlusContextChatEngine
+        )
+        agent = chat_engine_cls.from_defaults(
+            get_retriever(vector_index, rag_params),
+            llm=llm,
+            memory=memory,
+            node_postprocessors=get_node_postprocessors(rag_params, callback_manager),
+            callback_manager=callback_manager,
         )
 
     return agent
@@ -197,6 +529,8 @@ def load_meta_agent(
 
     """
     extra_kwargs = extra_kwargs or {}
+    # record per-stage latency / tokens of builder turns
+    kwargs.setdefault("callback_manager", CallbackManager([get_metrics_handler()]))
     if isinstance(llm, OpenAI) and llm.metadata.is_function_calling_model:
         # get OpenAI Agent
 
@@ -222,38 +556,54 @@ def load_meta_agent(
 def construct_agent(
     system_prompt: str,
     rag_params: RAGParams,
-    docs: List[Document],
+    docs: List[DocOrRef],
     vector_index: Optional[VectorStoreIndex] = None,
     additional_tools: Optional[List] = None,
+    agent_id: Optional[str] = None,
+    msg_handler: Optional[Callable[[str], None]] = None,
 ) -> Tuple[BaseChatEngine, Dict]:
-    """Construct agent from docs / parameters / indices."""
+    """Construct agent from docs / parameters / indices.
+
+    If `agent_id` is given, identical concurrent queries to the agent (and to its
+    vector tool) are coalesced into a single execution. `msg_handler` is passed
+    to `load_agent`.
+
+    """
     extra_info = {}
     additional_tools = additional_tools or []
 
     # first resolve llm and embedding model
-    embed_model = resolve_embed_model(rag_params.embed_model) # default is openai's
+    embed_model = _resolve_embed_model(rag_params.embed_model) # default is openai's
     # llm = resolve_llm(rag_params.llm)
     # TODO: use OpenAI for now
     # llm = OpenAI(model=rag_params.llm)
     llm = _resolve_llm(rag_params.llm)
 
     # first let's index the data with the right parameters
-    Settings.chunk_size=rag_params.chunk_size
-    Settings.llm=llm
-    Settings.embed_model=embed_model
+    # NOTE: pass llm / embed model / chunking explicitly instead of setting the
+    # global `Settings`, so that agents can be built from several threads
+    callback_manager = CallbackManager([get_metrics_handler()])
+    llm.callback_manager = callback_manager
+    embed_model.callback_manager = callback_manager
+    transformations = [SentenceSplitter(chunk_size=rag_params.chunk_size)]
 
     if vector_index is None:
-        vector_index = VectorStoreIndex.from_documents(
-            docs
-        )
+        vector_index = build_vector_index(docs, rag_params, embed_model=embed_model)
     else:
         pass
 
     extra_info["vector_index"] = vector_index
 
-    vector_query_engine = vector_index.as_query_engine(
-        similarity_top_k=rag_params.top_k
+    vector_query_engine = RetrieverQueryEngine.from_args(
+        get_retriever(vector_index, rag_params),
+        llm=llm,
+        node_postprocessors=get_node_postprocessors(rag_params, callback_manager),
+        callback_manager=callback_manager,
     )
+    if agent_id is not None:
+        vector_query_engine = SingleFlightQueryEngine(
+            vector_query_engine, agent_id, params=rag_params.dict()
+        )
     all_tools = []
     vector_tool = QueryEngineTool(
         query_engine=vector_query_engine,
@@ -265,9 +615,11 @@ def construct_agent(
     all_tools.append(vector_tool)
     if rag_params.include_summarization:
         summary_index = SummaryIndex.from_documents(
-            docs, llm=Settings.llm, embed_model=Settings.embed_model
+            rehydrate_docs(docs),
+            transformations=transformations,
+            callback_manager=callback_manager,
         )
-        summary_query_engine = summary_index.as_query_engine()
+        summary_query_engine = summary_index.as_query_engine(llm=llm)
         summary_tool = QueryEngineTool(
             query_engine=summary_query_engine,
             metadata=ToolMetadata(
@@ -293,7 +645,10 @@ def construct_agent(
         system_prompt=system_prompt,
         verbose=True,
         extra_kwargs={"vector_index": vector_index, "rag_params": rag_params},
+        msg_handler=msg_handler,
     )
+    if agent_id is not None:
+        agent = SingleFlightChatEngine(agent, agent_id, params=rag_params.dict())
     return agent, extra_info
 
 
@@ -437,7 +792,7 @@ def construct_mm_agent(
     additional_tools = additional_tools or []
 
     # first resolve llm and embedding model
-    embed_model = resolve_embed_model(rag_params.embed_model)
+    embed_model = _resolve_embed_model(rag_params.embed_model)
     # TODO: use OpenAI for now
     os.environ["OPENAI_API_KEY"] = st.secrets.openai_key
     openai_mm_llm = OpenAIMultiModal(model="gpt-4-vision-preview", max_new_tokens=1500)
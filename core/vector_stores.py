@@ -0,0 +1,1043 @@
+"""Compact in-memory vector stores.
+
+`QuantizedVectorStore` is a drop-in replacement for llama-index's
+`SimpleVectorStore` that keeps embeddings in a NumPy array at reduced
+precision instead of a dict of float lists:
+
+- `float16`: half precision
+- `int8`: scalar quantization, one float32 scale per vector
+- optionally truncated to the leading `dim` dimensions (for embedding models
+  trained for it, e.g. OpenAI `text-embedding-3-*`), renormalized
+
+`ProductQuantizedVectorStore` goes further for very large agents: vectors are
+split in subvectors, each encoded as the id of its nearest centroid (one byte
+for up to 256 centroids), 16-32x smaller than float32. Codebooks are trained
+with k-means (NumPy) on the first vectors added, and queries are scored with
+asymmetric distance tables (query subvectors against centroids).
+
+Similarities are computed on the compact form. With `full_precision_rerank`,
+the full vectors are also kept (memory-mapped from disk once persisted) and
+the top candidates are re-scored with them.
+
+Persisted next to the other stores of a storage context:
+
+    default__vector_store.json          node ids, ref doc ids, metadata, params
+    default__vector_store.codes.npy     compact vectors
+    default__vector_store.scales.npy    (int8)
+    default__vector_store.full.npy      (full_precision_rerank)
+    default__vector_store.codebooks.npy (product quantization)
+
+`ShardedVectorStore` splits a large index (e.g. an agent over a directory of
+files) in shards of the stores above, searched in parallel by a pool of
+worker processes.
+
+"""
+
+import dataclasses
+import heapq
+import json
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import zlib
+from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import fsspec
+import numpy as np
+from fsspec.implementations.local import LocalFileSystem
+from llama_index.core.storage.storage_context import IMAGE_VECTOR_STORE_NAMESPACE
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.simple import (
+    DEFAULT_VECTOR_STORE,
+    NAMESPACE_SEP,
+    SimpleVectorStore,
+    _build_metadata_filter_fn,
+)
+from llama_index.core.vector_stores.types import (
+    DEFAULT_PERSIST_FNAME,
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+from pydantic import Field, PrivateAttr
+
+EMBEDDING_PRECISIONS = ("float32", "float16", "int8")
+# candidates re-scored at full precision, per result
+RERANK_FACTOR = 4
+# rows scored at once (bounds the float32 copy of int8 / float16 codes)
+QUERY_BLOCK_SIZE = 65536
+INDEX_TYPES = ("flat", "pq")
+# product quantization codebooks are trained on (a sample of) this many vectors
+PQ_MAX_TRAIN_SAMPLES = 32768
+PQ_NUM_ITERS = 15
+SHARD_BY = ("source", "hash")
+# number of shard worker processes (default: one per core)
+SHARD_WORKERS_ENV_VAR = "RAGS_SHARD_WORKERS"
+
+logger = logging.getLogger(__name__)
+
+
+def _get_array_path(persist_path: Union[str, Path], name: str) -> Path:
+    persist_path = Path(persist_path)
+    return persist_path.with_name(f"{persist_path.stem}.{name}.npy")
+
+
+def _save_array(path: Path, array: np.ndarray) -> None:
+    """Save array to a temp file, then move it in place.
+
+    The file at path may be memory-mapped by the store being saved, it must not
+    be truncated under it.
+
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the nearest centroid of each vector."""
+    centroid_norms = (centroids**2).sum(axis=1)
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), QUERY_BLOCK_SIZE):
+        block = vectors[start : start + QUERY_BLOCK_SIZE]
+        # ||x - c||^2 up to ||x||^2, which doesn't change the argmin
+        distances = centroid_norms - 2 * block @ centroids.T
+        assignments[start : start + len(block)] = distances.argmin(axis=1)
+    return assignments
+
+
+def _kmeans(
+    vectors: np.ndarray, num_centroids: int, num_iters: int, rng: np.random.Generator
+) -> np.ndarray:
+    """Lloyd's k-means, initialized with random vectors. Returns centroids."""
+    centroids = vectors[rng.choice(len(vectors), num_centroids, replace=False)]
+    for _ in range(num_iters):
+        assignments = _assign(vectors, centroids)
+        counts = np.bincount(assignments, minlength=num_centroids)
+        sums = np.stack(
+            [
+                np.bincount(assignments, weights=vectors[:, i], minlength=num_centroids)
+                for i in range(vectors.shape[1])
+            ],
+            axis=1,
+        )
+        empty = counts == 0
+        centroids = np.where(
+            empty[:, None], centroids, sums / np.maximum(counts, 1)[:, None]
+        ).astype(np.float32)
+        # re-seed empty clusters
+        if empty.any():
+            centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+    return centroids
+
+
+class QuantizedVectorStore(BasePydanticVectorStore):
+    """In-memory vector store with reduced-precision / truncated embeddings.
+
+    Similarity is cosine similarity, like `SimpleVectorStore`.
+
+    """
+
+    stores_text: bool = False
+
+    precision: str = Field(default="int8", description="float32, float16 or int8.")
+    dim: Optional[int] = Field(
+        default=None, description="Number of leading dimensions kept (all if None)."
+    )
+    full_precision_rerank: bool = Field(
+        default=False, description="Whether to re-score candidates at full precision."
+    )
+
+    _node_ids: List[str] = PrivateAttr(default_factory=list)
+    _rows: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _ref_doc_ids: List[str] = PrivateAttr(default_factory=list)
+    _metadata_dict: Dict[str, Any] = PrivateAttr(default_factory=dict)
+    _codes: Optional[np.ndarray] = PrivateAttr(default=None)
+    _scales: Optional[np.ndarray] = PrivateAttr(default=None)
+    _full: Optional[np.ndarray] = PrivateAttr(default=None)
+
+    def __init__(
+        self,
+        precision: str = "int8",
+        dim: Optional[int] = None,
+        full_precision_rerank: bool = False,
+        **kwargs: Any,
+    ) -> None:
+        """Init params."""
+        if precision not in EMBEDDING_PRECISIONS:
+            raise ValueError(
+                f"Embedding precision {precision} not in {EMBEDDING_PRECISIONS}."
+            )
+        if dim is not None and dim <= 0:
+            raise ValueError("Embedding dim must be positive.")
+        super().__init__(
+            precision=precision,
+            dim=dim,
+            full_precision_rerank=full_precision_rerank,
+            **kwargs,
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        """Class name."""
+        return "QuantizedVectorStore"
+
+    @property
+    def client(self) -> None:
+        """Get client."""
+        return
+
+    @property
+    def num_vectors(self) -> int:
+        """Number of vectors in the store."""
+        return len(self._node_ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the vectors held in memory, in bytes.
+
+        Memory-mapped full vectors are paged in on demand and not counted.
+
+        """
+        arrays = [self._codes, self._scales]
+        if self._full is not None and not isinstance(self._full, np.memmap):
+            arrays.append(self._full)
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def _encode(self, vectors: np.ndarray) -> Dict[str, np.ndarray]:
+        """Encode full vectors, returns arrays to append by name."""
+        if self.dim is not None:
+            if self.dim > vectors.shape[1]:
+                raise ValueError(
+                    f"Embedding dim {self.dim} larger than the embedding model's "
+                    f"({vectors.shape[1]})."
+                )
+            compact = _normalize(vectors[:, : self.dim])
+        else:
+            compact = vectors
+        arrays = self._quantize(compact)
+        if self.full_precision_rerank:
+            arrays["full"] = vectors
+        return arrays
+
+    def _quantize(self, vectors: np.ndarray) -> Dict[str, np.ndarray]:
+        """Quantize (truncated) vectors, returns arrays to append by name."""
+        if self.precision == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales = np.maximum(scales, 1e-12).astype(np.float32)
+            return {
+                "codes": np.round(vectors / scales[:, None]).astype(np.int8),
+                "scales": scales,
+            }
+        return {"codes": vectors.astype(self.precision)}
+
+    def _get_row_array_names(self) -> List[str]:
+        """Names of the arrays with one row per vector."""
+        return ["codes", "scales", "full"]
+
+    def _get_params(self) -> Dict[str, Any]:
+        """Init params, persisted with the store."""
+        return {
+            "precision": self.precision,
+            "dim": self.dim,
+            "full_precision_rerank": self.full_precision_rerank,
+        }
+
+    def _prepare(self) -> None:
+        """Get the store ready to query / persist."""
+
+    def get(self, text_id: str) -> List[float]:
+        """Get embedding (full precision if kept, else decoded)."""
+        self._prepare()
+        row = self._rows[text_id]
+        if self._full is not None:
+            return self._full[row].tolist()
+        return self._decode(np.array([row]))[0].tolist()
+
+    def _decode(self, rows: np.ndarray) -> np.ndarray:
+        assert self._codes is not None
+        vectors = self._codes[rows].astype(np.float32)
+        if self._scales is not None:
+            vectors *= self._scales[rows, None]
+        return vectors
+
+    def add(
+        self,
+        nodes: Sequence[BaseNode],
+        **add_kwargs: Any,
+    ) -> List[str]:
+        """Add nodes to index."""
+        if not nodes:
+            return []
+        # re-added nodes replace the old ones
+        self._delete_rows(
+            [self._rows[node.node_id] for node in nodes if node.node_id in self._rows]
+        )
+        vectors = _normalize(
+            np.array([node.get_embedding() for node in nodes], dtype=np.float32)
+        )
+        for name, array in self._encode(vectors).items():
+            current = getattr(self, f"_{name}")
+            setattr(
+                self,
+                f"_{name}",
+                array if current is None else np.concatenate([current, array]),
+            )
+        for node in nodes:
+            self._rows[node.node_id] = len(self._node_ids)
+            self._node_ids.append(node.node_id)
+            self._ref_doc_ids.append(node.ref_doc_id or "None")
+            metadata = node_to_metadata_dict(
+                node, remove_text=True, flat_metadata=False
+            )
+            metadata.pop("_node_content", None)
+            self._metadata_dict[node.node_id] = metadata
+        return [node.node_id for node in nodes]
+
+    def _delete_rows(self, rows: List[int]) -> None:
+        if not rows:
+            return
+        keep = np.ones(len(self._node_ids), dtype=bool)
+        keep[rows] = False
+        for name in self._get_row_array_names():
+            array = getattr(self, f"_{name}")
+            if array is not None:
+                setattr(self, f"_{name}", np.asarray(array[keep]))
+        for row in rows:
+            self._metadata_dict.pop(self._node_ids[row], None)
+        self._node_ids = [id for id, k in zip(self._node_ids, keep) if k]
+        self._ref_doc_ids = [id for id, k in zip(self._ref_doc_ids, keep) if k]
+        self._rows = {node_id: row for row, node_id in enumerate(self._node_ids)}
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """Delete nodes with ref_doc_id."""
+        self._delete_rows(
+            [row for row, id in enumerate(self._ref_doc_ids) if id == ref_doc_id]
+        )
+
+    def clear(self) -> None:
+        """Clear the store."""
+        self._delete_rows(list(range(len(self._node_ids))))
+
+    def _score(self, query_embedding: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Similarities of the compact vectors at rows with the query."""
+        assert self._codes is not None
+        query = query_embedding
+        if self.dim is not None:
+            query = _normalize(query[None, : self.dim])[0]
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), QUERY_BLOCK_SIZE):
+            block = rows[start : start + QUERY_BLOCK_SIZE]
+            scores[start : start + len(block)] = self._decode(block) @ query
+        return scores
+
+    def query(
+        self,
+        query: VectorStoreQuery,
+        **kwargs: Any,
+    ) -> VectorStoreQueryResult:
+        """Get nodes for response."""
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Invalid query mode: {query.mode}")
+        self._prepare()
+        if self._codes is None or not self._node_ids:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        query_filter_fn = _build_metadata_filter_fn(
+            lambda node_id: self._metadata_dict[node_id], query.filters
+        )
+        if query.node_ids is not None:
+            candidate_ids = [id for id in query.node_ids if id in self._rows]
+            rows = np.array([self._rows[id] for id in candidate_ids], dtype=np.int64)
+        else:
+            rows = np.arange(len(self._node_ids))
+        if query.filters is not None:
+            rows = rows[
+                np.array(
+                    [query_filter_fn(self._node_ids[row]) for row in rows], dtype=bool
+                )
+            ]
+        if len(rows) == 0:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        query_embedding = _normalize(
+            np.array([query.query_embedding], dtype=np.float32)
+        )[0]
+        scores = self._score(query_embedding, rows)
+        top_k = min(query.similarity_top_k, len(rows))
+        num_candidates = top_k
+        if self._full is not None:
+            num_candidates = min(top_k * RERANK_FACTOR, len(rows))
+        top = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+        if self._full is not None:
+            # sorted rows read the memory map sequentially
+            top = top[np.argsort(rows[top])]
+            scores[top] = self._full[rows[top]] @ query_embedding
+        top = top[np.argsort(-scores[top], kind="stable")][:top_k]
+        return VectorStoreQueryResult(
+            similarities=scores[top].tolist(),
+            ids=[self._node_ids[row] for row in rows[top]],
+        )
+
+    def persist(
+        self,
+        persist_path: str = DEFAULT_PERSIST_FNAME,
+        fs: Optional[fsspec.AbstractFileSystem] = None,
+    ) -> None:
+        """Persist the store (local filesystem only)."""
+        if fs is not None and not isinstance(fs, LocalFileSystem):
+            raise ValueError("QuantizedVectorStore can only be persisted locally.")
+        self._prepare()
+        Path(persist_path).parent.mkdir(parents=True, exist_ok=True)
+        # the codes file marks a persisted store, even an empty one
+        codes = self._codes if self._codes is not None else np.zeros((0, 0))
+        _save_array(_get_array_path(persist_path, "codes"), codes)
+        for name in self._get_persisted_array_names():
+            array = getattr(self, f"_{name}")
+            if array is not None:
+                _save_array(_get_array_path(persist_path, name), array)
+        with open(persist_path, "w") as f:
+            json.dump(
+                {
+                    "class_name": self.class_name(),
+                    "params": self._get_params(),
+                    "node_ids": self._node_ids,
+                    "ref_doc_ids": self._ref_doc_ids,
+                    "metadata_dict": self._metadata_dict,
+                },
+                f,
+            )
+
+    def _get_persisted_array_names(self) -> List[str]:
+        """Names of the arrays saved (besides codes)."""
+        return ["scales", "full"]
+
+    @classmethod
+    def from_persist_path(
+        cls,
+        persist_path: str,
+        fs: Optional[fsspec.AbstractFileSystem] = None,
+        mmap: bool = False,
+    ) -> "QuantizedVectorStore":
+        """Load a store, full vectors are memory-mapped.
+
+        Loads the class the store was persisted with (e.g. a
+        `ProductQuantizedVectorStore`). With mmap, all the arrays are
+        memory-mapped (read-only until the store is modified).
+
+        """
+        with open(persist_path) as f:
+            data = json.load(f)
+        store_cls = {
+            store_cls.class_name(): store_cls
+            for store_cls in (QuantizedVectorStore, ProductQuantizedVectorStore)
+        }[data["class_name"]]
+        store = store_cls(**data["params"])
+        store._node_ids = data["node_ids"]
+        store._ref_doc_ids = data["ref_doc_ids"]
+        store._metadata_dict = data["metadata_dict"]
+        store._rows = {node_id: row for row, node_id in enumerate(store._node_ids)}
+        if not store._node_ids:
+            return store
+        store._codes = np.load(
+            _get_array_path(persist_path, "codes"), mmap_mode="r" if mmap else None
+        )
+        for name in store._get_persisted_array_names():
+            array_path = _get_array_path(persist_path, name)
+            if array_path.exists():
+                # full vectors are only read for the candidates of a query
+                mmap_mode = "r" if mmap or name == "full" else None
+                setattr(store, f"_{name}", np.load(array_path, mmap_mode=mmap_mode))
+        return store
+
+
+class ProductQuantizedVectorStore(QuantizedVectorStore):
+    """In-memory vector store with product-quantized embeddings.
+
+    Vectors (truncated to `dim` if set) are split in subvectors of
+    `subvector_dim` dimensions, each stored as the id of its nearest centroid
+    among `num_centroids`. Codebooks are trained when the store is first
+    queried or persisted, on the vectors added until then; vectors added later
+    are encoded with the same codebooks.
+
+    """
+
+    subvector_dim: int = Field(default=8, description="Dimensions per subvector.")
+    num_centroids: int = Field(
+        default=256, description="Centroids per subvector (at most 65536)."
+    )
+
+    # vectors added before the codebooks are trained
+    _untrained: Optional[np.ndarray] = PrivateAttr(default=None)
+    _codebooks: Optional[np.ndarray] = PrivateAttr(default=None)
+    _train_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(
+        self,
+        dim: Optional[int] = None,
+        full_precision_rerank: bool = False,
+        subvector_dim: int = 8,
+        num_centroids: int = 256,
+        **kwargs: Any,
+    ) -> None:
+        """Init params."""
+        if subvector_dim <= 0:
+            raise ValueError("PQ subvector dim must be positive.")
+        if not 1 < num_centroids <= 65536:
+            raise ValueError("PQ number of centroids must be in [2, 65536].")
+        kwargs.pop("precision", None)
+        super().__init__(
+            precision="float32",
+            dim=dim,
+            full_precision_rerank=full_precision_rerank,
+            subvector_dim=subvector_dim,
+            num_centroids=num_centroids,
+            **kwargs,
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        """Class name."""
+        return "ProductQuantizedVectorStore"
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the vectors (and codebooks) held in memory, in bytes."""
+        return super().nbytes + sum(
+            array.nbytes
+            for array in (self._untrained, self._codebooks)
+            if array is not None
+        )
+
+    def _get_row_array_names(self) -> List[str]:
+        return ["codes", "full", "untrained"]
+
+    def _get_persisted_array_names(self) -> List[str]:
+        return ["full", "codebooks"]
+
+    def _get_params(self) -> Dict[str, Any]:
+        return {
+            "dim": self.dim,
+            "full_precision_rerank": self.full_precision_rerank,
+            "subvector_dim": self.subvector_dim,
+            "num_centroids": self.num_centroids,
+        }
+
+    def _quantize(self, vectors: np.ndarray) -> Dict[str, np.ndarray]:
+        if vectors.shape[1] % self.subvector_dim != 0:
+            raise ValueError(
+                f"Embedding dim {vectors.shape[1]} not divisible by PQ subvector "
+                f"dim {self.subvector_dim}."
+            )
+        if self._codebooks is None:
+            return {"untrained": vectors}
+        codebooks = self._codebooks
+        num_subvectors = codebooks.shape[0]
+        codes = np.empty(
+            (len(vectors), num_subvectors),
+            dtype=np.uint8 if codebooks.shape[1] <= 256 else np.uint16,
+        )
+        subvectors = vectors.reshape(len(vectors), num_subvectors, -1)
+        for i in range(num_subvectors):
+            codes[:, i] = _assign(subvectors[:, i], codebooks[i])
+        return {"codes": codes}
+
+    def _prepare(self) -> None:
+        """Train codebooks on the vectors added so far, then encode them."""
+        with self._train_lock:
+            if self._untrained is None:
+                return
+            vectors = self._untrained
+            rng = np.random.default_rng(0)
+            train = vectors
+            if len(train) > PQ_MAX_TRAIN_SAMPLES:
+                train = train[rng.choice(len(train), PQ_MAX_TRAIN_SAMPLES, False)]
+            num_subvectors = vectors.shape[1] // self.subvector_dim
+            num_centroids = min(self.num_centroids, len(train))
+            train_subvectors = train.reshape(len(train), num_subvectors, -1)
+            self._codebooks = np.stack(
+                [
+                    _kmeans(
+                        np.ascontiguousarray(train_subvectors[:, i]),
+                        num_centroids,
+                        PQ_NUM_ITERS,
+                        rng,
+                    )
+                    for i in range(num_subvectors)
+                ]
+            )
+            self._codes = self._quantize(vectors)["codes"]
+            self._untrained = None
+
+    def _decode(self, rows: np.ndarray) -> np.ndarray:
+        assert self._codes is not None and self._codebooks is not None
+        codes = self._codes[rows]
+        return np.concatenate(
+            [self._codebooks[i][codes[:, i]] for i in range(self._codebooks.shape[0])],
+            axis=1,
+        )
+
+    def _score(self, query_embedding: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Asymmetric distance computation: similarities from a lookup table."""
+        assert self._codes is not None and self._codebooks is not None
+        query = query_embedding
+        if self.dim is not None:
+            query = _normalize(query[None, : self.dim])[0]
+        num_subvectors = self._codebooks.shape[0]
+        # table[i, c]: similarity of query subvector i with centroid c
+        table = np.einsum(
+            "id,icd->ic", query.reshape(num_subvectors, -1), self._codebooks
+        )
+        subvector_ids = np.arange(num_subvectors)
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), QUERY_BLOCK_SIZE):
+            block = rows[start : start + QUERY_BLOCK_SIZE]
+            scores[start : start + len(block)] = table[
+                subvector_ids, self._codes[block]
+            ].sum(axis=1)
+        return scores
+
+
+# shards of a `ShardedVectorStore` a worker process has loaded, by persist path:
+# (mtime of the persisted shard, shard with its arrays memory-mapped)
+_WORKER_SHARDS: Dict[str, Tuple[int, QuantizedVectorStore]] = {}
+
+
+def _load_shard(persist_path: str) -> QuantizedVectorStore:
+    """Load a persisted shard, once per worker process."""
+    mtime = os.stat(persist_path).st_mtime_ns
+    cached = _WORKER_SHARDS.get(persist_path)
+    if cached is None or cached[0] != mtime:
+        cached = (
+            mtime,
+            QuantizedVectorStore.from_persist_path(persist_path, mmap=True),
+        )
+        _WORKER_SHARDS[persist_path] = cached
+    return cached[1]
+
+
+def _query_shard(
+    persist_path: str, query: VectorStoreQuery
+) -> Tuple[List[str], List[float]]:
+    """Query a persisted shard (run in the shard worker processes)."""
+    result = _load_shard(persist_path).query(query)
+    return result.ids or [], result.similarities or []
+
+
+def _warm_up_shard(persist_path: str) -> None:
+    _load_shard(persist_path)
+
+
+_SHARD_POOL: Optional[ProcessPoolExecutor] = None
+_SHARD_POOL_LOCK = threading.Lock()
+
+
+def get_shard_pool() -> ProcessPoolExecutor:
+    """Get process-wide pool of shard worker processes.
+
+    One worker per core, or `RAGS_SHARD_WORKERS`. Workers are spawned (not
+    forked, the serving process has threads) and load the shards they're
+    asked to search once, memory-mapped, so shards are paged in from the OS
+    page cache rather than copied per worker.
+
+    """
+    global _SHARD_POOL
+    with _SHARD_POOL_LOCK:
+        if _SHARD_POOL is None:
+            max_workers = int(os.environ.get(SHARD_WORKERS_ENV_VAR) or 0)
+            _SHARD_POOL = ProcessPoolExecutor(
+                max_workers=max_workers or os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _SHARD_POOL
+
+
+def _reset_shard_pool(pool: ProcessPoolExecutor) -> None:
+    """Drop a broken pool, the next `get_shard_pool` starts a new one."""
+    global _SHARD_POOL
+    with _SHARD_POOL_LOCK:
+        if _SHARD_POOL is pool:
+            _SHARD_POOL = None
+    pool.shutdown(wait=False)
+
+
+class ShardedVectorStore(BasePydanticVectorStore):
+    """Vector store split in shards searched in parallel by worker processes.
+
+    Nodes are assigned to a shard by source file (`shard_by="source"`) or by a
+    hash of their source document id (`shard_by="hash"`, `num_shards`
+    shards). Each shard is a `QuantizedVectorStore` (float32 unless
+    `shard_params` say otherwise), persisted next to the others:
+
+        default__vector_store.json              shard keys, params
+        default__vector_store.shard0.json       (+ .codes.npy, ...)
+        default__vector_store.shard1.json
+
+    Once loaded from disk, a query is sent to the shard worker pool (one task
+    per shard), and the per-shard top-k are merged. Shards modified since
+    they were loaded, and stores that were never loaded (just built), are
+    searched in-process.
+
+    """
+
+    stores_text: bool = False
+
+    shard_by: str = Field(default="source", description="source or hash.")
+    num_shards: int = Field(
+        default=8, description="Number of shards, when sharding by hash."
+    )
+    shard_params: Dict[str, Any] = Field(
+        default_factory=dict, description="`get_vector_store` params of shards."
+    )
+
+    _shards: Dict[str, QuantizedVectorStore] = PrivateAttr(default_factory=dict)
+    _shard_keys: Dict[str, str] = PrivateAttr(default_factory=dict)
+    # persist paths of the shards unchanged since they were loaded
+    _shard_paths: Dict[str, str] = PrivateAttr(default_factory=dict)
+
+    def __init__(
+        self,
+        shard_by: str = "source",
+        num_shards: int = 8,
+        shard_params: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> None:
+        """Init params."""
+        if shard_by not in SHARD_BY:
+            raise ValueError(f"Shard by {shard_by} not in {SHARD_BY}.")
+        if num_shards <= 0:
+            raise ValueError("Number of shards must be positive.")
+        super().__init__(
+            shard_by=shard_by,
+            num_shards=num_shards,
+            shard_params=shard_params or {},
+            **kwargs,
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        """Class name."""
+        return "ShardedVectorStore"
+
+    @property
+    def client(self) -> None:
+        """Get client."""
+        return
+
+    @property
+    def num_vectors(self) -> int:
+        """Number of vectors in the store."""
+        return sum(shard.num_vectors for shard in self._shards.values())
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the vectors held in memory (by this process), in bytes."""
+        return sum(
+            sum(
+                array.nbytes
+                for array in (shard._codes, shard._scales, shard._full)
+                if array is not None and not isinstance(array, np.memmap)
+            )
+            for shard in self._shards.values()
+        )
+
+    @property
+    def shard_sizes(self) -> Dict[str, int]:
+        """Number of vectors per shard key."""
+        return {key: shard.num_vectors for key, shard in self._shards.items()}
+
+    def _get_shard_key(self, node: BaseNode) -> str:
+        if self.shard_by == "source":
+            return str(
+                node.metadata.get("file_path") or node.metadata.get("url") or ""
+            )
+        doc_id = node.ref_doc_id or node.node_id
+        return str(zlib.crc32(doc_id.encode("utf-8")) % self.num_shards)
+
+    def _new_shard(self) -> QuantizedVectorStore:
+        return get_vector_store(**self.shard_params) or QuantizedVectorStore(
+            precision="float32"
+        )
+
+    def get(self, text_id: str) -> List[float]:
+        """Get embedding."""
+        return self._shards[self._shard_keys[text_id]].get(text_id)
+
+    def add(
+        self,
+        nodes: Sequence[BaseNode],
+        **add_kwargs: Any,
+    ) -> List[str]:
+        """Add nodes to index."""
+        nodes_by_key: Dict[str, List[BaseNode]] = defaultdict(list)
+        for node in nodes:
+            key = self._get_shard_key(node)
+            old_key = self._shard_keys.get(node.node_id)
+            if old_key is not None and old_key != key:
+                # re-added to another shard
+                old_shard = self._shards[old_key]
+                old_shard._delete_rows([old_shard._rows[node.node_id]])
+                self._shard_paths.pop(old_key, None)
+            nodes_by_key[key].append(node)
+        for key, key_nodes in nodes_by_key.items():
+            if key not in self._shards:
+                self._shards[key] = self._new_shard()
+            self._shards[key].add(key_nodes)
+            self._shard_paths.pop(key, None)
+            for node in key_nodes:
+                self._shard_keys[node.node_id] = key
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """Delete nodes with ref_doc_id."""
+        for key, shard in self._shards.items():
+            if ref_doc_id not in shard._ref_doc_ids:
+                continue
+            old_ids = set(shard._node_ids)
+            shard.delete(ref_doc_id)
+            for node_id in old_ids - set(shard._node_ids):
+                self._shard_keys.pop(node_id, None)
+            self._shard_paths.pop(key, None)
+
+    def clear(self) -> None:
+        """Clear the store."""
+        self._shards = {}
+        self._shard_keys = {}
+        self._shard_paths = {}
+
+    def _get_shard_node_ids(
+        self, node_ids: Optional[List[str]]
+    ) -> Dict[str, Optional[List[str]]]:
+        """Node ids to restrict each shard's search to (None: all)."""
+        if node_ids is None:
+            return {key: None for key in self._shards}
+        shard_node_ids: Dict[str, List[str]] = defaultdict(list)
+        for node_id in dict.fromkeys(node_ids):
+            key = self._shard_keys.get(node_id)
+            if key is not None:
+                shard_node_ids[key].append(node_id)
+        # retrievers pass every node id of the index: don't send them to workers
+        return {
+            key: None if len(ids) == self._shards[key].num_vectors else ids
+            for key, ids in shard_node_ids.items()
+        }
+
+    def query(
+        self,
+        query: VectorStoreQuery,
+        **kwargs: Any,
+    ) -> VectorStoreQueryResult:
+        """Get nodes for response."""
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Invalid query mode: {query.mode}")
+        shard_queries = {
+            key: dataclasses.replace(query, node_ids=node_ids)
+            for key, node_ids in self._get_shard_node_ids(query.node_ids).items()
+        }
+        pooled_keys = [key for key in shard_queries if key in self._shard_paths]
+        if len(pooled_keys) < 2:
+            pooled_keys = []
+        results: List[Tuple[List[str], List[float]]] = []
+        futures: List[Future] = []
+        pool = get_shard_pool() if pooled_keys else None
+        try:
+            if pool is not None:
+                futures = [
+                    pool.submit(
+                        _query_shard, self._shard_paths[key], shard_queries[key]
+                    )
+                    for key in pooled_keys
+                ]
+            # the other shards are searched while the workers search theirs
+            for key, shard_query in shard_queries.items():
+                if key not in pooled_keys:
+                    result = self._shards[key].query(shard_query)
+                    results.append((result.ids or [], result.similarities or []))
+            results.extend(future.result() for future in futures)
+        except BrokenProcessPool:
+            assert pool is not None
+            logger.warning("Shard worker pool broken, searching in-process.")
+            _reset_shard_pool(pool)
+            results = []
+            for key, shard_query in shard_queries.items():
+                result = self._shards[key].query(shard_query)
+                results.append((result.ids or [], result.similarities or []))
+
+        # merge the per-shard top-k
+        scored = [
+            (similarity, node_id)
+            for ids, similarities in results
+            for node_id, similarity in zip(ids, similarities)
+        ]
+        top = heapq.nlargest(query.similarity_top_k, scored, key=lambda x: x[0])
+        return VectorStoreQueryResult(
+            similarities=[similarity for similarity, _ in top],
+            ids=[node_id for _, node_id in top],
+        )
+
+    def persist(
+        self,
+        persist_path: str = DEFAULT_PERSIST_FNAME,
+        fs: Optional[fsspec.AbstractFileSystem] = None,
+    ) -> None:
+        """Persist the shards and the shard keys (local filesystem only)."""
+        if fs is not None and not isinstance(fs, LocalFileSystem):
+            raise ValueError("ShardedVectorStore can only be persisted locally.")
+        Path(persist_path).parent.mkdir(parents=True, exist_ok=True)
+        shards = []
+        for i, key in enumerate(sorted(self._shards)):
+            shard_path = _get_shard_path(persist_path, i)
+            self._shards[key].persist(str(shard_path))
+            shards.append({"key": key, "path": shard_path.name})
+        with open(persist_path, "w") as f:
+            json.dump(
+                {
+                    "class_name": self.class_name(),
+                    "params": {
+                        "shard_by": self.shard_by,
+                        "num_shards": self.num_shards,
+                        "shard_params": self.shard_params,
+                    },
+                    "shards": shards,
+                },
+                f,
+            )
+
+    @classmethod
+    def from_persist_path(
+        cls, persist_path: str, fs: Optional[fsspec.AbstractFileSystem] = None
+    ) -> "ShardedVectorStore":
+        """Load a store, shards are memory-mapped."""
+        with open(persist_path) as f:
+            data = json.load(f)
+        store = cls(**data["params"])
+        for shard_dict in data["shards"]:
+            shard_path = str((Path(persist_path).parent / shard_dict["path"]).resolve())
+            shard = QuantizedVectorStore.from_persist_path(shard_path, mmap=True)
+            store._shards[shard_dict["key"]] = shard
+            store._shard_paths[shard_dict["key"]] = shard_path
+            for node_id in shard._node_ids:
+                store._shard_keys[node_id] = shard_dict["key"]
+        if len(store._shard_paths) > 1:
+            # start the workers (and page the shards in) before the first query
+            pool = get_shard_pool()
+            for shard_path in store._shard_paths.values():
+                pool.submit(_warm_up_shard, shard_path)
+        return store
+
+
+def _get_shard_path(persist_path: Union[str, Path], i: int) -> Path:
+    persist_path = Path(persist_path)
+    return persist_path.with_name(f"{persist_path.stem}.shard{i}.json")
+
+
+def _get_class_name(persist_path: Path) -> Optional[str]:
+    """Class name of a store persisted by this module, without loading it.
+
+    The class name is the first key of the persisted JSON; `SimpleVectorStore`
+    JSON doesn't have one.
+
+    """
+    if not persist_path.exists():
+        return None
+    with open(persist_path) as f:
+        head = f.read(128)
+    match = re.match(r'\{"class_name": "(\w+)"', head)
+    return match.group(1) if match else None
+
+
+def get_vector_store(
+    precision: str = "float32",
+    dim: Optional[int] = None,
+    full_precision_rerank: bool = False,
+    index_type: str = "flat",
+    pq_subvector_dim: int = 8,
+    pq_num_centroids: int = 256,
+    shard_by: Optional[str] = None,
+    num_shards: int = 8,
+) -> Optional[BasePydanticVectorStore]:
+    """Get vector store for embedding storage params.
+
+    Returns None for the default (flat, full precision, full dimension,
+    unsharded) storage, to keep using `SimpleVectorStore`.
+
+    """
+    if shard_by is not None:
+        return ShardedVectorStore(
+            shard_by=shard_by,
+            num_shards=num_shards,
+            shard_params={
+                "precision": precision,
+                "dim": dim,
+                "full_precision_rerank": full_precision_rerank,
+                "index_type": index_type,
+                "pq_subvector_dim": pq_subvector_dim,
+                "pq_num_centroids": pq_num_centroids,
+            },
+        )
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Index type {index_type} not in {INDEX_TYPES}.")
+    if index_type == "pq":
+        return ProductQuantizedVectorStore(
+            dim=dim,
+            full_precision_rerank=full_precision_rerank,
+            subvector_dim=pq_subvector_dim,
+            num_centroids=pq_num_centroids,
+        )
+    if precision == "float32" and dim is None:
+        return None
+    return QuantizedVectorStore(
+        precision=precision, dim=dim, full_precision_rerank=full_precision_rerank
+    )
+
+
+def load_vector_stores(
+    persist_dir: Union[str, Path],
+) -> Optional[Dict[str, BasePydanticVectorStore]]:
+    """Load vector stores of a storage dir if it has a store of this module.
+
+    Returns None otherwise (the stores are then loaded as `SimpleVectorStore`s).
+
+    """
+    persist_path = (
+        Path(persist_dir)
+        / f"{DEFAULT_VECTOR_STORE}{NAMESPACE_SEP}{DEFAULT_PERSIST_FNAME}"
+    )
+    vector_store: BasePydanticVectorStore
+    if _get_array_path(persist_path, "codes").exists():
+        vector_store = QuantizedVectorStore.from_persist_path(str(persist_path))
+    elif _get_class_name(persist_path) == ShardedVectorStore.class_name():
+        vector_store = ShardedVectorStore.from_persist_path(str(persist_path))
+    else:
+        return None
+    vector_stores: Dict[str, BasePydanticVectorStore] = {
+        DEFAULT_VECTOR_STORE: vector_store
+    }
+    image_path = (
+        Path(persist_dir)
+        / f"{IMAGE_VECTOR_STORE_NAMESPACE}{NAMESPACE_SEP}{DEFAULT_PERSIST_FNAME}"
+    )
+    if image_path.exists():
+        vector_stores[IMAGE_VECTOR_STORE_NAMESPACE] = (
+            SimpleVectorStore.from_persist_path(str(image_path))
+        )
+    return vector_stores
@@ -37,6 +37,18 @@ def update_agent() -> None:
             embed_model=st.session_state.embed_model_st,
             llm=st.session_state.llm_st,
             additional_tools=additional_tools,
+            compact_memory=st.session_state.compact_memory_st,
+            compress_docstore=st.session_state.compress_docstore_st,
+            metadata_filtering=st.session_state.metadata_filtering_st,
+            reranker=st.session_state.reranker_st.strip(),
+            rerank_fetch_k=st.session_state.rerank_fetch_k_st,
+            adaptive_top_k=st.session_state.adaptive_top_k_st,
+            min_top_k=st.session_state.min_top_k_st,
+            max_top_k=st.session_state.max_top_k_st,
+            context_packing=st.session_state.context_packing_st,
+            context_token_budget=st.session_state.context_token_budget_st,
+            memory_window_tokens=st.session_state.memory_window_tokens_st,
+            speculative_retrieval=st.session_state.speculative_retrieval_st,
         )
 
         # Update Radio Buttons: update selected agent to the new id
@@ -45,6 +57,28 @@ def update_agent() -> None:
         raise ValueError("Agent builder is None. Cannot update agent.")
 
 
+def add_data() -> None:
+    """Add data to agent."""
+    if (
+        "agent_builder" in st.session_state.keys()
+        and st.session_state.agent_builder is not None
+    ):
+        new_file_names = [
+            f.strip()
+            for f in st.session_state.new_file_names_st.split(",")
+            if f.strip()
+        ]
+        new_urls = [
+            u.strip() for u in st.session_state.new_urls_st.split(",") if u.strip()
+        ]
+        agent_builder = cast(RAGAgentBuilder, st.session_state.agent_builder)
+        ### Add data (only the new data is indexed)
+        msg = agent_builder.add_data(file_names=new_file_names, urls=new_urls)
+        st.session_state.add_data_msg = msg
+    else:
+        raise ValueError("Agent builder is None. Cannot add data.")
+
+
 def delete_agent() -> None:
     """Delete agent."""
     if (
@@ -110,6 +144,20 @@ if current_state.agent_builder is not None:
             value=",".join(current_state.cache.urls),
             disabled=True,
         )
+        if current_state.cache.agent is not None and isinstance(
+            current_state.agent_builder, RAGAgentBuilder
+        ):
+            st.text_input("Add file names (comma-separated)", key="new_file_names_st")
+            st.text_input("Add URLs (comma-separated)", key="new_urls_st")
+            st.caption(
+                "Only the new data is embedded. Saving the agent still rewrites "
+                "its whole index (or a copy of its shared corpus), so adding "
+                "data to a large agent takes as much disk I/O as saving it."
+            )
+            st.button("Add Data", on_click=add_data)
+            if "add_data_msg" in st.session_state.keys():
+                st.info(st.session_state.add_data_msg)
+                del st.session_state.add_data_msg
 
     include_summarization_st = st.checkbox(
         "Include Summarization (only works for GPT-4)",
@@ -132,6 +180,66 @@ if current_state.agent_builder is not None:
         "Embed Model", value=rag_params.embed_model, key="embed_model_st"
     )
     llm_st = st.text_input("LLM", value=rag_params.llm, key="llm_st")
+    compact_memory_st = st.checkbox(
+        "Compact Memory (keep references to indexed documents)",
+        value=rag_params.compact_memory,
+        key="compact_memory_st",
+    )
+    compress_docstore_st = st.checkbox(
+        "Compress Docstore",
+        value=rag_params.compress_docstore,
+        key="compress_docstore_st",
+    )
+    metadata_filtering_st = st.checkbox(
+        "Metadata Filtering (index CSV rows with their fields, filter by query)",
+        value=rag_params.metadata_filtering,
+        key="metadata_filtering_st",
+    )
+    reranker_st = st.text_input(
+        "Reranker (e.g. cross-encoder:cross-encoder/ms-marco-MiniLM-L-6-v2, "
+        "empty for none)",
+        value=rag_params.reranker or "",
+        key="reranker_st",
+    )
+    rerank_fetch_k_st = st.number_input(
+        "Rerank Fetch K (chunks retrieved for the reranker)",
+        value=rag_params.rerank_fetch_k,
+        key="rerank_fetch_k_st",
+    )
+    adaptive_top_k_st = st.checkbox(
+        "Adaptive Top K (between min and max, cut at a score gap)",
+        value=rag_params.adaptive_top_k,
+        key="adaptive_top_k_st",
+    )
+    min_top_k_st = st.number_input(
+        "Min Top K", value=rag_params.min_top_k, key="min_top_k_st"
+    )
+    max_top_k_st = st.number_input(
+        "Max Top K", value=rag_params.max_top_k, key="max_top_k_st"
+    )
+    context_packing_st = st.checkbox(
+        "Context Packing (drop duplicate chunks, fit context in a token budget)",
+        value=rag_params.context_packing,
+        key="context_packing_st",
+    )
+    context_token_budget_st = st.number_input(
+        "Context Token Budget",
+        value=rag_params.context_token_budget,
+        key="context_token_budget_st",
+    )
+    memory_window_tokens_st = st.number_input(
+        "Memory Window Tokens (older chat turns are summarized, 0 to keep all)",
+        value=rag_params.memory_window_tokens or 0,
+        key="memory_window_tokens_st",
+    )
+    speculative_retrieval_st = st.checkbox(
+        "Speculative Retrieval (retrieve while the question is condensed)",
+        value=rag_params.speculative_retrieval,
+        key="speculative_retrieval_st",
+    )
+    if current_state.cache.vector_index is not None:
+        with st.expander("Memory (Expand to view)"):
+            st.json(current_state.cache.get_memory_report())
     if current_state.cache.agent is not None:
         st.button("Update Agent", on_click=update_agent)
         st.button(":red[Delete Agent]", on_click=delete_agent)
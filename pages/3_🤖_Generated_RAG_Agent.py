@@ -1,6 +1,12 @@
 """Streamlit page showing builder config."""
 import streamlit as st
-from st_utils import add_sidebar, get_current_state
+from st_utils import (
+    add_sidebar,
+    get_current_state,
+    get_session_id,
+    add_latency_panel,
+)
+from core.llm_scheduler import llm_request_context
 from core.utils import get_image_and_text_nodes
 from llama_index.core.schema import MetadataMode
 from llama_index.core.chat_engine.types import AGENT_CHAT_RESPONSE_TYPE
@@ -103,7 +109,7 @@ if current_state.cache is not None and current_state.cache.agent is not None:
     # If last message is not from assistant, generate a new response
     if st.session_state.agent_messages[-1]["role"] != "assistant":
         with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
+            with st.spinner("Thinking..."), llm_request_context(get_session_id()):
                 response = agent.chat(str(prompt))
                 st.write(str(response))
 
@@ -114,5 +120,7 @@ if current_state.cache is not None and current_state.cache.agent is not None:
                 add_to_message_history(
                     "assistant", str(response), extra={"response": response}
                 )
+
+    add_latency_panel()
 else:
     st.info("Agent not created. Please create an agent in the above section.")
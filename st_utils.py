@@ -8,11 +8,13 @@ from core.agent_builder.loader import (
 )
 from core.agent_builder.base import BaseRAGAgentBuilder
 from core.param_cache import ParamCache
+from core.callback_manager import get_metrics_handler
 from core.constants import (
     AGENT_CACHE_DIR,
 )
-from typing import Optional, cast
+from typing import List, Optional, cast
 from pydantic import BaseModel
+import uuid
 
 from llama_index.core.agent.types import BaseAgent
 import streamlit as st
@@ -36,6 +38,13 @@ def update_selected_agent_with_id(selected_id: Optional[str] = None) -> None:
     st.session_state.selected_cache = None
 
 
+def get_session_id() -> str:
+    """Get id of the current session (used to share LLM capacity fairly)."""
+    if "session_id" not in st.session_state.keys():
+        st.session_state.session_id = str(uuid.uuid4())
+    return st.session_state.session_id
+
+
 ## handler for sidebar specifically
 def update_selected_agent() -> None:
     """Update selected agent."""
@@ -85,11 +94,29 @@ def add_builder_config() -> None:
         )
 
 
+def update_agent_ids() -> List[str]:
+    """Reload agent ids if the registry changed since they were loaded.
+
+    Returns ids of the agents added since.
+
+    """
+    agent_registry = cast(AgentCacheRegistry, st.session_state.agent_registry)
+    version = agent_registry.get_version()
+    if (
+        "cur_agent_ids" in st.session_state.keys()
+        and st.session_state.get("agent_ids_version") == version
+    ):
+        return []
+    cur_agent_ids = st.session_state.get("cur_agent_ids", [])
+    st.session_state.cur_agent_ids = agent_registry.get_agent_ids()
+    st.session_state.agent_ids_version = version
+    return [id for id in st.session_state.cur_agent_ids if id not in cur_agent_ids]
+
+
 def add_sidebar() -> None:
     """Add sidebar."""
     with st.sidebar:
-        agent_registry = cast(AgentCacheRegistry, st.session_state.agent_registry)
-        st.session_state.cur_agent_ids = agent_registry.get_agent_ids()
+        update_agent_ids()
         choices = ["Create a new agent"] + st.session_state.cur_agent_ids
 
         # by default, set index to 0. if value is in selected_id, set index to that
@@ -107,6 +134,52 @@ def add_sidebar() -> None:
         )
 
 
+def add_latency_panel() -> None:
+    """Add latency waterfall of the latest chat turn of this session."""
+    trace = get_metrics_handler().get_latest_trace(session_id=get_session_id())
+    if trace is None or len(trace["spans"]) == 0:
+        return
+
+    import altair as alt
+    import pandas as pd
+
+    with st.expander("Latency (latest turn)"):
+        st.caption(
+            f"Total: {trace['duration_ms']:.0f} ms, "
+            f"prompt tokens: {trace['prompt_tokens']}, "
+            f"completion tokens: {trace['completion_tokens']}"
+        )
+        spans = sorted(trace["spans"], key=lambda span: span["start_ms"])
+        spans_df = pd.DataFrame(
+            [
+                {
+                    # unique label per span, in start order
+                    "span": f"{i:02d} {span['type']}"
+                    + (f" ({span['tool']})" if "tool" in span else ""),
+                    "type": span["type"],
+                    "start_ms": span["start_ms"],
+                    "end_ms": span["end_ms"],
+                    "duration_ms": span["duration_ms"],
+                    "tokens": span.get("prompt_tokens", 0)
+                    + span.get("completion_tokens", 0),
+                }
+                for i, span in enumerate(spans)
+            ]
+        )
+        chart = (
+            alt.Chart(spans_df)
+            .mark_bar()
+            .encode(
+                x=alt.X("start_ms", title="ms"),
+                x2="end_ms",
+                y=alt.Y("span", sort=None, title=None),
+                color="type",
+                tooltip=["span", "duration_ms", "tokens"],
+            )
+        )
+        st.altair_chart(chart, use_container_width=True)
+
+
 class CurrentSessionState(BaseModel):
     """Current session state."""
 
@@ -139,7 +212,7 @@ def get_current_state() -> CurrentSessionState:
         st.session_state.agent_registry = agent_registry
 
     if "cur_agent_ids" not in st.session_state.keys():
-        st.session_state.cur_agent_ids = agent_registry.get_agent_ids()
+        update_agent_ids()
 
     if "selected_id" not in st.session_state.keys():
         st.session_state.selected_id = None
@@ -0,0 +1,11 @@
+"""Tests run offline (see core/offline.py): no API keys, no network."""
+
+import os
+import sys
+from pathlib import Path
+
+# must be set before `core` is imported (it resolves the builder LLM on import)
+os.environ.setdefault("RAGS_OFFLINE", "1")
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
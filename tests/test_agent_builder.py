@@ -0,0 +1,34 @@
+"""Tests for adding data to an agent."""
+
+from pathlib import Path
+
+from core.agent_builder.base import RAGAgentBuilder
+from core.agent_builder.registry import AgentCacheRegistry
+from core.param_cache import ParamCache
+
+
+def test_add_data_does_not_modify_loaded_index(tmp_path: Path) -> None:
+    registry = AgentCacheRegistry(tmp_path / "cache")
+    # no data sources: the agent has its own index (not a shared corpus)
+    builder = RAGAgentBuilder(cache=ParamCache(), agent_registry=registry)
+    builder.cache.system_prompt = "You are a helpful assistant."
+    builder.set_rag_params(embed_model="offline:hash", llm="offline:echo")
+    builder.create_agent(agent_id="agent")
+    assert builder.cache.corpus_id is None
+
+    cache = registry.get_agent_cache("agent")
+    # another session serving the same agent (shares the loaded index)
+    other_cache = registry.get_agent_cache("agent")
+    assert other_cache.vector_index is cache.vector_index
+    num_nodes = len(other_cache.vector_index.docstore.docs)
+
+    path = tmp_path / "a.txt"
+    path.write_text("Some text about dogs.")
+    builder = RAGAgentBuilder(cache=cache, agent_registry=registry)
+    msg = builder.add_data(file_names=[str(path)])
+    assert msg == "Added 1 documents to agent agent."
+    assert len(builder.cache.vector_index.docstore.docs) > num_nodes
+    assert len(other_cache.vector_index.docstore.docs) == num_nodes
+    # saved with the new data
+    saved_cache = registry.get_agent_cache("agent")
+    assert len(saved_cache.vector_index.docstore.docs) > num_nodes
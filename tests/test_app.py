@@ -0,0 +1,110 @@
+"""Tests for the agent server's streaming endpoint."""
+
+import asyncio
+import json
+import threading
+import time
+from typing import Any, Iterator, List
+
+from app import AgentServer, Conversation, Request, _write_stream
+
+
+class FakeStreamingResponse:
+    """Streams tokens slowly, like an agent's `StreamingAgentChatResponse`."""
+
+    def __init__(self, num_tokens: int, delay: float) -> None:
+        self.num_tokens = num_tokens
+        self.delay = delay
+        self.streamed: List[str] = []
+        self.closed = threading.Event()
+
+    @property
+    def response_gen(self) -> Iterator[str]:
+        try:
+            for i in range(self.num_tokens):
+                time.sleep(self.delay)
+                token = f"t{i} "
+                self.streamed.append(token)
+                yield token
+        finally:
+            self.closed.set()
+
+
+class FakeAgent:
+    def __init__(self, response: FakeStreamingResponse) -> None:
+        self.response = response
+
+    def stream_chat(self, message: str) -> FakeStreamingResponse:
+        return self.response
+
+
+class DisconnectingWriter:
+    """Stream writer whose client goes away after `max_writes` chunks."""
+
+    def __init__(self, max_writes: int) -> None:
+        self.max_writes = max_writes
+        self.chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> None:
+        self.chunks.append(data)
+
+    async def drain(self) -> None:
+        if len(self.chunks) > self.max_writes:
+            raise ConnectionResetError("client went away")
+
+
+def _make_server(response: FakeStreamingResponse) -> AgentServer:
+    server = AgentServer(registry=None, max_concurrency=1)  # type: ignore
+    server._caches["agent"] = None  # type: ignore
+    server._conversations[("agent", "conv")] = Conversation(
+        agent=FakeAgent(response)  # type: ignore
+    )
+    return server
+
+
+def _request(message: str) -> Request:
+    body = json.dumps({"message": message, "conversation_id": "conv"})
+    return Request("POST", "/agents/agent/stream_chat", {}, body.encode())
+
+
+def test_stream_chat() -> None:
+    response = FakeStreamingResponse(num_tokens=3, delay=0)
+    server = _make_server(response)
+
+    async def _main() -> List[bytes]:
+        server._semaphore = asyncio.Semaphore(1)
+        conversation_id, gen = await server._stream_chat("agent", _request("hi"))
+        writer = DisconnectingWriter(max_writes=100)
+        await _write_stream(writer, conversation_id, gen)  # type: ignore
+        return writer.chunks
+
+    chunks = asyncio.run(_main())
+    body = b"".join(chunks)
+    assert b"X-Conversation-Id: conv" in body
+    assert body.endswith(b"0\r\n\r\n")
+    assert response.streamed == ["t0 ", "t1 ", "t2 "]
+
+
+def test_stream_chat_client_disconnect() -> None:
+    response = FakeStreamingResponse(num_tokens=50, delay=0.01)
+    server = _make_server(response)
+    conversation = server._conversations[("agent", "conv")]
+    released_after_worker: List[bool] = []
+
+    async def _main() -> Any:
+        server._semaphore = asyncio.Semaphore(1)
+        conversation_id, gen = await server._stream_chat("agent", _request("hi"))
+        writer = DisconnectingWriter(max_writes=2)
+        try:
+            await _write_stream(writer, conversation_id, gen)  # type: ignore
+        except ConnectionResetError:
+            pass
+        # the slot is released only after the worker stopped
+        released_after_worker.append(response.closed.is_set())
+        assert not conversation.lock.locked()
+        assert not server._semaphore.locked()
+
+    asyncio.run(_main())
+    assert released_after_worker == [True]
+    # the worker stopped streaming instead of consuming the whole response
+    assert len(response.streamed) < response.num_tokens
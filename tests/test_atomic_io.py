@@ -0,0 +1,106 @@
+"""Tests for crash-safe persistence of directories."""
+
+import os
+import time
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from core.atomic_io import cleanup_staging, staged_dir
+
+
+def _make_dir(path: Path, text: str) -> None:
+    path.mkdir()
+    (path / "data.txt").write_text(text)
+
+
+def _age(path: Path, secs: float) -> None:
+    mtime = time.time() - secs
+    os.utime(path, (mtime, mtime))
+
+
+def _list_dir(path: Path) -> List[str]:
+    return sorted(p.name for p in path.iterdir())
+
+
+def test_staged_dir_replaces(tmp_path: Path) -> None:
+    path = tmp_path / "agent"
+    _make_dir(path, "old")
+
+    with staged_dir(path) as staging_path:
+        (staging_path / "data.txt").write_text("new")
+        # not visible until the block exits
+        assert (path / "data.txt").read_text() == "old"
+
+    assert (path / "data.txt").read_text() == "new"
+    assert _list_dir(tmp_path) == ["agent"]
+
+
+def test_staged_dir_raise_leaves_path_intact(tmp_path: Path) -> None:
+    path = tmp_path / "agent"
+    _make_dir(path, "old")
+
+    with pytest.raises(RuntimeError):
+        with staged_dir(path) as staging_path:
+            (staging_path / "data.txt").write_text("partial")
+            raise RuntimeError("interrupted")
+
+    assert (path / "data.txt").read_text() == "old"
+    assert _list_dir(tmp_path) == ["agent"]
+
+
+def test_staged_dir_no_overwrite(tmp_path: Path) -> None:
+    path = tmp_path / "agent"
+    _make_dir(path, "old")
+
+    with pytest.raises(FileExistsError):
+        with staged_dir(path, overwrite=False):
+            pass
+    assert (path / "data.txt").read_text() == "old"
+
+
+def test_staged_dir_no_overwrite_race(tmp_path: Path) -> None:
+    path = tmp_path / "agent"
+
+    with pytest.raises(FileExistsError):
+        with staged_dir(path, overwrite=False) as staging_path:
+            (staging_path / "data.txt").write_text("mine")
+            # written by someone else in the meantime
+            _make_dir(path, "theirs")
+
+    assert (path / "data.txt").read_text() == "theirs"
+    assert _list_dir(tmp_path) == ["agent"]
+
+
+def test_cleanup_staging(tmp_path: Path) -> None:
+    # replaced, but the previous version wasn't deleted yet
+    _make_dir(tmp_path / "a", "new")
+    _make_dir(tmp_path / ".a.x1.trash", "old")
+    # moved aside, but the replacement never landed
+    _make_dir(tmp_path / ".b.x2.trash", "old")
+    # never moved in place
+    _make_dir(tmp_path / ".c.x3.staging", "new")
+    for path in tmp_path.iterdir():
+        _age(path, 120)
+    # a write in progress
+    _make_dir(tmp_path / ".d.x4.staging", "new")
+
+    cleaned = cleanup_staging(tmp_path, grace_period=60)
+
+    assert sorted(path.name for path in cleaned) == [
+        ".a.x1.trash",
+        ".b.x2.trash",
+        ".c.x3.staging",
+    ]
+    assert _list_dir(tmp_path) == [".d.x4.staging", "a", "b"]
+    assert (tmp_path / "a" / "data.txt").read_text() == "new"
+    assert (tmp_path / "b" / "data.txt").read_text() == "old"
+
+
+def test_cleanup_staging_grace_period(tmp_path: Path) -> None:
+    _make_dir(tmp_path / ".b.x2.trash", "old")
+    _make_dir(tmp_path / ".c.x3.staging", "new")
+
+    assert cleanup_staging(tmp_path, grace_period=60) == []
+    assert _list_dir(tmp_path) == [".b.x2.trash", ".c.x3.staging"]
@@ -0,0 +1,67 @@
+"""Tests for shared corpora deleted by another process."""
+
+from pathlib import Path
+from typing import List
+
+import pytest
+from llama_index.core import Document
+
+from core.corpus_store import CorpusStore
+from core.utils import RAGParams
+
+RAG_PARAMS = RAGParams(embed_model="offline:hash", llm="offline:echo")
+
+
+@pytest.fixture
+def docs() -> List[Document]:
+    return [Document(text=f"Document number {i}.") for i in range(3)]
+
+
+@pytest.fixture
+def file_names(tmp_path: Path) -> List[str]:
+    path = tmp_path / "a.txt"
+    path.write_text("Document number 0.")
+    return [str(path)]
+
+
+def test_get_or_build_stores_deleted_corpus_again(
+    tmp_path: Path, docs: List[Document], file_names: List[str]
+) -> None:
+    store = CorpusStore(tmp_path / "_corpora")
+    # the same directory, used by another process
+    other_store = CorpusStore(tmp_path / "_corpora")
+
+    corpus_id, index = store.get_or_build(docs, RAG_PARAMS, file_names=file_names)
+    store.add_ref(corpus_id, "agent_1")
+    other_store.remove_ref(corpus_id, "agent_1")
+    assert not store.exists(corpus_id)
+
+    # a new agent over the same sources
+    assert store.get_or_build(docs, RAG_PARAMS, file_names=file_names) == (
+        corpus_id,
+        index,
+    )
+    assert store.exists(corpus_id)
+    store.add_ref(corpus_id, "agent_2")
+    assert other_store.get_refs(corpus_id) == ["agent_2"]
+
+
+def test_add_ref_stores_deleted_corpus_again(
+    tmp_path: Path, docs: List[Document], file_names: List[str]
+) -> None:
+    store = CorpusStore(tmp_path / "_corpora")
+    other_store = CorpusStore(tmp_path / "_corpora")
+
+    corpus_id, _ = store.get_or_build(docs, RAG_PARAMS, file_names=file_names)
+    # deleted before the new agent references it
+    other_store.add_ref(corpus_id, "agent_1")
+    other_store.remove_ref(corpus_id, "agent_1")
+    store.add_ref(corpus_id, "agent_2")
+    assert store.exists(corpus_id)
+    assert other_store.get_index(corpus_id, "offline:hash") is not None
+
+
+def test_add_ref_refuses_missing_corpus(tmp_path: Path) -> None:
+    with pytest.raises(ValueError):
+        CorpusStore(tmp_path / "_corpora").add_ref("Corpus_missing", "agent_1")
+    assert CorpusStore(tmp_path / "_corpora").get_refs("Corpus_missing") == []
@@ -0,0 +1,208 @@
+"""Tests for the LLM rate limiter / fair scheduler, with a fake clock."""
+
+import asyncio
+import threading
+import time
+from typing import Callable, Iterator, List
+
+import pytest
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.llms import MockLLM
+
+from core.llm_scheduler import (
+    LLMScheduler,
+    LLMSchedulerEventHandler,
+    Priority,
+    RateLimit,
+)
+
+KEY = "fake:model"
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _advance(scheduler: LLMScheduler, clock: FakeClock, secs: float) -> None:
+    """Advance the fake clock and wake up waiting calls."""
+    with scheduler._cond:
+        clock.now += secs
+        scheduler._cond.notify_all()
+
+
+def _wait_for(condition: Callable[[], bool], timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def _start_call(
+    scheduler: LLMScheduler,
+    granted: List[str],
+    name: str,
+    tokens: float = 0,
+    session_id: str = "default",
+    priority: Priority = Priority.INTERACTIVE,
+) -> threading.Thread:
+    """Acquire in a thread, appending name to granted once it goes through."""
+
+    def _run() -> None:
+        scheduler.acquire(KEY, tokens=tokens, session_id=session_id, priority=priority)
+        granted.append(name)
+
+    num_queued = scheduler.get_metrics().get(KEY, {}).get("queued", 0)
+    thread = threading.Thread(target=_run, daemon=True)
+    thread.start()
+    # queued in call order
+    _wait_for(lambda: scheduler.get_metrics()[KEY]["queued"] == num_queued + 1)
+    return thread
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
+
+
+def test_requests_per_minute(clock: FakeClock) -> None:
+    scheduler = LLMScheduler({KEY: RateLimit(requests_per_minute=2)}, clock=clock)
+    assert scheduler.acquire(KEY) == 0.0
+    assert scheduler.acquire(KEY) == 0.0
+
+    granted: List[str] = []
+    thread = _start_call(scheduler, granted, "third")
+    _advance(scheduler, clock, 29)
+    time.sleep(0.05)
+    assert granted == []
+    _advance(scheduler, clock, 1)
+    thread.join(timeout=5)
+    assert granted == ["third"]
+
+
+def test_tokens_per_minute(clock: FakeClock) -> None:
+    scheduler = LLMScheduler({"*": RateLimit(tokens_per_minute=60)}, clock=clock)
+    scheduler.acquire(KEY, tokens=50)
+
+    granted: List[str] = []
+    # 10 tokens left, 1 token / sec: 30 more tokens in 30 secs
+    thread = _start_call(scheduler, granted, "big", tokens=40)
+    _advance(scheduler, clock, 29)
+    time.sleep(0.05)
+    assert granted == []
+    _advance(scheduler, clock, 1)
+    thread.join(timeout=5)
+    assert granted == ["big"]
+
+    # usage reported after the fact is debited
+    scheduler.debit(KEY, 30)
+    assert scheduler.get_metrics()[KEY]["tokens"] == 120
+
+
+def test_interactive_before_background(clock: FakeClock) -> None:
+    scheduler = LLMScheduler({KEY: RateLimit(requests_per_minute=1)}, clock=clock)
+    scheduler.acquire(KEY)
+
+    granted: List[str] = []
+    threads = [
+        _start_call(scheduler, granted, "index build", priority=Priority.BACKGROUND),
+        _start_call(scheduler, granted, "chat", priority=Priority.INTERACTIVE),
+    ]
+    for expected in (["chat"], ["chat", "index build"]):
+        _advance(scheduler, clock, 60)
+        _wait_for(lambda: len(granted) == len(expected))
+        assert granted == expected
+    for thread in threads:
+        thread.join(timeout=5)
+
+
+def test_round_robin_across_sessions(clock: FakeClock) -> None:
+    scheduler = LLMScheduler({KEY: RateLimit(requests_per_minute=1)}, clock=clock)
+    scheduler.acquire(KEY, session_id="a")
+
+    granted: List[str] = []
+    threads = [
+        _start_call(scheduler, granted, "a1", session_id="a"),
+        _start_call(scheduler, granted, "a2", session_id="a"),
+        _start_call(scheduler, granted, "b1", session_id="b"),
+        _start_call(scheduler, granted, "b2", session_id="b"),
+    ]
+    for i in range(len(threads)):
+        _advance(scheduler, clock, 60)
+        _wait_for(lambda: len(granted) == i + 1)
+    # a was served last, b goes first, then they alternate
+    assert granted == ["b1", "a1", "b2", "a2"]
+    for thread in threads:
+        thread.join(timeout=5)
+
+
+def test_queue_wait_metrics(clock: FakeClock) -> None:
+    scheduler = LLMScheduler({KEY: RateLimit(requests_per_minute=1)}, clock=clock)
+    scheduler.acquire(KEY)
+
+    granted: List[str] = []
+    thread = _start_call(scheduler, granted, "second")
+    assert scheduler.get_metrics()[KEY]["queued"] == 1
+    _advance(scheduler, clock, 60)
+    thread.join(timeout=5)
+
+    metrics = scheduler.get_metrics()[KEY]
+    assert metrics["requests"] == 2
+    assert metrics["queued"] == 0
+    assert metrics["wait_max"] == 60
+    assert metrics["wait_avg"] == 30
+    assert metrics["wait_p95"] == 60
+
+
+@pytest.fixture
+def scheduler_handler(clock: FakeClock) -> Iterator[LLMScheduler]:
+    """Scheduler that the LLM calls of the fake provider go through."""
+    scheduler = LLMScheduler({"*": RateLimit(requests_per_minute=2)}, clock=clock)
+    handler = LLMSchedulerEventHandler(scheduler)
+    dispatcher = get_dispatcher()
+    dispatcher.add_event_handler(handler)
+    try:
+        yield scheduler
+    finally:
+        dispatcher.event_handlers.remove(handler)
+
+
+def test_fake_llm_calls_are_scheduled(
+    scheduler_handler: LLMScheduler, clock: FakeClock
+) -> None:
+    llm = MockLLM()
+    llm.complete("hello")
+    llm.complete("hello")
+    (key,) = scheduler_handler.get_metrics()
+    assert scheduler_handler.get_metrics()[key]["requests"] == 2
+
+    done = threading.Event()
+    thread = threading.Thread(
+        target=lambda: (llm.complete("hello"), done.set()), daemon=True
+    )
+    thread.start()
+    assert not done.wait(0.1)
+    _advance(scheduler_handler, clock, 30)
+    assert done.wait(5)
+
+
+def test_async_calls_dont_block_the_event_loop(
+    scheduler_handler: LLMScheduler,
+) -> None:
+    llm = MockLLM()
+    llm.complete("hello")
+    llm.complete("hello")
+
+    async def _run() -> None:
+        # over the limit: goes through (in debt) instead of freezing the loop
+        await asyncio.wait_for(llm.acomplete("hello"), timeout=0.5)
+        # async entry points wait for capacity without blocking the loop
+        waiting = asyncio.ensure_future(scheduler_handler.await_capacity())
+        await asyncio.sleep(0.1)
+        assert not waiting.done()
+        waiting.cancel()
+
+    asyncio.run(_run())
@@ -0,0 +1,141 @@
+"""Tests for the template fast path of the builder agent."""
+
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from core.agent_builder import loader
+from core.agent_builder.loader import (
+    DEFAULT_TASK_STR,
+    TEMPLATE_SYS_PROMPT_STR,
+    TaskPlan,
+    load_meta_agent_and_tools,
+    plan_task,
+)
+from core.agent_builder.registry import AgentCacheRegistry
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def _task_str(plan: TaskPlan) -> str:
+    prefix = TEMPLATE_SYS_PROMPT_STR.split("{task}")[0]
+    return plan.system_prompt[len(prefix) :].splitlines()[0]
+
+
+@pytest.fixture(autouse=True)
+def repo_cwd(monkeypatch: pytest.MonkeyPatch) -> None:
+    # data paths are relative to the repo, like in the app
+    monkeypatch.chdir(REPO_DIR)
+
+
+# the pills of the home page
+@pytest.mark.parametrize(
+    "task, file_names",
+    [
+        ("I want you to recommend me some books", ["data/books.csv"]),
+        (
+            "I want to search over my CSV documents",
+            sorted(str(path) for path in Path("data").rglob("*.csv")),
+        ),
+    ],
+)
+def test_plan_task_pills(task: str, file_names: List[str]) -> None:
+    plan = plan_task(task)
+    assert plan is not None
+    assert plan.file_names == file_names
+    assert _task_str(plan) == task
+
+
+@pytest.mark.parametrize(
+    "task",
+    [
+        "I want you to recommend me some musics",
+        "I want you to recommend me some recipes",
+        # the file isn't shipped with the repo
+        "I want to analyze this PDF file (data/invoices.pdf)",
+    ],
+)
+def test_plan_task_pills_without_data(task: str) -> None:
+    assert plan_task(task) is None
+
+
+def test_plan_task_pdf_pill(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "invoices.pdf").touch()
+    monkeypatch.chdir(tmp_path)
+
+    plan = plan_task("I want to analyze this PDF file (data/invoices.pdf)")
+    assert plan is not None
+    assert plan.file_names == ["data/invoices.pdf"]
+    assert _task_str(plan) == "I want to analyze this PDF file"
+
+
+@pytest.mark.parametrize(
+    "task, task_str, rag_params",
+    [
+        (
+            "Tell me about films from data/movies/war.csv and data/books.csv",
+            "Tell me about films",
+            {},
+        ),
+        ("top k 5 of data/books.csv", DEFAULT_TASK_STR, {"top_k": 5}),
+        (
+            "Answer questions over data/books.csv, with top k 3 and chunk size 256.",
+            "Answer questions.",
+            {"top_k": 3, "chunk_size": 256},
+        ),
+        (
+            "Summarize https://example.com/a.html for me",
+            "Summarize for me",
+            {"include_summarization": True},
+        ),
+    ],
+)
+def test_plan_task_system_prompt(task: str, task_str: str, rag_params: dict) -> None:
+    plan = plan_task(task)
+    assert plan is not None
+    assert _task_str(plan) == task_str
+    assert plan.rag_params == rag_params
+
+
+def test_plan_task_ambiguous() -> None:
+    # several datasets, missing file, web search
+    assert plan_task("Recommend books and movies") is None
+    assert plan_task("Answer questions over data/missing.csv") is None
+    assert plan_task("Search the web for books") is None
+
+
+@pytest.fixture
+def builder(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> loader.TemplateBuilderAgent:
+    # the builder steps themselves are covered by the builder
+    monkeypatch.setattr(loader, "run_task_plan", lambda plan, agent_builder: "built")
+    builder_agent, _ = load_meta_agent_and_tools(
+        agent_registry=AgentCacheRegistry(str(tmp_path))
+    )
+    assert isinstance(builder_agent, loader.TemplateBuilderAgent)
+    return builder_agent
+
+
+def test_fast_path(builder: loader.TemplateBuilderAgent) -> None:
+    response = builder._run_fast_path("I want you to recommend me some books")
+    assert response is not None
+    assert response.response == "built"
+    # recorded for follow-up requests
+    assert len(builder.chat_history) == 2
+
+
+def test_fast_path_only_when_untouched(builder: loader.TemplateBuilderAgent) -> None:
+    task = "I want you to recommend me some books"
+    builder._agent_builder.cache.system_prompt = "You are a book expert."
+    assert builder._run_fast_path(task) is None
+
+    builder._agent_builder.cache.system_prompt = None
+    builder._agent_builder.cache.file_names = ["data/books.csv"]
+    assert builder._run_fast_path(task) is None
+
+    builder._agent_builder.cache.file_names = []
+    builder.memory.put(loader.ChatMessage(role="user", content="Hi"))
+    assert builder._run_fast_path(task) is None
@@ -0,0 +1,42 @@
+"""Tests for the summarizing chat memory."""
+
+from typing import Any, List
+
+from llama_index.core.base.llms.types import ChatMessage, CompletionResponse
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.llms import MockLLM
+
+from core.llm_scheduler import (
+    Priority,
+    RequestContext,
+    get_request_context,
+    llm_request_context,
+)
+from core.memory import SummaryWindowMemory
+
+
+class RecordingLLM(MockLLM):
+    """Records the request context of each completion."""
+
+    contexts: List[Any] = Field(default_factory=list)
+
+    def complete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
+        self.contexts.append(get_request_context())
+        return CompletionResponse(text="A summary.")
+
+
+def test_summary_runs_in_background_in_the_session() -> None:
+    llm = RecordingLLM()
+    memory = SummaryWindowMemory.from_defaults(llm=llm, token_limit=5)
+    with llm_request_context("session", Priority.INTERACTIVE):
+        for i in range(3):
+            memory.put(ChatMessage(role="user", content=f"question {i} " * 10))
+            memory.put(ChatMessage(role="assistant", content=f"answer {i} " * 10))
+            memory.wait_for_summary(timeout=5)
+
+    assert llm.contexts
+    assert all(
+        context == RequestContext(session_id="session", priority=Priority.BACKGROUND)
+        for context in llm.contexts
+    )
+    assert memory.summary == "A summary."
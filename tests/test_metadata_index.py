@@ -0,0 +1,160 @@
+"""Tests for filter extraction and metadata-filtered retrieval."""
+
+from typing import Any, List, Optional
+
+import pytest
+from llama_index.core import VectorStoreIndex
+from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import MetadataFilters
+
+import core.metadata_index as metadata_index_module
+from core.metadata_index import MetadataFilteringRetriever, MetadataIndex
+from core.offline import resolve_offline_embed_model
+
+NODES = [
+    TextNode(
+        id_="apocalypse_now",
+        text="Apocalypse Now, 1979, War, Drama, Francis Ford Coppola",
+        metadata={"year": 1979, "genre": "War, Drama", "director": "Coppola"},
+    ),
+    TextNode(
+        id_="platoon",
+        text="Platoon, 1986, War, Drama, Oliver Stone",
+        metadata={"year": 1986, "genre": "War, Drama", "director": "Oliver Stone"},
+    ),
+    TextNode(
+        id_="nineteen_eighty_four",
+        text="1984, 1984, Drama, Michael Radford",
+        metadata={"year": 1984, "genre": "Drama", "director": "Michael Radford"},
+    ),
+    TextNode(
+        id_="the_fog_of_war",
+        text="The Fog of War, 2003, Documentary, History, Errol Morris",
+        metadata={
+            "year": 2003,
+            "genre": "Documentary, History",
+            "director": "Errol Morris",
+        },
+    ),
+    TextNode(
+        id_="orwell_1984",
+        text="1984, George Orwell, the story of Winston Smith in Oceania",
+        metadata={"original_publication_year": 1949, "authors": "George Orwell"},
+    ),
+]
+
+
+@pytest.fixture
+def metadata_index() -> MetadataIndex:
+    return MetadataIndex.from_nodes(NODES)
+
+
+def _get_ids(
+    metadata_index: MetadataIndex, filters: Optional[MetadataFilters]
+) -> List[str]:
+    assert filters is not None
+    return sorted(metadata_index.get_node_ids(filters))
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        # titles, not conditions
+        "Summarize the story of 1984",
+        "What happens in 1984?",
+        "What is the history of the Vietnam war?",
+        "Tell me about the war in this drama",
+    ],
+)
+def test_no_filters(metadata_index: MetadataIndex, query: str) -> None:
+    assert metadata_index.extract_filters(query) is None
+
+
+def test_genre_near_media_noun(metadata_index: MetadataIndex) -> None:
+    filters = metadata_index.extract_filters("Recommend war films")
+    assert _get_ids(metadata_index, filters) == ["apocalypse_now", "platoon"]
+    filters = metadata_index.extract_filters("Any history and drama movies?")
+    assert _get_ids(metadata_index, filters) == []
+    filters = metadata_index.extract_filters("Recommend some documentaries")
+    assert _get_ids(metadata_index, filters) == ["the_fog_of_war"]
+
+
+def test_year_filters(metadata_index: MetadataIndex) -> None:
+    filters = metadata_index.extract_filters("Which movies were released in 1984?")
+    assert _get_ids(metadata_index, filters) == ["nineteen_eighty_four"]
+    filters = metadata_index.extract_filters("war films from the 1970s")
+    assert _get_ids(metadata_index, filters) == ["apocalypse_now"]
+    filters = metadata_index.extract_filters("Books written before 1950")
+    assert _get_ids(metadata_index, filters) == ["orwell_1984"]
+
+
+def test_name_filters(metadata_index: MetadataIndex) -> None:
+    filters = metadata_index.extract_filters("What did George Orwell write?")
+    assert _get_ids(metadata_index, filters) == ["orwell_1984"]
+
+
+@pytest.fixture
+def vector_index() -> VectorStoreIndex:
+    return VectorStoreIndex(
+        [node.model_copy() for node in NODES],
+        embed_model=resolve_offline_embed_model("offline:hash"),
+    )
+
+
+@pytest.fixture
+def searched_node_ids(monkeypatch: pytest.MonkeyPatch) -> List[Optional[List[str]]]:
+    """Node ids each vector search is restricted to (None: whole index)."""
+    searched: List[Optional[List[str]]] = []
+
+    class RecordingRetriever(VectorIndexRetriever):
+        def __init__(self, *args: Any, **kwargs: Any) -> None:
+            searched.append(kwargs.get("node_ids"))
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(
+        metadata_index_module, "VectorIndexRetriever", RecordingRetriever
+    )
+    return searched
+
+
+def test_retriever_only_searches_filtered_nodes(
+    metadata_index: MetadataIndex,
+    vector_index: VectorStoreIndex,
+    searched_node_ids: List[Optional[List[str]]],
+) -> None:
+    retriever = MetadataFilteringRetriever(
+        vector_index, metadata_index, similarity_top_k=2
+    )
+    nodes = retriever.retrieve("Recommend war films")
+    assert sorted(node.node.node_id for node in nodes) == ["apocalypse_now", "platoon"]
+    assert searched_node_ids == [["apocalypse_now", "platoon"]]
+
+
+def test_retriever_fills_from_unfiltered_search(
+    metadata_index: MetadataIndex,
+    vector_index: VectorStoreIndex,
+    searched_node_ids: List[Optional[List[str]]],
+) -> None:
+    retriever = MetadataFilteringRetriever(
+        vector_index, metadata_index, similarity_top_k=2
+    )
+    # the year filter misreads the title: one match, the book fills the rest
+    query = "Which movies were released in 1984? the story of Winston Smith"
+    node_ids = [node.node.node_id for node in retriever.retrieve(query)]
+    assert node_ids == ["nineteen_eighty_four", "orwell_1984"]
+    assert searched_node_ids == [["nineteen_eighty_four"], None]
+
+
+def test_retriever_min_score(
+    metadata_index: MetadataIndex,
+    vector_index: VectorStoreIndex,
+    searched_node_ids: List[Optional[List[str]]],
+) -> None:
+    retriever = MetadataFilteringRetriever(
+        vector_index, metadata_index, similarity_top_k=2, min_score=1.1
+    )
+    # no filtered hit is good enough: all unfiltered
+    nodes = retriever.retrieve("Recommend war films")
+    assert len(nodes) == 2
+    assert searched_node_ids == [["apocalypse_now", "platoon"], None]
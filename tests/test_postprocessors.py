@@ -0,0 +1,164 @@
+"""Tests for the reranking, adaptive top-k and context packing postprocessors."""
+
+from typing import List, Optional, Sequence
+
+import pytest
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle, TextNode
+
+from core.postprocessors import (
+    AdaptiveTopK,
+    BatchedRerank,
+    ContextPacker,
+    ScoreCache,
+    count_tokens,
+)
+
+
+def _nodes(
+    texts: Sequence[str],
+    scores: Optional[Sequence[float]] = None,
+    file_path: Optional[str] = "a.txt",
+) -> List[NodeWithScore]:
+    scores = scores or [1.0] * len(texts)
+    metadata = {"file_path": file_path} if file_path is not None else {}
+    return [
+        NodeWithScore(
+            node=TextNode(id_=f"node_{i}", text=text, metadata=metadata),
+            score=score,
+        )
+        for i, (text, score) in enumerate(zip(texts, scores))
+    ]
+
+
+class LengthScorer:
+    """Scores texts by length, recording the batches it's called with."""
+
+    def __init__(self) -> None:
+        self.batches: List[List[str]] = []
+
+    def __call__(self, query: str, texts: Sequence[str]) -> List[float]:
+        self.batches.append(list(texts))
+        return [float(len(text)) for text in texts]
+
+
+def test_batched_rerank() -> None:
+    scorer = LengthScorer()
+    rerank = BatchedRerank(scorer, top_n=3, batch_size=2)
+    nodes = _nodes(["a", "aaaa", "aa", "aaaaa", "aaa"], file_path=None)
+
+    reranked = rerank.postprocess_nodes(nodes, QueryBundle("query"))
+
+    assert [node.node.node_id for node in reranked] == ["node_3", "node_1", "node_4"]
+    assert [node.score for node in reranked] == [5.0, 4.0, 3.0]
+    # 5 pairs in batches of 2
+    assert [len(batch) for batch in scorer.batches] == [2, 2, 1]
+
+
+def test_batched_rerank_cache() -> None:
+    scorer = LengthScorer()
+    cache = ScoreCache()
+    rerank = BatchedRerank(scorer, top_n=2, batch_size=8, cache=cache)
+    nodes = _nodes(["a", "aaaa", "aa"], file_path=None)
+
+    first = rerank.postprocess_nodes(nodes, QueryBundle("query"))
+    # same query, one new chunk: only it is scored
+    second = rerank.postprocess_nodes(
+        nodes + _nodes(["aaa"], file_path=None), QueryBundle("query")
+    )
+    # another query: scored again
+    rerank.postprocess_nodes(nodes, QueryBundle("other query"))
+
+    assert [node.score for node in first] == [4.0, 2.0]
+    assert [node.score for node in second] == [4.0, 3.0]
+    assert [len(batch) for batch in scorer.batches] == [3, 1, 3]
+
+
+def test_batched_rerank_no_query() -> None:
+    scorer = LengthScorer()
+    rerank = BatchedRerank(scorer, top_n=2)
+    nodes = _nodes(["a", "aaaa", "aa"])
+
+    assert rerank.postprocess_nodes(nodes) == nodes[:2]
+    assert scorer.batches == []
+
+
+@pytest.mark.parametrize(
+    "params, scores, expected_k",
+    [
+        # gap: 0.9 -> 0.5 is a drop of 0.44 of the top score
+        ({}, [0.9, 0.85, 0.5, 0.45], 2),
+        ({"score_gap": None}, [0.9, 0.85, 0.5, 0.45], 4),
+        ({"score_gap": 0.5}, [0.9, 0.85, 0.5, 0.45], 4),
+        # cutoff
+        ({"similarity_cutoff": 0.6}, [0.9, 0.85, 0.8, 0.5], 3),
+        # at least min_k, even below the cutoff / past a gap
+        ({"min_k": 3, "similarity_cutoff": 0.6}, [0.9, 0.5, 0.4, 0.3], 3),
+        ({"min_k": 2}, [0.9, 0.2, 0.15, 0.1], 4),
+        ({"min_k": 2}, [0.9, 0.8, 0.2, 0.1], 2),
+        # at most max_k
+        ({"max_k": 2}, [0.9, 0.9, 0.9, 0.9], 2),
+        # min_k over the number of nodes
+        ({"min_k": 5}, [0.9, 0.1], 2),
+        ({}, [0.9], 1),
+    ],
+)
+def test_adaptive_top_k_get_k(
+    params: dict, scores: List[float], expected_k: int
+) -> None:
+    assert AdaptiveTopK(**params)._get_k(scores) == expected_k
+
+
+def test_adaptive_top_k_sorts() -> None:
+    nodes = _nodes(["a", "b", "c"], scores=[0.1, 0.9, 0.85])
+
+    kept = AdaptiveTopK().postprocess_nodes(nodes)
+
+    assert [node.node.node_id for node in kept] == ["node_1", "node_2"]
+
+
+def test_context_packer_drops_duplicates() -> None:
+    text = "the quick brown fox jumps over the lazy dog near the river bank"
+    nodes = _nodes(
+        [text, text + " today", "an entirely different chunk about cats and mice"]
+    )
+
+    packed = ContextPacker().postprocess_nodes(nodes)
+
+    assert [node.node.node_id for node in packed] == ["node_0", "node_2"]
+
+
+def test_context_packer_strips_repeated_metadata() -> None:
+    nodes = _nodes(["first chunk of text", "second chunk of other words"])
+    nodes += _nodes(["third chunk, another file"], file_path="b.txt")
+
+    packed = ContextPacker().postprocess_nodes(nodes)
+
+    contents = [
+        node.node.get_content(metadata_mode=MetadataMode.LLM) for node in packed
+    ]
+    assert "file_path: a.txt" in contents[0]
+    assert "file_path" not in contents[1]
+    assert "file_path: b.txt" in contents[2]
+    # the nodes of the docstore are left as is
+    assert nodes[1].node.excluded_llm_metadata_keys == []
+
+
+def test_context_packer_budget() -> None:
+    chunk = " ".join(f"word{i}" for i in range(100))
+    nodes = _nodes([chunk, chunk.upper() + " x", chunk.replace("word", "term")])
+    node_tokens = count_tokens(nodes[0].node.get_content(MetadataMode.LLM))
+
+    # room for one node and a half
+    packed = ContextPacker(token_budget=int(node_tokens * 1.5)).postprocess_nodes(nodes)
+
+    assert len(packed) == 2
+    total = sum(
+        count_tokens(node.node.get_content(MetadataMode.LLM)) for node in packed
+    )
+    assert total <= int(node_tokens * 1.5)
+    truncated_text = packed[1].node.get_content(MetadataMode.NONE)
+    assert 0 < len(truncated_text) < len(nodes[1].node.get_content(MetadataMode.NONE))
+
+    # too little room left to truncate: the node is dropped
+    packed = ContextPacker(token_budget=node_tokens + 10).postprocess_nodes(nodes)
+    assert [node.node.node_id for node in packed] == ["node_0"]
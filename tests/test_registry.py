@@ -0,0 +1,96 @@
+"""Tests for replacing agents and cleaning up after interrupted writes."""
+
+import os
+import time
+from pathlib import Path
+from typing import Any, List
+
+import pytest
+
+from build_agents import build_agent
+from core.agent_builder.registry import AgentCacheRegistry
+from core.param_cache import ParamCache
+
+
+def _age(path: Path, secs: float) -> None:
+    mtime = time.time() - secs
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def registry(tmp_path: Path) -> AgentCacheRegistry:
+    """Registry with one agent over a shared corpus, `agent_1`."""
+    data_path = tmp_path / "a.txt"
+    data_path.write_text("Some text about cats.")
+    registry = AgentCacheRegistry(tmp_path / "cache")
+    build_agent(
+        {
+            "agent_id": "agent_1",
+            "system_prompt": "You are a helpful assistant.",
+            "file_names": [str(data_path)],
+            "rag_params": {"embed_model": "offline:hash", "llm": "offline:echo"},
+        },
+        registry,
+    )
+    return registry
+
+
+def test_replace_agent_cache(
+    registry: AgentCacheRegistry, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    cache = registry.get_agent_cache("agent_1")
+    corpus_id = cache.corpus_id
+    assert corpus_id is not None
+    assert registry.corpus_store.get_refs(corpus_id) == ["agent_1"]
+
+    save_to_disk = ParamCache.save_to_disk
+    seen_while_saving: List[Any] = []
+
+    def _save_to_disk(self: ParamCache, save_dir: str) -> None:
+        # the old agent is still registered and loadable
+        seen_while_saving.append(registry.get_agent_ids())
+        seen_while_saving.append(registry.get_agent_cache("agent_1").agent_id)
+        save_to_disk(self, save_dir)
+
+    monkeypatch.setattr(ParamCache, "save_to_disk", _save_to_disk)
+    cache.agent_id = "agent_2"
+    registry.replace_agent_cache("agent_1", "agent_2", cache)
+
+    assert seen_while_saving == [["agent_1"], "agent_1"]
+    assert registry.get_agent_ids() == ["agent_2"]
+    assert registry.get_agent_cache("agent_2").agent_id == "agent_2"
+    with pytest.raises(ValueError):
+        registry.get_agent_cache("agent_1")
+    # the corpus is referenced by the new agent only
+    assert registry.corpus_store.get_refs(corpus_id) == ["agent_2"]
+    assert registry.corpus_store.exists(corpus_id)
+
+
+def test_save_agent_cache_keeps_corpus(registry: AgentCacheRegistry) -> None:
+    cache = registry.get_agent_cache("agent_1")
+    registry.save_agent_cache("agent_1", cache)
+
+    assert registry.get_agent_ids() == ["agent_1"]
+    assert registry.corpus_store.get_refs(cache.corpus_id) == ["agent_1"]
+    assert registry.corpus_store.exists(cache.corpus_id)
+
+
+def test_cleanup_orphans(registry: AgentCacheRegistry, tmp_path: Path) -> None:
+    registry_dir = tmp_path / "cache"
+    cache = registry.get_agent_cache("agent_1")
+    # saved, but the process died before registering it
+    cache.save_to_disk(str(registry_dir / "orphan"))
+    registry.corpus_store.add_ref(cache.corpus_id, "orphan")
+    (registry_dir / ".agent_1.x1.staging").mkdir()
+    for path in registry_dir.iterdir():
+        _age(path, 120)
+    # being built by another process
+    cache.save_to_disk(str(registry_dir / "new"))
+
+    cleaned = registry.cleanup_orphans(grace_period=60)
+
+    assert sorted(cleaned) == [".agent_1.x1.staging", "orphan"]
+    assert not (registry_dir / "orphan").exists()
+    assert (registry_dir / "new").exists()
+    assert registry.get_agent_cache("agent_1").agent_id == "agent_1"
+    assert registry.corpus_store.get_refs(cache.corpus_id) == ["agent_1"]
@@ -0,0 +1,256 @@
+"""Tests for single-flight request coalescing."""
+
+import asyncio
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+import pytest
+from llama_index.core.chat_engine.types import (
+    AgentChatResponse,
+    BaseChatEngine,
+    StreamingAgentChatResponse,
+)
+from llama_index.core.llms import ChatMessage
+from llama_index.core.memory import ChatMemoryBuffer
+
+from core.single_flight import SingleFlight, SingleFlightChatEngine
+
+
+def _wait_for(condition: Callable[[], bool], timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+class BlockingCall:
+    """Function that blocks until released, counting its executions."""
+
+    def __init__(self, result: Any = "result") -> None:
+        self.result = result
+        self.release = threading.Event()
+        self.calls = 0
+
+    def __call__(self) -> Any:
+        self.calls += 1
+        self.release.wait(timeout=5)
+        if isinstance(self.result, BaseException):
+            raise self.result
+        return self.result
+
+
+def _run_concurrently(
+    single_flight: SingleFlight,
+    keys: List[str],
+    fn: BlockingCall,
+) -> List[Any]:
+    """Call `single_flight.do` for each key in its own thread.
+
+    The first call is started alone, the others once it's in flight. `fn` is
+    released once all the calls are in flight or merged.
+
+    """
+    results: List[Any] = [None] * len(keys)
+
+    def _call(i: int) -> None:
+        try:
+            results[i] = single_flight.do(keys[i], fn)
+        except BaseException as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=_call, args=(i,)) for i in range(len(keys))]
+    threads[0].start()
+    _wait_for(lambda: single_flight.get_metrics()["in_flight"] == 1)
+    for thread in threads[1:]:
+        thread.start()
+    num_executions = len(set(keys))
+    _wait_for(
+        lambda: single_flight.get_metrics()
+        == {
+            "executions": num_executions,
+            "merged": len(keys) - num_executions,
+            "in_flight": num_executions,
+        }
+    )
+    fn.release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    return results
+
+
+def test_do_shares_one_execution() -> None:
+    single_flight = SingleFlight()
+    fn = BlockingCall()
+
+    results = _run_concurrently(single_flight, ["key"] * 4, fn)
+
+    assert results == ["result"] * 4
+    assert fn.calls == 1
+    assert single_flight.get_metrics() == {
+        "executions": 1,
+        "merged": 3,
+        "in_flight": 0,
+    }
+
+
+def test_do_different_keys_not_merged() -> None:
+    single_flight = SingleFlight()
+    fn = BlockingCall()
+
+    results = _run_concurrently(single_flight, ["a", "b", "c"], fn)
+
+    assert results == ["result"] * 3
+    assert fn.calls == 3
+    assert single_flight.get_metrics()["executions"] == 3
+    assert single_flight.get_metrics()["merged"] == 0
+
+
+def test_do_raises_to_all_waiters() -> None:
+    single_flight = SingleFlight()
+    error = ValueError("failed")
+    fn = BlockingCall(result=error)
+
+    results = _run_concurrently(single_flight, ["key"] * 3, fn)
+
+    assert results == [error] * 3
+    assert fn.calls == 1
+    # not cached: the next call runs again
+    fn.result = "result"
+    assert single_flight.do("key", fn) == "result"
+    assert fn.calls == 2
+
+
+def test_reset_metrics() -> None:
+    single_flight = SingleFlight()
+    single_flight.do("key", lambda: None)
+    single_flight.reset_metrics()
+    assert single_flight.get_metrics() == {
+        "executions": 0,
+        "merged": 0,
+        "in_flight": 0,
+    }
+
+
+def test_ado_shares_one_execution() -> None:
+    single_flight = SingleFlight()
+    calls = 0
+
+    async def _fn() -> str:
+        nonlocal calls
+        calls += 1
+        while single_flight.get_metrics()["merged"] < 2:
+            await asyncio.sleep(0.001)
+        return "result"
+
+    async def _main() -> List[Any]:
+        leader = asyncio.ensure_future(single_flight.ado("key", _fn))
+        while single_flight.get_metrics()["in_flight"] == 0:
+            await asyncio.sleep(0.001)
+        followers = [single_flight.ado("key", _fn) for _ in range(2)]
+        return await asyncio.gather(leader, *followers)
+
+    assert asyncio.run(_main()) == ["result"] * 3
+    assert calls == 1
+    assert single_flight.get_metrics()["merged"] == 2
+
+
+class FakeChatEngine(BaseChatEngine):
+    """Chat engine answering after `release`, recording the turn in its memory."""
+
+    def __init__(self, release: threading.Event) -> None:
+        self.release = release
+        self.memory = ChatMemoryBuffer.from_defaults()
+        self.calls = 0
+
+    def reset(self) -> None:
+        self.memory.reset()
+
+    @property
+    def chat_history(self) -> List[ChatMessage]:
+        return self.memory.get_all()
+
+    def chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> AgentChatResponse:
+        self.calls += 1
+        self.release.wait(timeout=5)
+        response = f"answer to {message}"
+        self.memory.put(ChatMessage(role="user", content=message))
+        self.memory.put(ChatMessage(role="assistant", content=response))
+        return AgentChatResponse(response=response)
+
+    def stream_chat(self, *args: Any, **kwargs: Any) -> StreamingAgentChatResponse:
+        raise NotImplementedError
+
+    async def achat(self, *args: Any, **kwargs: Any) -> AgentChatResponse:
+        raise NotImplementedError
+
+    async def astream_chat(
+        self, *args: Any, **kwargs: Any
+    ) -> StreamingAgentChatResponse:
+        raise NotImplementedError
+
+
+@pytest.fixture
+def release() -> threading.Event:
+    return threading.Event()
+
+
+def test_chat_engine_followers_record_turn(release: threading.Event) -> None:
+    single_flight = SingleFlight()
+    engines = [
+        SingleFlightChatEngine(
+            FakeChatEngine(release), "agent", single_flight=single_flight
+        )
+        for _ in range(3)
+    ]
+    responses: List[Any] = [None] * 3
+
+    def _chat(i: int) -> None:
+        responses[i] = engines[i].chat("Hello?")
+
+    threads = [threading.Thread(target=_chat, args=(i,)) for i in range(3)]
+    threads[0].start()
+    _wait_for(lambda: single_flight.get_metrics()["in_flight"] == 1)
+    for thread in threads[1:]:
+        thread.start()
+    _wait_for(lambda: single_flight.get_metrics()["merged"] == 2)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert [str(response) for response in responses] == ["answer to Hello?"] * 3
+    assert sum(engine.chat_engine.calls for engine in engines) == 1
+    # every session has the turn in its history, for follow-up questions
+    for engine in engines:
+        assert [(m.role.value, m.content) for m in engine.chat_history] == [
+            ("user", "Hello?"),
+            ("assistant", "answer to Hello?"),
+        ]
+
+
+def test_chat_engine_different_history_not_merged(release: threading.Event) -> None:
+    single_flight = SingleFlight()
+    engines = [
+        SingleFlightChatEngine(
+            FakeChatEngine(release), "agent", single_flight=single_flight
+        )
+        for _ in range(2)
+    ]
+    # the second conversation already had a turn
+    engines[1].chat_engine.memory.put(ChatMessage(role="user", content="Hi."))
+    assert engines[0]._get_key("Hello?", None) != engines[1]._get_key("Hello?", None)
+
+    release.set()
+    threads = [
+        threading.Thread(target=engine.chat, args=("Hello?",)) for engine in engines
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert [engine.chat_engine.calls for engine in engines] == [1, 1]
+    assert single_flight.get_metrics()["merged"] == 0
+    assert len(engines[1].chat_history) == 3
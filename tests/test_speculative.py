@@ -0,0 +1,114 @@
+"""Tests for speculative retrieval in the condense + context chat engine."""
+
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+import pytest
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.base.llms.types import CompletionResponse
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.llms import ChatMessage, MockLLM
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+import core.speculative as speculative_module
+from core.speculative import SpeculativeCondensePlusContextChatEngine
+
+HISTORY = [
+    ChatMessage(role="user", content="Tell me about dogs."),
+    ChatMessage(role="assistant", content="Dogs are domesticated wolves."),
+]
+
+
+class CondensingLLM(MockLLM):
+    """Condenses every question to `condensed` (raises if it's an exception)."""
+
+    condensed: Any = Field(default="")
+
+    def complete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
+        if isinstance(self.condensed, BaseException):
+            raise self.condensed
+        return CompletionResponse(text=self.condensed)
+
+
+class RecordingRetriever(BaseRetriever):
+    """Returns one node per query, recording the queries."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.queries: List[str] = []
+        self._lock = threading.Lock()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        with self._lock:
+            self.queries.append(query_bundle.query_str)
+        return [NodeWithScore(node=TextNode(text=query_bundle.query_str), score=1.0)]
+
+
+def _make_chat_engine(
+    condensed: Any,
+) -> SpeculativeCondensePlusContextChatEngine:
+    llm = CondensingLLM()
+    llm.condensed = condensed
+    return SpeculativeCondensePlusContextChatEngine.from_defaults(
+        RecordingRetriever(), llm=llm, chat_history=HISTORY
+    )
+
+
+def test_reuses_speculative_retrieval() -> None:
+    message = "How long do dogs live?"
+    chat_engine = _make_chat_engine(condensed="How long do dogs live?")
+
+    _, context_source, nodes = chat_engine._run_c3(message)
+
+    assert chat_engine._retriever.queries == [message]
+    assert [node.node.get_content() for node in nodes] == [message]
+    assert context_source.raw_input == {"message": message}
+
+
+def test_retrieves_again_with_condensed_question() -> None:
+    message = "How long do they live?"
+    condensed = "What is the lifespan of domesticated dogs?"
+    chat_engine = _make_chat_engine(condensed=condensed)
+
+    _, context_source, nodes = chat_engine._run_c3(message)
+
+    assert chat_engine._retriever.queries == [message, condensed]
+    assert [node.node.get_content() for node in nodes] == [condensed]
+    assert context_source.raw_input == {"message": condensed}
+
+
+def test_no_history_no_speculation() -> None:
+    message = "How long do dogs live?"
+    chat_engine = _make_chat_engine(condensed=ValueError("no LLM call expected"))
+    chat_engine.reset()
+
+    chat_engine._run_c3(message)
+
+    assert chat_engine._retriever.queries == [message]
+
+
+class PendingExecutor:
+    """Executor whose tasks never start (so they can be cancelled)."""
+
+    def __init__(self) -> None:
+        self.futures: List[Future] = []
+
+    def submit(self, fn: Callable, *args: Any) -> Future:
+        future: Future = Future()
+        self.futures.append(future)
+        return future
+
+
+def test_condense_error_cancels_speculative_retrieval(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    executor = PendingExecutor()
+    monkeypatch.setattr(speculative_module, "_SPECULATIVE_EXECUTOR", executor)
+    chat_engine = _make_chat_engine(condensed=ValueError("LLM down"))
+
+    with pytest.raises(ValueError, match="LLM down"):
+        chat_engine._run_c3("How long do they live?")
+
+    assert len(executor.futures) == 1
+    assert executor.futures[0].cancelled()
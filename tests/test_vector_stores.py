@@ -0,0 +1,165 @@
+"""Tests for the compact vector stores, against `SimpleVectorStore`."""
+
+import dataclasses
+from pathlib import Path
+from typing import Callable, List
+
+import numpy as np
+import pytest
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores import SimpleVectorStore, VectorStoreQuery
+from llama_index.core.vector_stores.types import BasePydanticVectorStore
+
+from core.vector_stores import (
+    ProductQuantizedVectorStore,
+    QuantizedVectorStore,
+    ShardedVectorStore,
+)
+
+NUM_NODES = 1000
+DIM = 64
+NUM_QUERIES = 20
+TOP_K = 10
+
+# (store factory, minimum recall@10 against exact search)
+STORES = {
+    "float16": (lambda: QuantizedVectorStore(precision="float16"), 0.99),
+    "int8": (lambda: QuantizedVectorStore(precision="int8"), 0.95),
+    "int8_dim32": (lambda: QuantizedVectorStore(precision="int8", dim=32), 0.9),
+    "int8_dim32_rerank": (
+        lambda: QuantizedVectorStore(
+            precision="int8", dim=32, full_precision_rerank=True
+        ),
+        0.95,
+    ),
+    # product quantization is coarse, it relies on re-ranking for precision
+    "pq": (lambda: ProductQuantizedVectorStore(), 0.45),
+    "pq_rerank": (
+        lambda: ProductQuantizedVectorStore(full_precision_rerank=True),
+        0.85,
+    ),
+    "sharded": (lambda: ShardedVectorStore(shard_by="source"), 1.0),
+    "sharded_int8": (
+        lambda: ShardedVectorStore(
+            shard_by="hash", num_shards=4, shard_params={"precision": "int8"}
+        ),
+        0.95,
+    ),
+}
+
+
+def _random_embeddings(rng: np.random.Generator, num: int) -> np.ndarray:
+    # most of the variance in the leading dimensions, like the embeddings of
+    # models trained to be truncated
+    return rng.normal(size=(num, DIM)) * np.exp(-np.arange(DIM) / 16)
+
+
+@pytest.fixture(scope="module")
+def nodes() -> List[TextNode]:
+    embeddings = _random_embeddings(np.random.default_rng(0), NUM_NODES)
+    return [
+        TextNode(
+            id_=f"node_{i}",
+            text="",
+            embedding=embedding.tolist(),
+            metadata={"file_path": f"file_{i % 4}.txt"},
+        )
+        for i, embedding in enumerate(embeddings)
+    ]
+
+
+@pytest.fixture(scope="module")
+def queries() -> List[VectorStoreQuery]:
+    embeddings = _random_embeddings(np.random.default_rng(1), NUM_QUERIES)
+    return [
+        VectorStoreQuery(query_embedding=embedding.tolist(), similarity_top_k=TOP_K)
+        for embedding in embeddings
+    ]
+
+
+@pytest.fixture(scope="module")
+def exact_store(nodes: List[TextNode]) -> SimpleVectorStore:
+    store = SimpleVectorStore()
+    store.add(nodes)
+    return store
+
+
+def _make_store(name: str, nodes: List[TextNode]) -> BasePydanticVectorStore:
+    make_store: Callable[[], BasePydanticVectorStore] = STORES[name][0]
+    store = make_store()
+    store.add(nodes)
+    return store
+
+
+def _recall(
+    store: BasePydanticVectorStore,
+    exact_store: SimpleVectorStore,
+    queries: List[VectorStoreQuery],
+) -> float:
+    recalls = []
+    for query in queries:
+        expected_ids = set(exact_store.query(query).ids or [])
+        ids = set(store.query(query).ids or [])
+        recalls.append(len(expected_ids & ids) / TOP_K)
+    return float(np.mean(recalls))
+
+
+@pytest.mark.parametrize("name", list(STORES))
+def test_recall(
+    name: str,
+    nodes: List[TextNode],
+    queries: List[VectorStoreQuery],
+    exact_store: SimpleVectorStore,
+) -> None:
+    store = _make_store(name, nodes)
+    assert _recall(store, exact_store, queries) >= STORES[name][1]
+
+
+@pytest.mark.parametrize("name", list(STORES))
+def test_persist_round_trip(
+    name: str,
+    nodes: List[TextNode],
+    queries: List[VectorStoreQuery],
+    tmp_path: Path,
+) -> None:
+    store = _make_store(name, nodes)
+    persist_path = str(tmp_path / "default__vector_store.json")
+    store.persist(persist_path)
+    loaded_store = type(store).from_persist_path(persist_path)
+
+    assert type(loaded_store) is type(store)
+    for query in queries[:5]:
+        result = store.query(query)
+        loaded_result = loaded_store.query(query)
+        assert loaded_result.ids == result.ids
+        assert loaded_result.similarities == pytest.approx(result.similarities)
+
+
+@pytest.mark.parametrize("name", list(STORES))
+def test_top_k_bounds(
+    name: str, nodes: List[TextNode], queries: List[VectorStoreQuery]
+) -> None:
+    store = _make_store(name, nodes[:20])
+    query = dataclasses.replace(queries[0], similarity_top_k=0)
+    assert not store.query(query).ids
+
+    query = dataclasses.replace(queries[0], similarity_top_k=50)
+    result = store.query(query)
+    assert sorted(result.ids or []) == sorted(node.node_id for node in nodes[:20])
+    similarities = result.similarities or []
+    assert similarities == sorted(similarities, reverse=True)
+
+
+def test_sharded_merge_order(
+    nodes: List[TextNode],
+    queries: List[VectorStoreQuery],
+    exact_store: SimpleVectorStore,
+) -> None:
+    store = _make_store("sharded", nodes)
+    assert len(store.shard_sizes) == 4
+    for query in queries:
+        # float32 shards: the merged top-k is the exact top-k, in order
+        result = store.query(query)
+        expected = exact_store.query(query)
+        assert result.ids == expected.ids
+        assert result.similarities == pytest.approx(expected.similarities, abs=1e-5)